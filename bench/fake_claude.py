@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の偽claudeコマンド
+
+本物のClaude CLIと同じ引数（-p / --output-format text|json|stream-json / --resume）を
+受け付け、環境変数で指定した遅延・出力サイズ・出力間隔・終了コードで応答する。
+
+    FAKE_CLAUDE_LATENCY   最初の出力までの秒数（デフォルト: 0）
+    FAKE_CLAUDE_BYTES     最終結果の出力バイト数（デフォルト: 1024）
+    FAKE_CLAUDE_CHUNKS    stream-json時のassistantイベント数（デフォルト: 5）
+    FAKE_CLAUDE_INTERVAL  assistantイベントの間隔秒（デフォルト: 0.05）
+    FAKE_CLAUDE_EXIT      終了コード（デフォルト: 0）
+    FAKE_CLAUDE_STDERR    標準エラーに書く文字列（デフォルト: なし）
+    FAKE_CLAUDE_WRITE     作業ディレクトリのファイルに追記する行数（デフォルト: 0）
+    FAKE_CLAUDE_EXPLORE   最初の編集前にリポジトリを探索する1ターンの秒数（デフォルト: 0）
+    FAKE_CLAUDE_EXPLORE_TURNS  探索のターン数（デフォルト: 3）
+
+--append-system-prompt（Botのリポジトリ概要）は受け付けるが内容は見ず、探索は常に行う。
+概要で探索が短くなるかは本物のClaudeの振る舞いなので、オフラインでは計測しない。
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+LINE = "- src/module.py: 関数を追加し、テストを更新しました\n"
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def make_output(size):
+    """改行を含む指定バイト数程度のテキスト（分割処理が実際の出力に近くなるように）"""
+    unit = LINE.encode('utf-8')
+    text = LINE * (size // len(unit) + 1)
+    return text.encode('utf-8')[:size].decode('utf-8', 'ignore')
+
+
+def result_event(session_id, exit_code, started, result, turns):
+    """json・stream-jsonの最後に出るresultイベント（使用量は出力サイズから概算）"""
+    return {
+        'type': 'result',
+        'subtype': 'success' if exit_code == 0 else 'error',
+        'session_id': session_id,
+        'is_error': exit_code != 0,
+        'duration_ms': int((time.monotonic() - started) * 1000),
+        'duration_api_ms': int((time.monotonic() - started) * 800),
+        'num_turns': turns,
+        'total_cost_usd': round(len(result) * 2e-6, 6),
+        'usage': {
+            'input_tokens': 120 * turns,
+            'cache_read_input_tokens': 4000 * turns,
+            'cache_creation_input_tokens': 800,
+            'output_tokens': len(result) // 4,
+        },
+        'result': result,
+    }
+
+
+def explore(turns, seconds, session_id, output_format):
+    """
+    ファイル構成・最近の変更を調べるターン（本物のClaudeがLS・Glob・git logを
+    呼ぶのと同じく実際に作業ディレクトリを走査し、1ターンごとにseconds秒待つ）
+    """
+    tools = [
+        ('LS', {'path': '.'}),
+        ('Glob', {'pattern': '**/*'}),
+        ('Bash', {'command': 'git log --name-only -n 15'}),
+    ]
+    for turn in range(turns):
+        name, tool_input = tools[turn % len(tools)]
+        if name == 'Bash':
+            subprocess.run(['git', 'log', '--name-only', '-n', '15'], capture_output=True)
+        else:
+            for root, dirs, names in os.walk('.'):
+                dirs[:] = [d for d in dirs if d != '.git']
+                for file_name in names:
+                    os.stat(os.path.join(root, file_name))
+        time.sleep(seconds)
+        if output_format == 'stream-json':
+            emit({
+                'type': 'assistant',
+                'session_id': session_id,
+                'message': {'content': [{'type': 'tool_use', 'name': name, 'input': tool_input}]},
+            })
+
+
+def emit(event):
+    sys.stdout.write(json.dumps(event, ensure_ascii=False) + '\n')
+    sys.stdout.flush()
+
+
+def main(argv):
+    if '--version' in argv:
+        print('0.0.0 (fake claude)')
+        return 0
+
+    output_format = 'text'
+    if '--output-format' in argv:
+        output_format = argv[argv.index('--output-format') + 1]
+    session_id = argv[argv.index('--resume') + 1] if '--resume' in argv else str(uuid.uuid4())
+
+    latency = env_float('FAKE_CLAUDE_LATENCY', 0)
+    size = int(os.environ.get('FAKE_CLAUDE_BYTES', 1024))
+    chunks = int(os.environ.get('FAKE_CLAUDE_CHUNKS', 5))
+    interval = env_float('FAKE_CLAUDE_INTERVAL', 0.05)
+    exit_code = int(os.environ.get('FAKE_CLAUDE_EXIT', 0))
+    stderr = os.environ.get('FAKE_CLAUDE_STDERR', '')
+    write = int(os.environ.get('FAKE_CLAUDE_WRITE', 0))
+    explore_seconds = env_float('FAKE_CLAUDE_EXPLORE', 0)
+    explore_turns = int(os.environ.get('FAKE_CLAUDE_EXPLORE_TURNS', 3))
+
+    started = time.monotonic()
+    time.sleep(latency)
+    result = make_output(size)
+    if write:
+        # 変更を加えたように見せる（worktreeのコミット・差分集計の経路を通す）
+        with open(f"fake_{session_id[:8]}.py", 'a', encoding='utf-8') as f:
+            f.write(f"# {session_id}\n" * write)
+
+    if output_format == 'stream-json':
+        emit({'type': 'system', 'subtype': 'init', 'session_id': session_id, 'model': 'fake-model'})
+    if explore_seconds:
+        explore(explore_turns, explore_seconds, session_id, output_format)
+
+    if output_format == 'stream-json':
+        for index in range(chunks):
+            if index:
+                time.sleep(interval)
+            emit({
+                'type': 'assistant',
+                'session_id': session_id,
+                'message': {'content': [
+                    {'type': 'text', 'text': f"ステップ {index + 1}/{chunks} を実行中"},
+                    {'type': 'tool_use', 'name': 'Edit', 'input': {'file_path': f"src/module_{index}.py"}},
+                ]},
+            })
+        emit(result_event(session_id, exit_code, started, result, chunks + 1))
+    elif output_format == 'json':
+        emit(result_event(session_id, exit_code, started, result, 1))
+    else:
+        sys.stdout.write(result)
+        sys.stdout.flush()
+
+    if stderr:
+        sys.stderr.write(stderr + '\n')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
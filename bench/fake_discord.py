@@ -0,0 +1,146 @@
+"""
+ベンチマーク用の偽Discordトランスポート
+
+Botが使うチャンネル・メッセージ・コマンドコンテキストのうち、送信と編集だけを
+実装する。呼び出しはすべてFakeTransportに記録され、チャンネルごとの
+レート制限（既定: 5回/5秒）を超えた呼び出しはdiscord.pyが429を受けた場合と
+同じく待機してから処理される。
+"""
+
+import asyncio
+import contextlib
+import itertools
+import time
+from collections import Counter, defaultdict, deque
+
+
+class FakeTransport:
+    """全チャンネルの送信・編集を記録し、レート制限を再現する"""
+
+    def __init__(self, *, rate_limit=5, per=5.0, latency=0.0):
+        self.rate_limit = rate_limit
+        self.per = per
+        self.latency = latency
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.rate_limit_wait = 0.0
+        self.bytes_sent = 0
+        self.channels = {}
+        self._windows = defaultdict(deque)
+        self._ids = itertools.count(1)
+
+    def get_channel(self, channel_id):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = FakeChannel(self, channel_id)
+        return self.channels[channel_id]
+
+    def next_id(self):
+        return next(self._ids)
+
+    async def request(self, kind, channel_id, size=0):
+        """1回のAPI呼び出し（レート制限に掛かれば空くまで待つ）"""
+        if self.rate_limit:
+            window = self._windows[channel_id]
+            while True:
+                now = time.monotonic()
+                while window and now - window[0] >= self.per:
+                    window.popleft()
+                if len(window) < self.rate_limit:
+                    break
+                retry_after = self.per - (now - window[0])
+                self.rate_limited += 1
+                self.rate_limit_wait += retry_after
+                await asyncio.sleep(retry_after)
+            window.append(time.monotonic())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[kind] += 1
+        self.bytes_sent += size
+
+    def summary(self):
+        return {
+            'calls': dict(self.calls),
+            'total_calls': sum(self.calls.values()),
+            'rate_limited': self.rate_limited,
+            'rate_limit_wait': round(self.rate_limit_wait, 3),
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+def _payload_size(content=None, embed=None, file=None):
+    size = len((content or '').encode('utf-8'))
+    if embed is not None:
+        size += len(str(embed.description or '').encode('utf-8'))
+        size += sum(len(str(f.value).encode('utf-8')) for f in embed.fields)
+    if file is not None:
+        # discord.Fileの中身を読み切る（実際のアップロードと同じくI/Oを発生させる）
+        size += len(file.fp.read())
+    return size
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.channel = channel
+        self.id = channel.transport.next_id()
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, *, content=None, embed=None):
+        await self.channel.transport.request('edit', self.channel.id, _payload_size(content, embed))
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        return self
+
+    async def delete(self):
+        await self.channel.transport.request('delete', self.channel.id)
+
+
+class FakeChannel:
+    def __init__(self, transport, channel_id):
+        self.transport = transport
+        self.id = channel_id
+        self.parent_id = None
+        self.messages = []
+
+    async def send(self, content=None, *, embed=None, file=None, **kwargs):
+        kind = 'send_file' if file is not None else 'send_embed' if embed is not None else 'send'
+        await self.transport.request(kind, self.id, _payload_size(content, embed, file))
+        message = FakeMessage(self, content, embed)
+        self.messages.append(message)
+        return message
+
+
+class FakeAuthor:
+    def __init__(self, author_id=1, name='bench'):
+        self.id = author_id
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeCommandMessage:
+    """コマンドを送ったメッセージ（添付ファイルのみ）"""
+
+    def __init__(self, attachments=None):
+        self.attachments = attachments or []
+
+
+class FakeContext:
+    """commands.Contextの代わりにコマンドのコールバックへ渡す"""
+
+    def __init__(self, bot, channel, author=None, attachments=None):
+        self.bot = bot
+        self.channel = channel
+        self.author = author or FakeAuthor()
+        self.message = FakeCommandMessage(attachments)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        await self.channel.transport.request('typing', self.channel.id)
+        yield
@@ -0,0 +1,381 @@
+"""
+Discord Dev Bot ベンチマーク
+
+DiscordとClaude CLIを使わずに、implementコマンドの受付から結果送信までを
+オフラインで計測する。偽claude（fake_claude.py）をPATHの先頭に置き、
+偽Discordトランスポート（fake_discord.py）へ送信させる。
+
+    python bench/run_bench.py                  # 全ワークロード
+    python bench/run_bench.py burst stream     # 指定したワークロードのみ
+    python bench/run_bench.py burst --jobs 10 --bytes 4096 --json
+
+各ワークロードは独立したプロセスで実行する（ピークRSSを個別に測るため）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, replace
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+sys.path.insert(0, str(BENCH_DIR))
+
+
+@dataclass
+class Workload:
+    name: str
+    description: str
+    jobs: int = 10
+    output_bytes: int = 1024
+    latency: float = 0.1
+    chunks: int = 5
+    interval: float = 0.05
+    exit_code: int = 0
+    channels: int = 1
+    max_workers: int = 2
+    stream_output: bool = True
+    session_reuse: bool = True
+    rate_limit: int = 5
+    rate_per: float = 5.0
+    # 末尾のlight_jobs件は別ユーザーが投入（公平性の確認用）
+    light_jobs: int = 0
+    # Trueなら全件を1回の !dev batch で投入（max_workersはbatch_workersとして使う）
+    batch: bool = False
+    write_lines: int = 0
+    # 作業ディレクトリをrepo_files個のファイルを持つgitリポジトリにする
+    repo_files: int = 0
+    # 偽claudeが最初の編集前にリポジトリを探索する1ターンの秒数
+    explore: float = 0.0
+    context_prefetch: bool = False
+    # 回帰判定の上限（Noneなら判定しない）。超えたら終了コード1
+    max_edits: int = None
+    max_rate_limit_wait: float = None
+
+
+WORKLOADS = {
+    'burst': Workload(
+        'burst', '50件同時のimplement、出力1MB（ファイル添付経路）',
+        jobs=50, output_bytes=1024 * 1024, latency=0.5, channels=50, max_workers=50
+    ),
+    'stream': Workload(
+        'stream', '進捗イベントの多いジョブ（メッセージ編集の集約）',
+        jobs=5, output_bytes=4096, latency=0.0, chunks=200, interval=0.01, channels=5, max_workers=5,
+        max_edits=25, max_rate_limit_wait=60.0
+    ),
+    'inline': Workload(
+        'inline', '分割送信される出力（約9KB）を同じチャンネルへ連続投入（レート制限の影響）',
+        jobs=4, output_bytes=9000, latency=0.05, channels=1, max_workers=2
+    ),
+    'queue': Workload(
+        'queue', '小さなジョブ200件をワーカー4つで処理（キューのオーバーヘッド）',
+        jobs=200, output_bytes=512, latency=0.0, chunks=1, channels=20, max_workers=4,
+        stream_output=False, max_edits=150, max_rate_limit_wait=1200.0
+    ),
+    'fairness': Workload(
+        'fairness', '1人が18件投入した直後に別ユーザーが2件投入（後者の待ち時間）',
+        jobs=20, output_bytes=512, latency=0.3, chunks=1, channels=2, max_workers=2,
+        stream_output=False, rate_limit=0, light_jobs=2
+    ),
+    'batch': Workload(
+        'batch', '16件を1回のbatchで投入（worktreeで並列実行、所要時間がタスク数でなく並列数に比例するか）',
+        jobs=16, output_bytes=512, latency=1.0, chunks=1, channels=1, max_workers=8,
+        stream_output=False, rate_limit=0, batch=True, write_lines=20
+    ),
+    'cold': Workload(
+        'cold', '3000ファイルのリポジトリでimplement（毎回ファイル構成の探索から始まる）',
+        jobs=10, output_bytes=1024, latency=0.1, chunks=3, channels=10, max_workers=2,
+        rate_limit=0, repo_files=3000, explore=0.3
+    ),
+    'context': Workload(
+        'context', 'coldと同じジョブをリポジトリ概要付き（context_prefetch）で実行（概要の作成・取得のコスト）',
+        jobs=10, output_bytes=1024, latency=0.1, chunks=3, channels=10, max_workers=2,
+        rate_limit=0, repo_files=3000, explore=0.3, context_prefetch=True
+    ),
+    'errors': Workload(
+        'errors', '異常終了するジョブ（エラー通知経路）',
+        jobs=20, output_bytes=256, latency=0.0, exit_code=1, channels=20, max_workers=4
+    ),
+}
+
+
+def import_bot():
+    """bot.pyを読み込む"""
+    import bot
+    return bot
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_workload(workload, workdir):
+    bot_module = import_bot()
+    from fake_discord import FakeTransport, FakeContext, FakeAuthor
+
+    # 偽claudeをPATHの先頭に置く
+    bin_dir = workdir / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'claude').symlink_to(BENCH_DIR / 'fake_claude.py')
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ.update({
+        'FAKE_CLAUDE_LATENCY': str(workload.latency),
+        'FAKE_CLAUDE_BYTES': str(workload.output_bytes),
+        'FAKE_CLAUDE_CHUNKS': str(workload.chunks),
+        'FAKE_CLAUDE_INTERVAL': str(workload.interval),
+        'FAKE_CLAUDE_EXIT': str(workload.exit_code),
+        'FAKE_CLAUDE_WRITE': str(workload.write_lines),
+        'FAKE_CLAUDE_EXPLORE': str(workload.explore),
+    })
+
+    # ジョブDB・キャッシュはワークロードごとの一時ディレクトリへ
+    bot_module.DATA_DIR = workdir / 'data'
+    bot_module.DATA_DIR.mkdir()
+    project_dir = workdir / 'project'
+    project_dir.mkdir()
+    for index in range(workload.repo_files):
+        path = project_dir / f"pkg{index % 20}" / f"mod{index % 7}" / f"file{index}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# file {index}\n" * (index % 50 + 1), encoding='utf-8')
+    if workload.batch or workload.repo_files:
+        # バッチはworktreeを作るためgitリポジトリが必要
+        for args in (['init', '-q'], ['add', '-A'],
+                     ['-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                      'commit', '-q', '--allow-empty', '-m', 'init']):
+            subprocess.run(['git', *args], cwd=project_dir, check=True)
+        os.environ.update({'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+                           'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@example.com'})
+
+    config = bot_module.Settings.from_dict({
+        'discord_token': 'bench',
+        'project_dir': str(project_dir),
+        'max_workers': workload.max_workers,
+        'batch_workers': workload.max_workers,
+        'project_concurrency': workload.max_workers,
+        'stream_output': workload.stream_output,
+        'session_reuse': workload.session_reuse,
+        'log_level': 'WARNING',
+        # コミットは計測対象外（worktreeなしの同時実行はauto_commitと併用できない）
+        'auto_commit': False,
+        'auto_push': False,
+        # Bot側のレート制限は計測対象外（fairnessは実行順序のみを見る）
+        'rate_limit_user_per_hour': 0,
+        'rate_limit_channel_per_hour': 0,
+        'context_prefetch': workload.context_prefetch,
+    })
+    bot_module.configure_logging(config)
+
+    transport = FakeTransport(rate_limit=workload.rate_limit, per=workload.rate_per)
+    bot = bot_module.DevBot(config, None)
+    bot.get_channel = transport.get_channel
+    # on_readyの代わり（ログインしないので接続済み扱いにする）
+    bot.services.set_connected(True)
+
+    # 完了したジョブを集める
+    finished = []
+    done = asyncio.Event()
+    execute_job = bot.scheduler.runner
+
+    async def runner(job):
+        try:
+            await execute_job(job)
+        finally:
+            finished.append(job)
+            if len(finished) >= workload.jobs:
+                done.set()
+
+    bot.scheduler.runner = runner
+    await bot.scheduler.start()
+
+    implement = bot.get_command('implement').callback
+    heavy = FakeAuthor(1, 'heavy')
+    light = FakeAuthor(2, 'light')
+    started = time.perf_counter()
+    if workload.batch:
+        await bot.get_command('batch').callback(
+            FakeContext(bot, transport.get_channel(1000), heavy),
+            content='\n'.join(f"- ベンチマーク用の実装依頼 {index}" for index in range(workload.jobs))
+        )
+    else:
+        await asyncio.gather(*(
+            implement(
+                FakeContext(
+                    bot,
+                    transport.get_channel(1000 + index % workload.channels),
+                    light if index >= workload.jobs - workload.light_jobs else heavy
+                ),
+                content=f"ベンチマーク用の実装依頼 {index}"
+            )
+            for index in range(workload.jobs)
+        ))
+    await done.wait()
+    # 最後のジョブのステータス保存・バッチの結果送信を待つ
+    while bot.scheduler.running or bot.services.batches or bot.scheduler.pending_notifications:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    bot.scheduler.store.close()
+
+    latencies = [job.finished_at - job.created_at for job in finished]
+    light_latencies = [job.finished_at - job.created_at for job in finished if job.author_id == light.id]
+    waits = [job.started_at - job.created_at for job in finished]
+    statuses = {}
+    for job in finished:
+        statuses[job.status] = statuses.get(job.status, 0) + 1
+
+    first_edit = bot_module.metrics.get('devbot_stage_seconds', stage='first_edit')
+    context_wait = bot_module.metrics.get('devbot_stage_seconds', stage='context')
+    context_cost = None
+    if workload.context_prefetch:
+        # 作り直しの時間（初回）と、HEADが同じときの取得の時間を新しいRepoContextで測る
+        context = bot_module.RepoContext(max_chars=config.context_max_chars)
+        before = time.perf_counter()
+        summary = await context.get(str(project_dir))
+        built = time.perf_counter()
+        await context.get(str(project_dir))
+        context_cost = {
+            'build': round(built - before, 3),
+            'cached': round(time.perf_counter() - built, 4),
+            'chars': len(summary or ''),
+            # 各ジョブの実行前に概要を待った時間（初回の作成を含む）
+            'wait_mean': round(context_wait['sum'] / context_wait['count'], 4) if context_wait else None,
+        }
+    discord = transport.summary()
+    edits = discord['calls'].get('edit', 0)
+    regressions = []
+    if workload.max_edits is not None and edits > workload.max_edits:
+        regressions.append(f"edit {edits}回 > 上限 {workload.max_edits}回")
+    if workload.max_rate_limit_wait is not None and discord['rate_limit_wait'] > workload.max_rate_limit_wait:
+        regressions.append(
+            f"レート制限待機 {discord['rate_limit_wait']}秒 > 上限 {workload.max_rate_limit_wait}秒"
+        )
+
+    return {
+        'workload': asdict(workload),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(finished) / elapsed, 2) if elapsed else 0.0,
+        'latency_p50': round(percentile(latencies, 0.50), 3),
+        'latency_p99': round(percentile(latencies, 0.99), 3),
+        'queue_wait_p50': round(percentile(waits, 0.50), 3),
+        'queue_wait_p99': round(percentile(waits, 0.99), 3),
+        'light_latency_max': round(max(light_latencies, default=0.0), 3),
+        # Claude起動から最初のファイル編集まで（stream-jsonのときのみ計測される）
+        'first_edit_mean': round(first_edit['sum'] / first_edit['count'], 3) if first_edit else None,
+        # リポジトリ概要のBot側のコスト（偽claudeは概要を読まないため、探索の短縮は含まない）
+        'context': context_cost,
+        'statuses': statuses,
+        # Linuxのru_maxrssはKB単位
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'discord': discord,
+        # 回帰判定の対象（メッセージ編集回数とレート制限の累計待機秒数）
+        'edits': edits,
+        'rate_limit_wait': discord['rate_limit_wait'],
+        'regressions': regressions,
+    }
+
+
+def format_result(result):
+    workload = result['workload']
+    discord = result['discord']
+    calls = ' '.join(f"{kind}={count}" for kind, count in sorted(discord['calls'].items()))
+    return '\n'.join([
+        f"[{workload['name']}] {workload['description']}",
+        f"  ジョブ: {workload['jobs']}件 / 出力 {workload['output_bytes']}B / ワーカー {workload['max_workers']}"
+        f" / 結果 {result['statuses']}",
+        f"  所要時間: {result['elapsed']}秒 / スループット: {result['throughput']} jobs/s",
+        f"  レイテンシ: p50 {result['latency_p50']}秒 / p99 {result['latency_p99']}秒"
+        f"（うち待ち時間 p50 {result['queue_wait_p50']}秒 / p99 {result['queue_wait_p99']}秒）",
+        *([f"  起動から最初の編集まで: 平均 {result['first_edit_mean']}秒"]
+          if result['first_edit_mean'] is not None else []),
+        *([f"  リポジトリ概要: 作成 {result['context']['build']}秒 / 取得 {result['context']['cached']}秒"
+           f" / {result['context']['chars']}文字 / 実行前の待ち 平均 {result['context']['wait_mean']}秒",
+           "  ※ 偽claudeは概要があっても同じだけ探索するため、最初の編集までの短縮は計測していません"]
+          if result.get('context') else []),
+        f"  ピークRSS: {result['peak_rss_mb']}MB",
+        *([f"  後から投入した別ユーザーのレイテンシ: 最大 {result['light_latency_max']}秒"]
+          if workload['light_jobs'] else []),
+        f"  Discord呼び出し: {discord['total_calls']}回 ({calls}) / 送信 {discord['bytes_sent']}B"
+        f" / レート制限 {discord['rate_limited']}回 ({discord['rate_limit_wait']}秒待機)",
+        *([f"  回帰判定: {'NG（' + ' / '.join(result['regressions']) + '）' if result['regressions'] else 'OK'}"
+           f"（edit上限 {workload['max_edits']}回 / 待機上限 {workload['max_rate_limit_wait']}秒）"]
+          if workload['max_edits'] is not None or workload['max_rate_limit_wait'] is not None else []),
+    ])
+
+
+def run_child(name, args):
+    """ワークロードを別プロセスで実行して結果を受け取る"""
+    command = [sys.executable, __file__, name, '--child', '--json']
+    for option in ('jobs', 'bytes', 'workers', 'latency'):
+        value = getattr(args, option)
+        if value is not None:
+            command += [f"--{option}", str(value)]
+    if args.no_rate_limit:
+        command.append('--no-rate-limit')
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} 失敗:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Discord Dev Bot オフラインベンチマーク')
+    parser.add_argument('workloads', nargs='*', help=f"ワークロード名（{', '.join(WORKLOADS)}）")
+    parser.add_argument('--jobs', type=int, help='ジョブ数を上書き')
+    parser.add_argument('--bytes', type=int, help='出力バイト数を上書き')
+    parser.add_argument('--workers', type=int, help='同時実行数を上書き')
+    parser.add_argument('--latency', type=float, help='偽claudeの応答遅延（秒）を上書き')
+    parser.add_argument('--no-rate-limit', action='store_true', help='Discordのレート制限を再現しない')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    names = args.workloads or list(WORKLOADS)
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"不明なワークロード: {', '.join(unknown)}")
+
+    if args.child:
+        workload = WORKLOADS[names[0]]
+        overrides = {
+            'jobs': args.jobs,
+            'output_bytes': args.bytes,
+            'max_workers': args.workers,
+            'latency': args.latency,
+        }
+        overrides = {k: v for k, v in overrides.items() if v is not None}
+        if args.no_rate_limit:
+            overrides['rate_limit'] = 0
+        if overrides:
+            # 上限は既定の条件に対する値なので、条件を変えたときは判定しない
+            overrides.update(max_edits=None, max_rate_limit_wait=None)
+        workload = replace(workload, **overrides)
+        with tempfile.TemporaryDirectory(prefix='devbot-bench-') as workdir:
+            result = asyncio.run(run_workload(workload, Path(workdir)))
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    results = []
+    for name in names:
+        result = run_child(name, args)
+        results.append(result)
+        if not args.json:
+            print(format_result(result))
+            print()
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    if any(result['regressions'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
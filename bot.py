@@ -4,20 +4,42 @@ Windows起動時自動起動・タスクトレイ常駐型Bot
 """
 
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
+import math
 import asyncio
 import os
 import subprocess
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import atexit
+import contextlib
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime, timedelta
 import json
+import random
 from pathlib import Path
 import sys
+import signal
+import codecs
+import time
 import traceback
-import pystray
-from PIL import Image, ImageDraw
+import sqlite3
+try:
+    import resource  # POSIXのみ
+except ImportError:
+    resource = None
+import re
+import gzip
+import zlib
+import hashlib
+import functools
+import tempfile
+import shutil
+from dataclasses import dataclass, field, fields, asdict
+from collections import OrderedDict
 import threading
+import itertools
 
 # ログ設定
 log_dir = Path(__file__).parent / "logs"
@@ -26,23 +48,105 @@ log_dir.mkdir(exist_ok=True)
 logger = logging.getLogger('discord_bot')
 logger.setLevel(logging.INFO)
 
-# ログローテーション（7日分保持）
+# キューに溜められるログ件数と1件あたりの最大文字数（メモリ使用量の上限）
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_MESSAGE = 8000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    ログをキューに積むだけのハンドラ（ファイル書き込みは別スレッド）
+    
+    キューが満杯のときは待たずに捨て、捨てた件数を数える。
+    """
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        record = super().prepare(record)
+        if len(record.msg) > LOG_MAX_MESSAGE:
+            record.msg = record.msg[:LOG_MAX_MESSAGE] + f"...（{len(record.msg)}文字）"
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1レコードのJSON形式"""
+    
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _gzip_rotator(source, dest):
+    """ローテーションしたログをgzip圧縮して保存"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+# ログローテーション（7日分保持、古いログはgzip圧縮）
 handler = RotatingFileHandler(
     log_dir / 'bot.log',
     maxBytes=5*1024*1024,  # 5MB
     backupCount=7,
-    encoding='utf-8'
+    encoding='utf-8',
+    delay=True
 )
-handler.setFormatter(logging.Formatter(
+handler.namer = lambda name: name + '.gz'
+handler.rotator = _gzip_rotator
+# log_jsonをfalseに戻したときにも使うのでモジュールに残す
+TEXT_FORMATTER = logging.Formatter(
     '%(asctime)s [%(levelname)s] %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
-))
-logger.addHandler(handler)
+)
+handler.setFormatter(TEXT_FORMATTER)
 
 # コンソール出力も追加（デバッグ用）
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
-logger.addHandler(console_handler)
+
+# イベントループのスレッドではキューに積むだけにし、書き込みはリスナースレッドで行う
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+logger.addHandler(queue_handler)
+log_listener = QueueListener(log_queue, handler, console_handler, respect_handler_level=True)
+log_listener.start()
+
+
+def stop_log_listener():
+    """残っているログを書き出してリスナースレッドを止める（複数回呼んでもよい）"""
+    if getattr(log_listener, '_thread', None) is not None:
+        log_listener.stop()
+
+
+atexit.register(stop_log_listener)
+
+
+def configure_logging(config):
+    """設定ファイルのログ設定を反映"""
+    logger.setLevel(config.log_level.upper())
+    # 設定の再読み込みでどちらにも切り替えられるよう、常に設定し直す
+    handler.setFormatter(JsonFormatter() if config.log_json else TEXT_FORMATTER)
+
+
+# データ保存先（ジョブキュー等）
+DATA_DIR = Path(__file__).parent / "data"
+DATA_DIR.mkdir(exist_ok=True)
 
 # 設定ファイル
 CONFIG_FILE = Path(__file__).parent / "config.json"
@@ -52,25 +156,293 @@ PROJECT_DIR = Path("")  # Set in config.json
 DEFAULT_CONFIG = {
     "discord_token": "",
     "command_prefix": "!dev ",
+    "prefix_commands": True,
+    "slash_commands": True,
+    "slash_guilds": [],
     "project_dir": str(PROJECT_DIR),
     "auto_reconnect": True,
-    "startup_delay": 30
+    "reconnect_base_delay": 1,
+    "reconnect_max_delay": 300,
+    "crash_window": 600,
+    "crash_budget": 10,
+    "startup_delay": 30,
+    "tray": "auto",
+    "claude_timeout": 300,
+    "claude_output_format": "text",
+    "stream_output": True,
+    "stream_edit_interval": 1.5,
+    "max_workers": 2,
+    "project_concurrency": 1,
+    "claude_resolve_ttl": 3600,
+    "session_reuse": True,
+    "session_idle_ttl": 3600,
+    "max_sessions": 100,
+    "output_inline_limit": 10000,
+    "attachment_limit": 8 * 1024 * 1024,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": 0,
+    "latency_sample_interval": 30,
+    "log_level": "INFO",
+    "log_json": False,
+    "result_cache": True,
+    "result_cache_size": 50 * 1024 * 1024,
+    "config_reload_interval": 2,
+    "rate_limit_user_burst": 3,
+    "rate_limit_user_per_hour": 20,
+    "rate_limit_channel_burst": 6,
+    "rate_limit_channel_per_hour": 40,
+    "rate_limit_action": "defer",
+    "fair_share_half_life": 3600,
+    "user_weights": {},
+    "claude_cpu_limit": 0,
+    "claude_memory_limit": 0,
+    "claude_file_size_limit": 0,
+    "claude_max_processes": 0,
+    "claude_cpu_quota": 0,
+    "cgroups": "auto",
+    "health_check_interval": 300,
+    "health_check_timeout": 10,
+    "health_disk_min_free": 1024,
+    "batch_workers": 0,
+    "batch_max_tasks": 50,
+    "auto_commit": True,
+    "auto_push": False,
+    "git_remote": "origin",
+    "push_window": 10,
+    "git_push_timeout": 120,
+    "context_prefetch": False,
+    "context_max_chars": 6000,
+    "context_refresh_interval": 30,
+    "restart_method": "auto",
+    "drain_timeout": 300
 }
 
 
+class ConfigError(ValueError):
+    """config.jsonの値が不正"""
+
+
+@dataclass(slots=True, frozen=True)
+class Settings:
+    """
+    検証済みの設定（DEFAULT_CONFIG＋config.json）
+    
+    作成後は変更しない。ホットリロード時は新しいインスタンスに丸ごと差し替えるため、
+    読む側は常に一貫した設定を見る。
+    """
+    discord_token: str
+    command_prefix: str
+    prefix_commands: bool
+    slash_commands: bool
+    slash_guilds: list
+    project_dir: str
+    auto_reconnect: bool
+    reconnect_base_delay: float
+    reconnect_max_delay: float
+    crash_window: float
+    crash_budget: int
+    startup_delay: float
+    tray: object
+    claude_timeout: float
+    claude_output_format: str
+    stream_output: bool
+    stream_edit_interval: float
+    max_workers: int
+    project_concurrency: int
+    claude_resolve_ttl: float
+    session_reuse: bool
+    session_idle_ttl: float
+    max_sessions: int
+    output_inline_limit: int
+    attachment_limit: int
+    metrics_host: str
+    metrics_port: int
+    latency_sample_interval: float
+    log_level: str
+    log_json: bool
+    result_cache: bool
+    result_cache_size: int
+    config_reload_interval: float
+    rate_limit_user_burst: int
+    rate_limit_user_per_hour: float
+    rate_limit_channel_burst: int
+    rate_limit_channel_per_hour: float
+    rate_limit_action: str
+    fair_share_half_life: float
+    user_weights: dict
+    claude_cpu_limit: int
+    claude_memory_limit: int
+    claude_file_size_limit: int
+    claude_max_processes: int
+    claude_cpu_quota: float
+    cgroups: object
+    health_check_interval: float
+    health_check_timeout: float
+    health_disk_min_free: int
+    batch_workers: int
+    batch_max_tasks: int
+    auto_commit: bool
+    auto_push: bool
+    git_remote: str
+    push_window: float
+    git_push_timeout: float
+    context_prefetch: bool
+    context_max_chars: int
+    context_refresh_interval: float
+    restart_method: str
+    drain_timeout: float
+    projects: dict = field(default_factory=dict)
+    
+    # 下限値（これ未満はエラー）
+    MINIMUMS = {
+        'reconnect_base_delay': 0.1, 'reconnect_max_delay': 1, 'crash_window': 1, 'crash_budget': 1,
+        'startup_delay': 0, 'claude_timeout': 1, 'stream_edit_interval': 0.2, 'max_workers': 1,
+        'project_concurrency': 1, 'claude_resolve_ttl': 0, 'session_idle_ttl': 1, 'max_sessions': 1,
+        'output_inline_limit': 1, 'attachment_limit': 1024, 'metrics_port': 0,
+        'latency_sample_interval': 1, 'result_cache_size': 0, 'config_reload_interval': 0,
+        'rate_limit_user_burst': 1, 'rate_limit_user_per_hour': 0, 'rate_limit_channel_burst': 1,
+        'rate_limit_channel_per_hour': 0, 'fair_share_half_life': 1, 'claude_cpu_limit': 0,
+        'claude_memory_limit': 0, 'claude_file_size_limit': 0, 'claude_max_processes': 0,
+        'claude_cpu_quota': 0, 'health_check_interval': 10, 'health_check_timeout': 1,
+        'health_disk_min_free': 0, 'batch_workers': 0, 'batch_max_tasks': 1, 'push_window': 0,
+        'git_push_timeout': 1, 'context_max_chars': 500, 'context_refresh_interval': 0,
+        'drain_timeout': 0,
+    }
+    LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+    OUTPUT_FORMATS = ('text', 'json', 'stream-json')
+    RESTART_METHODS = ('auto', 'exec', 'exit')
+    # 実行中に変更しても再起動まで反映されない項目
+    RESTART_REQUIRED = ('discord_token', 'metrics_host', 'metrics_port', 'tray', 'startup_delay', 'cgroups',
+                        'prefix_commands', 'slash_commands', 'slash_guilds')
+    
+    @classmethod
+    def from_dict(cls, raw):
+        """辞書を検証してSettingsを作る（不正な値はまとめてConfigError）"""
+        if not isinstance(raw, dict):
+            raise ConfigError("設定はJSONオブジェクトである必要があります")
+        values = {**DEFAULT_CONFIG, **raw}
+        errors = []
+        kwargs = {}
+        for f in fields(cls):
+            if f.name not in values:
+                continue
+            try:
+                kwargs[f.name] = cls._check(f.name, f.type, values[f.name])
+            except ConfigError as e:
+                errors.append(str(e))
+        unknown = sorted(set(values) - set(kwargs) - {f.name for f in fields(cls)})
+        if unknown:
+            logger.warning(f"未知の設定項目を無視します: {', '.join(unknown)}")
+        if not errors and not (kwargs['prefix_commands'] or kwargs['slash_commands']):
+            errors.append("prefix_commands / slash_commands: 少なくとも一方をtrueにしてください")
+        if not errors and kwargs['auto_commit']:
+            errors += cls._shared_tree_errors(kwargs)
+        if errors:
+            raise ConfigError('\n'.join(errors))
+        return cls(**kwargs)
+    
+    @classmethod
+    def _check(cls, name, expected, value):
+        if name in ('tray', 'cgroups'):
+            if value != 'auto' and not isinstance(value, bool):
+                raise ConfigError(f'{name}: true / false / "auto" のいずれかを指定してください')
+            return value
+        if name == 'projects':
+            return cls._check_projects(value)
+        if expected is bool:
+            ok = isinstance(value, bool)
+        elif expected is int:
+            ok = isinstance(value, int) and not isinstance(value, bool)
+        elif expected is float:
+            ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+            value = float(value) if ok else value
+        else:
+            ok = isinstance(value, expected)
+        if not ok:
+            raise ConfigError(f"{name}: {expected.__name__}型が必要です（{value!r}）")
+        minimum = cls.MINIMUMS.get(name)
+        if minimum is not None and value < minimum:
+            raise ConfigError(f"{name}: {minimum}以上を指定してください（{value!r}）")
+        if name == 'log_level' and value.upper() not in cls.LOG_LEVELS:
+            raise ConfigError(f"log_level: {' / '.join(cls.LOG_LEVELS)} のいずれかを指定してください")
+        if name == 'claude_output_format' and value not in cls.OUTPUT_FORMATS:
+            raise ConfigError(f"claude_output_format: {' / '.join(cls.OUTPUT_FORMATS)} のいずれかを指定してください")
+        if name == 'restart_method' and value not in cls.RESTART_METHODS:
+            raise ConfigError(f"restart_method: {' / '.join(cls.RESTART_METHODS)} のいずれかを指定してください")
+        if name == 'rate_limit_action' and value not in ('defer', 'reject'):
+            raise ConfigError('rate_limit_action: "defer" / "reject" のいずれかを指定してください')
+        if name == 'slash_guilds':
+            if not all(str(guild_id).isdigit() for guild_id in value):
+                raise ConfigError(f"slash_guilds: サーバーIDの配列が必要です（{value!r}）")
+            return [int(guild_id) for guild_id in value]
+        if name == 'user_weights':
+            for user_id, weight in value.items():
+                if not str(user_id).isdigit() or isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+                    raise ConfigError(f"user_weights: ユーザーID→正の数値が必要です（{user_id!r}: {weight!r}）")
+        return value
+    
+    @staticmethod
+    def _shared_tree_errors(values):
+        """
+        auto_commitは作業ツリーの変更をすべてコミットするため、worktreeを使わない
+        プロジェクトで同時に実行すると他のジョブの途中の変更まで混ざる。その組み合わせを拒否する
+        """
+        errors = []
+        hint = "（auto_commitが有効な場合、worktreesを使わないプロジェクトは同時実行できません）"
+        if values['project_dir'] and values['project_concurrency'] > 1:
+            errors.append(f"project_concurrency: 1を指定してください{hint}")
+        for name, entry in values.get('projects', {}).items():
+            if not entry.get('worktrees', False) and entry.get('concurrency', values['project_concurrency']) > 1:
+                errors.append(f"projects.{name}.concurrency: 1を指定するかworktreesを有効にしてください{hint}")
+        return errors
+    
+    @staticmethod
+    def _check_projects(value):
+        if not isinstance(value, dict):
+            raise ConfigError("projects: プロジェクト名→設定のオブジェクトが必要です")
+        projects = {}
+        for name, entry in value.items():
+            if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+                raise ConfigError(f"projects.{name}: path（文字列）が必要です")
+            try:
+                channels = [int(c) for c in entry.get('channels', [])]
+            except (TypeError, ValueError):
+                raise ConfigError(f"projects.{name}.channels: チャンネルIDの配列が必要です")
+            concurrency = entry.get('concurrency')
+            if concurrency is not None and (isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1):
+                raise ConfigError(f"projects.{name}.concurrency: 1以上の整数が必要です")
+            if not isinstance(entry.get('worktrees', False), bool):
+                raise ConfigError(f"projects.{name}.worktrees: true / false が必要です")
+            projects[name] = {**entry, 'channels': channels}
+        return projects
+    
+    @property
+    def batch_concurrency(self):
+        """バッチの同時実行数（0ならCPUコア数）"""
+        return self.batch_workers or os.cpu_count() or 1
+    
+    def to_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+    
+    def changed_fields(self, other):
+        """otherと値が異なる項目名"""
+        return [f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name)]
+
+
 class Config:
     """設定管理クラス"""
     
     @staticmethod
     def load():
+        """config.jsonを読み込んで検証（無ければデフォルト値で作成）"""
         if CONFIG_FILE.exists():
             with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
                 config = json.load(f)
-                # デフォルト値とマージ
-                return {**DEFAULT_CONFIG, **config}
+                # デフォルト値とマージして検証
+                return Settings.from_dict(config)
         else:
             Config.save(DEFAULT_CONFIG)
-            return DEFAULT_CONFIG.copy()
+            return Settings.from_dict(DEFAULT_CONFIG)
     
     @staticmethod
     def save(config):
@@ -78,113 +450,4117 @@ class Config:
             json.dump(config, f, indent=2, ensure_ascii=False)
 
 
-class DevBot(commands.Bot):
-    """開発支援Discord Bot"""
+class ConfigWatcher:
+    """
+    config.jsonの変更を監視し、検証を通った設定をon_changeへ渡す
     
-    def __init__(self, config, tray_icon):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        
-        super().__init__(
-            command_prefix=config['command_prefix'],
-            intents=intents
+    interval秒ごとにmtimeとサイズを確認する（追加の依存なしで全OSで動く）。
+    書き込み途中・不正な内容なら現在の設定を維持し、次の変更を待つ。
+    """
+    
+    def __init__(self, path, on_change, *, interval=2.0):
+        self.path = Path(path)
+        self.on_change = on_change
+        self.interval = interval
+        self.last_error = None
+        self.last_reload = None
+        self._signature = self._stat()
+    
+    def _stat(self):
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+    
+    async def run(self):
+        while self.interval > 0:
+            await asyncio.sleep(self.interval)
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            await self.reload()
+    
+    async def reload(self):
+        """config.jsonを読み直して適用。適用した設定（失敗時はNone）を返す"""
+        try:
+            settings = await asyncio.to_thread(Config.load)
+        except (OSError, json.JSONDecodeError, ConfigError) as e:
+            self.last_error = str(e)
+            logger.error(f"config.jsonの再読み込み失敗（現在の設定を維持）: {e}")
+            return None
+        self.last_error = None
+        self.last_reload = datetime.now()
+        await self.on_change(settings)
+        return settings
+
+
+@dataclass
+class ProcessResult:
+    """子プロセスの実行結果"""
+    returncode: int
+    stdout: str
+    stderr: str
+    duration: float
+    spawn_time: float = 0.0  # 起動開始からプロセス生成まで（秒）
+    first_byte_time: float = None  # 起動開始から最初のstdout受信まで（秒）
+    stats: 'ProcessStats' = None  # limitsを渡した場合の資源使用量
+
+
+async def kill_process_tree(proc):
+    """子プロセスとその子孫をまとめて強制終了"""
+    if proc.returncode is not None:
+        return
+    try:
+        if sys.platform == 'win32':
+            # taskkill /T でプロセスツリーごと終了
+            killer = await asyncio.create_subprocess_exec(
+                'taskkill', '/F', '/T', '/PID', str(proc.pid),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            await killer.wait()
+        else:
+            # start_new_session=True で起動しているのでPID=プロセスグループID
+            os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        return
+    except OSError as e:
+        logger.warning(f"プロセスツリー終了失敗、単体killにフォールバック: {e}")
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+# npmのcmd-shimが起動するスクリプト（"%dp0%\node_modules\...\cli.js" %*）
+NPM_SHIM_PATTERN = re.compile(r'"%~?dp0%?\\([^"]+)"\s+%\*')
+
+
+@functools.lru_cache(maxsize=32)
+def _npm_shim_target(path, mtime):
+    """npmが生成した.cmdならnodeとスクリプトのargv（それ以外はNone）。mtimeはキャッシュの無効化用"""
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            match = NPM_SHIM_PATTERN.search(f.read())
+    except OSError:
+        match = None
+    if match is None:
+        # キャッシュされるので警告はファイルごとに1回
+        logger.warning(f"{path} はcmd.exe経由で起動されます（引数の改行・%が正しく渡らない場合があります）")
+        return None
+    base = os.path.dirname(path)
+    script = os.path.join(base, *match.group(1).split('\\'))
+    # シムと同じ場所のnode.exeを優先（npmのシムと同じ順序）
+    node = os.path.join(base, 'node.exe')
+    if not os.path.exists(node):
+        node = shutil.which('node')
+    if node is None or not os.path.exists(script):
+        return None
+    return (node, script)
+
+
+def platform_argv(argv):
+    """
+    execするargv（シェルを介さず1プロセスで起動する）
+    
+    POSIXはそのまま。Windowsの.cmd/.batはCreateProcessが暗黙にcmd.exeを挟み、
+    引数がcmdの構文で解釈される（改行で切れる・%が展開される）ため、
+    npmのシムならnodeとスクリプトを直接起動する
+    """
+    if sys.platform != 'win32' or not argv[0].lower().endswith(('.cmd', '.bat')):
+        return argv
+    try:
+        target = _npm_shim_target(argv[0], os.stat(argv[0]).st_mtime)
+    except OSError:
+        target = None
+    if target is None:
+        return argv
+    return [*target, *argv[1:]]
+
+
+def open_path(path):
+    """ファイルを既定のアプリで開く（トレイのログ表示）"""
+    if sys.platform == 'win32':
+        os.startfile(path)
+    elif sys.platform == 'darwin':
+        subprocess.Popen(['open', str(path)])
+    else:
+        subprocess.Popen(['xdg-open', str(path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# restart_method: "exit" で終了するときの終了コード（EX_TEMPFAIL）
+RESTART_EXIT_CODE = 75
+
+
+def resolve_restart_method(config):
+    """
+    再起動の方法（config["restart_method"]）
+    
+    exec: 同じプロセスを起動し直す / exit: 終了コード75で終了し、systemd等に起動し直させる。
+    autoはsystemdのサービスとして動いていればexit、それ以外はexec
+    """
+    if config.restart_method != 'auto':
+        return config.restart_method
+    return 'exit' if os.environ.get('INVOCATION_ID') else 'exec'
+
+
+def relaunch():
+    """同じPython・同じ引数でBotを起動し直す（イベントループ終了後に呼ぶ）"""
+    argv = [sys.executable, os.path.abspath(sys.argv[0]), *sys.argv[1:]]
+    logger.info("Botを再起動します")
+    stop_log_listener()
+    if sys.platform == 'win32':
+        # Windowsのexecvは新しいプロセスを起動して終了するだけなので、コンソールから切り離して起動
+        subprocess.Popen(
+            argv,
+            creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
+            close_fds=True
         )
-        
-        self.config = config
-        self.tray_icon = tray_icon
-        self.start_time = datetime.now()
-        self.is_shutting_down = False
-        
-        # コマンド登録
-        self.add_commands()
-        
-        logger.info("Bot初期化完了")
+        return
+    # 開いているファイル・ソケットは継承されない（Pythonの既定でclose-on-exec）
+    os.execv(sys.executable, argv)
+
+
+def pause_before_exit():
+    """ダブルクリック起動でエラー内容を読めるよう、コンソールがあるときだけ入力を待つ"""
+    if sys.stdin is not None and sys.stdin.isatty():
+        input("Enterキーで終了...")
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """Claude子プロセスに掛ける資源制限（0は無制限）"""
+    cpu_seconds: int = 0
+    memory_mb: int = 0
+    file_size_mb: int = 0
+    max_processes: int = 0
+    cpu_quota: float = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            cpu_seconds=config.claude_cpu_limit,
+            memory_mb=config.claude_memory_limit,
+            file_size_mb=config.claude_file_size_limit,
+            max_processes=config.claude_max_processes,
+            cpu_quota=config.claude_cpu_quota,
+        )
+
+    def __bool__(self):
+        return any((self.cpu_seconds, self.memory_mb, self.file_size_mb, self.max_processes, self.cpu_quota))
+
+    def wrap(self, argv):
+        """
+        起動したシェルがexec前にulimitで制限を掛けるコマンドにする（POSIXのみ。制限がなければそのまま）
+
+        起動後にprlimitで掛ける方式だと掛けるまでの間は制限なしで動き、その間に生まれた
+        子孫にも継承されないため。preexec_fnはスレッドのあるプロセスでは安全でないので使わない。
+        rlimitはプロセス単位（ツリー全体ではない）で子孫に継承される。メモリはRLIMIT_DATA
+        （Node.jsは仮想アドレスを大きく予約するためRLIMIT_ASは使わない）。
+        プロセス数はユーザー単位のRLIMIT_NPROCでは絞れないためcgroup使用時のみ有効。
+        現在のハード上限を超える値は切り詰め、設定できなければ起動せずに失敗する
+        """
+        if resource is None:
+            return argv
+        mb = 1024 * 1024
+        commands = []
+        # ulimitの単位: -t は秒、-d はKB、-f は512バイト（POSIX）
+        for name, option, unit, value, grace in (
+            # CPUは上限でSIGXCPU、猶予5秒を過ぎるとSIGKILL
+            ('RLIMIT_CPU', 't', 1, self.cpu_seconds, 5),
+            ('RLIMIT_DATA', 'd', 1024, self.memory_mb * mb, 0),
+            ('RLIMIT_FSIZE', 'f', 512, self.file_size_mb * mb, 0),
+        ):
+            if not value:
+                continue
+            current = resource.getrlimit(getattr(resource, name))[1]
+            soft, hard = value, value + grace
+            if current != resource.RLIM_INFINITY and hard > current:
+                logger.warning(f"{name}は現在のハード上限 {current} までしか設定できません（指定 {value}）")
+                soft, hard = min(soft, current), current
+            # ソフト上限を先に下げる（ハード上限を現在のソフト上限より下げるとEINVAL）
+            commands.append(f"ulimit -S -{option} {soft // unit} && ulimit -H -{option} {hard // unit}")
+        if not commands:
+            return argv
+        script = ' && '.join(commands) + ' && exec "$@"'
+        return ['/bin/sh', '-c', script, 'devbot-rlimit', *argv]
+
+
+@dataclass
+class ProcessStats:
+    """子プロセスツリー全体の資源使用量"""
+    cpu_seconds: float = 0.0
+    max_rss: int = 0  # バイト（ツリー全体の同時使用量の最大値）
+    read_bytes: int = 0
+    write_bytes: int = 0
+    source: str = 'proc'  # 'cgroup' / 'proc' / 'none'
+
+    def summary(self):
+        if self.source == 'none':
+            return '計測なし'
+        mb = 1024 * 1024
+        return (f"CPU {self.cpu_seconds:.1f}s / 最大RSS {self.max_rss / mb:.0f}MB"
+                f" / I/O 読込{self.read_bytes / mb:.1f}MB 書込{self.write_bytes / mb:.1f}MB")
+
+
+class ProcessTreeMonitor:
+    """
+    /procを定期的に走査し、セッション（=起動時のプロセスグループ）配下の使用量を集計
+
+    CPU時間は各プロセスの最後に見えた値の合計。走査間隔（1秒）より短命な
+    子孫は数えられないため、正確な値が必要ならcgroup v2を使う
+    """
+
+    INTERVAL = 1.0
+
+    def __init__(self, leader):
+        self.leader = leader
+        self.enabled = os.path.isdir('/proc/self')
+        self._cpu = {}
+        self._io = {}
+        self.max_rss = 0
+        self._ticks = os.sysconf('SC_CLK_TCK') if self.enabled else 100
+        self._page = os.sysconf('SC_PAGE_SIZE') if self.enabled else 4096
+
+    def members(self):
+        """リーダーと同じセッションに属するPID一覧"""
+        pids = []
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry.name}/stat", 'rb') as f:
+                    stat = f.read().rsplit(b')', 1)[1].split()
+            except OSError:
+                continue
+            # ')'以降: state ppid pgrp session ...
+            if int(stat[3]) == self.leader:
+                pids.append((int(entry.name), stat))
+        return pids
+
+    def sample(self):
+        if not self.enabled:
+            return
+        rss = 0
+        for pid, stat in self.members():
+            # utime stime は ')' 以降の12・13番目、rssは22番目
+            self._cpu[pid] = (int(stat[11]) + int(stat[12])) / self._ticks
+            rss += int(stat[21]) * self._page
+            try:
+                with open(f"/proc/{pid}/io") as f:
+                    io = dict(line.split(': ') for line in f.read().splitlines())
+                self._io[pid] = (int(io['read_bytes']), int(io['write_bytes']))
+            except (OSError, KeyError, ValueError):
+                pass
+        self.max_rss = max(self.max_rss, rss)
+
+    async def run(self):
+        while True:
+            await asyncio.to_thread(self.sample)
+            await asyncio.sleep(self.INTERVAL)
+
+    def stats(self):
+        if not self.enabled:
+            return ProcessStats(source='none')
+        return ProcessStats(
+            cpu_seconds=sum(self._cpu.values()),
+            max_rss=self.max_rss,
+            read_bytes=sum(read for read, _ in self._io.values()),
+            write_bytes=sum(write for _, write in self._io.values()),
+        )
+
+    def kill_leftovers(self):
+        """リーダー終了後も残った子孫（デーモン化したものを含む）を終了"""
+        if not self.enabled:
+            return
+        for pid, _ in self.members():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class CgroupManager:
+    """
+    cgroup v2でジョブごとの資源制限と計測を行う（Linuxのみ）
+
+    Botが属するcgroupの下に devbot-main（Bot自身）と devbot-jobs/job-N
+    （Claude子プロセス）を作る。cgroup v2は制御器を有効にしたcgroupに
+    プロセスを置けないため、Bot自身を葉に移してから委譲する。
+    systemdの Delegate=yes などで書き込み権限がある場合に使える
+    """
+
+    ROOT = Path('/sys/fs/cgroup')
+    CONTROLLERS = ('memory', 'cpu', 'pids')
+
+    def __init__(self, base, controllers):
+        self.base = base
+        self.controllers = controllers
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def create(cls, root=None):
+        """使えればインスタンス、使えなければNone（rlimitにフォールバック）"""
+        root = root or cls.ROOT
+        if not sys.platform.startswith('linux') or not (root / 'cgroup.controllers').exists():
+            return None
+        try:
+            with open('/proc/self/cgroup') as f:
+                relative = next(line[3:].strip() for line in f if line.startswith('0::'))
+            own = root / relative.lstrip('/')
+            available = set((own / 'cgroup.controllers').read_text().split())
+            controllers = [name for name in cls.CONTROLLERS if name in available]
+            main = own / 'devbot-main'
+            main.mkdir(exist_ok=True)
+            (main / 'cgroup.procs').write_text(str(os.getpid()))
+            base = own / 'devbot-jobs'
+            base.mkdir(exist_ok=True)
+            for path in (own, base):
+                for name in controllers:
+                    (path / 'cgroup.subtree_control').write_text(f"+{name}")
+        except (OSError, StopIteration) as e:
+            logger.info(f"cgroup v2は使用しません（rlimitで制限）: {e}")
+            return None
+        logger.info(f"cgroup v2で子プロセスを管理: {base} ({', '.join(controllers) or '計測のみ'})")
+        return cls(base, controllers)
+
+    def job(self, limits):
+        """実行1回分のcgroupを作成して制限を書き込む"""
+        path = self.base / f"run-{os.getpid()}-{next(self._ids)}"
+        path.mkdir(exist_ok=True)
+        values = {}
+        if 'memory' in self.controllers:
+            values['memory.max'] = str(limits.memory_mb * 1024 * 1024) if limits.memory_mb else 'max'
+        if 'cpu' in self.controllers:
+            period = 100000
+            values['cpu.max'] = f"{int(limits.cpu_quota * period)} {period}" if limits.cpu_quota else f"max {period}"
+        if 'pids' in self.controllers:
+            values['pids.max'] = str(limits.max_processes) if limits.max_processes else 'max'
+        for filename, value in values.items():
+            (path / filename).write_text(value)
+        return JobCgroup(path)
+
+
+class JobCgroup:
+    """1ジョブ分のcgroup"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def wrap(self, argv):
+        """
+        起動したプロセス自身がexec前にcgroupへ入るコマンドにする
+
+        起動後にPIDを書き込む方式だと、書き込むまでに生まれた子孫が漏れるため
+        """
+        script = '{ echo $$ > "$0"; } 2>/dev/null; exec "$@"'
+        return ['/bin/sh', '-c', script, str(self.path / 'cgroup.procs'), *argv]
+
+    def pids(self):
+        try:
+            return [int(pid) for pid in (self.path / 'cgroup.procs').read_text().split()]
+        except OSError:
+            return []
+
+    def kill(self):
+        """cgroup内の全プロセスを終了（cgroup.killはLinux 5.14以降）"""
+        try:
+            (self.path / 'cgroup.kill').write_text('1')
+            return
+        except OSError:
+            pass
+        for pid in self.pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _read(self, filename):
+        try:
+            return (self.path / filename).read_text()
+        except OSError:
+            return ''
+
+    def stats(self, fallback):
+        """cgroupの集計値で上書きした使用量（I/Oはio制御器がなければ/procの値）"""
+        stats = ProcessStats(**{f.name: getattr(fallback, f.name) for f in fields(ProcessStats)})
+        cpu = dict(line.split() for line in self._read('cpu.stat').splitlines() if line)
+        if 'usage_usec' in cpu:
+            stats.cpu_seconds = int(cpu['usage_usec']) / 1e6
+            stats.source = 'cgroup'
+        peak = self._read('memory.peak').strip()
+        if peak.isdigit():
+            stats.max_rss = max(stats.max_rss, int(peak))
+        io = self._read('io.stat')
+        if io:
+            read = write = 0
+            for line in io.splitlines():
+                values = dict(item.split('=') for item in line.split()[1:])
+                read += int(values.get('rbytes', 0))
+                write += int(values.get('wbytes', 0))
+            stats.read_bytes, stats.write_bytes = read, write
+        return stats
+
+    async def remove(self):
+        """プロセスが消えるのを待ってcgroupを削除"""
+        for _ in range(50):
+            try:
+                self.path.rmdir()
+                return
+            except OSError:
+                self.kill()
+                await asyncio.sleep(0.1)
+        logger.warning(f"cgroupを削除できませんでした: {self.path}")
+
+
+async def _pump_stream(stream, chunks, callback, marks=None):
+    """パイプを逐次読み取り、行単位でコールバックへ渡す"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # 改行が来るまでの断片（長い1行を読むたびに先頭から連結・分割し直さない）
+    pending = []
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        if marks is not None and 'first_byte' not in marks:
+            marks['first_byte'] = time.monotonic()
+        text = decoder.decode(data)
+        chunks.append(text)
+        if callback is None:
+            continue
+        if '\n' not in text:
+            pending.append(text)
+            continue
+        head, *lines, rest = text.split('\n')
+        pending.append(head)
+        await callback(''.join(pending))
+        for line in lines:
+            await callback(line)
+        pending = [rest]
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        chunks.append(tail)
+        pending.append(tail)
+    if callback is not None and any(pending):
+        await callback(''.join(pending))
+
+
+async def run_process(argv, *, cwd=None, timeout=None, on_stdout=None, on_stderr=None,
+                      limits=None, cgroups=None, on_stats=None, env=None):
+    """
+    子プロセスをasyncioネイティブに実行
+
+    stdout/stderrは逐次読み取り、on_stdout/on_stderr（async関数）に1行ずつ渡す。
+    タイムアウト時・キャンセル時はプロセスツリーごと終了させる。
+    タイムアウト時は asyncio.TimeoutError を送出。
+
+    limits（ResourceLimits）を渡すと資源制限を掛けてツリー全体の使用量を計測し、
+    終了時（例外時も）にon_stats(ProcessStats)を呼ぶ。cgroupsがあればcgroup v2、
+    なければrlimitで制限する。リーダー終了後に残った子孫は終了させる。
+    envは現在の環境変数に上書きする分だけを渡す
+    """
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    cgroup = monitor = sampler = None
+    stats = None
+    if limits is not None and cgroups is not None and sys.platform != 'win32':
+        try:
+            cgroup = cgroups.job(limits)
+            argv = cgroup.wrap(argv)
+        except OSError as e:
+            logger.warning(f"cgroupの作成に失敗、rlimitで制限: {e}")
+            cgroup = None
+    if limits is not None and cgroup is None and sys.platform != 'win32':
+        # exec前に子プロセス側で掛ける（制限のない時間を作らない）
+        argv = limits.wrap(argv)
+
+    started = time.monotonic()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *platform_argv(argv),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            env={**os.environ, **env} if env else None,
+            **kwargs
+        )
+    except BaseException:
+        # 起動できなかった場合も作成済みのcgroupを残さない
+        if cgroup is not None:
+            await cgroup.remove()
+        raise
+    spawned = time.monotonic()
+
+    if limits is not None and sys.platform != 'win32':
+        monitor = ProcessTreeMonitor(proc.pid)
+        sampler = asyncio.create_task(monitor.run())
+
+    stdout_chunks = []
+    stderr_chunks = []
+    marks = {}
+    waiter = asyncio.gather(
+        _pump_stream(proc.stdout, stdout_chunks, on_stdout, marks),
+        _pump_stream(proc.stderr, stderr_chunks, on_stderr),
+        proc.wait()
+    )
+    # キャンセル時に読み取りの中断が「未取得の例外」として記録されないようにする
+    waiter.add_done_callback(lambda future: future.cancelled() or future.exception())
+    try:
+        await asyncio.wait_for(waiter, timeout=timeout)
+    except BaseException:
+        # タイムアウト・キャンセル・コールバック例外のいずれでも子孫を残さない
+        await kill_process_tree(proc)
+        await proc.wait()
+        raise
+    finally:
+        if monitor is not None:
+            sampler.cancel()
+            stats = monitor.stats()
+            monitor.kill_leftovers()
+            if cgroup is not None:
+                stats = cgroup.stats(stats)
+                cgroup.kill()
+                await cgroup.remove()
+            if on_stats is not None:
+                on_stats(stats)
+
+    return ProcessResult(
+        returncode=proc.returncode,
+        stdout=''.join(stdout_chunks),
+        stderr=''.join(stderr_chunks),
+        duration=time.monotonic() - started,
+        spawn_time=spawned - started,
+        first_byte_time=marks['first_byte'] - started if 'first_byte' in marks else None,
+        stats=stats
+    )
+
+
+class Metrics:
+    """
+    カウンタ・ゲージ・ヒストグラムを保持し、Prometheusのテキスト形式で出力する
     
-    def add_commands(self):
-        """コマンド登録"""
+    すべてイベントループ上から更新する前提（ロックなし）
+    """
+    
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    SIZE_BUCKETS = (100, 1000, 4000, 10000, 100000, 1000000, 10000000)
+    MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+    
+    def __init__(self):
+        self._meta = {}
+        self._values = {}
+    
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._values[key] = self._values.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        self._values[(name, tuple(sorted(labels.items())))] = value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self._values.get(key)
+        if hist is None:
+            buckets = self._meta.get(name, (None, None, None))[2] or self.LATENCY_BUCKETS
+            hist = self._values[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(hist['buckets']):
+            if value <= bound:
+                hist['counts'][i] += 1
+                break
+        hist['sum'] += value
+        hist['count'] += 1
+    
+    def get(self, name, **labels):
+        return self._values.get((name, tuple(sorted(labels.items()))))
+    
+    def series(self, name):
+        """指定メトリクスの (ラベル辞書, 値) 一覧"""
+        return [(dict(labels), value) for (n, labels), value in self._values.items() if n == name]
+    
+    @staticmethod
+    def quantile(hist, q):
+        """ヒストグラムのバケットから分位点を線形補間で推定"""
+        if not hist or not hist['count']:
+            return None
+        target = q * hist['count']
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(hist['buckets'], hist['counts']):
+            if count and seen + count >= target:
+                return lower + (bound - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return hist['buckets'][-1]
+    
+    def render(self):
+        """Prometheusテキスト形式"""
+        lines = []
+        names = sorted({name for name, _ in self._values})
+        for name in names:
+            kind, help_text, _ = self._meta.get(name, ('untyped', '', None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in self.series(name):
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(value['buckets'], value['counts']):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels({**labels, 'le': bound})} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels({**labels, 'le': '+Inf'})} {value['count']}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value['sum']}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        body = ','.join(f'{k}="{str(v)}"' for k, v in labels.items())
+        return '{' + body + '}'
+
+
+metrics = Metrics()
+metrics.describe('devbot_stage_seconds', 'histogram', 'implementの段階ごとの所要時間')
+metrics.describe('devbot_claude_runs_total', 'counter', 'Claude実行回数（終了コード別）')
+metrics.describe('devbot_claude_timeouts_total', 'counter', 'Claude実行のタイムアウト回数')
+metrics.describe('devbot_output_chars', 'histogram', 'Claude出力の文字数', Metrics.SIZE_BUCKETS)
+metrics.describe('devbot_jobs_total', 'counter', '終了したジョブ数（状態別）')
+metrics.describe('devbot_queue_depth', 'gauge', '待ちジョブ数')
+metrics.describe('devbot_running_jobs', 'gauge', '実行中ジョブ数')
+metrics.describe('devbot_gateway_latency_seconds', 'histogram', 'Discordゲートウェイのレイテンシ')
+metrics.describe('devbot_gateway_latency_last_seconds', 'gauge', '直近のゲートウェイレイテンシ')
+metrics.describe('devbot_log_dropped_total', 'counter', 'キュー満杯で破棄したログ件数')
+metrics.describe('devbot_connected', 'gauge', 'Discordに接続中なら1')
+metrics.describe('devbot_reconnects_total', 'counter', 'クライアントを作り直して再接続した回数（理由別）')
+metrics.describe('devbot_reconnect_delay_seconds', 'gauge', '直近の再接続までの待機時間')
+metrics.describe('devbot_crash_budget_remaining', 'gauge', 'クラッシュ予算の残り回数')
+metrics.describe('devbot_gateway_disconnects_total', 'counter', 'ゲートウェイの切断回数')
+metrics.describe('devbot_gateway_resumes_total', 'counter', 'ゲートウェイセッションの再開回数')
+metrics.describe('devbot_rate_limited_total', 'counter', 'レート制限に掛かったコマンド数（範囲・対応別）')
+metrics.describe('devbot_result_cache_total', 'counter', 'askの結果キャッシュ参照回数（hit/miss/bypass）')
+metrics.describe('devbot_claude_cpu_seconds', 'histogram', 'Claude実行1回のCPU時間（子孫を含む）',
+                 Metrics.LATENCY_BUCKETS)
+metrics.describe('devbot_claude_max_rss_bytes', 'histogram', 'Claude実行1回の最大RSS（子孫の合計）',
+                 Metrics.MEMORY_BUCKETS)
+metrics.describe('devbot_claude_io_bytes_total', 'counter', 'Claude子プロセスのディスクI/Oバイト数（方向別）')
+metrics.describe('devbot_claude_cost_usd_total', 'counter', 'Claudeが報告した実行コストの合計（USD）')
+metrics.describe('devbot_claude_turns', 'histogram', 'Claude実行1回のターン数', (1, 2, 5, 10, 20, 50, 100))
+metrics.describe('devbot_claude_tokens_total', 'counter', 'Claudeが報告したトークン数（種別）')
+metrics.describe('devbot_git_commits_total', 'counter', 'implement後に作成したコミット数')
+metrics.describe('devbot_git_pushes_total', 'counter', 'git pushの回数（結果別）')
+metrics.describe('devbot_git_push_commits', 'histogram', '1回のpushにまとめたコミット数', (1, 2, 5, 10, 20, 50))
+metrics.describe('devbot_context_total', 'counter', 'リポジトリ概要の取得回数（hit / full / incremental）')
+metrics.describe('devbot_context_build_seconds', 'histogram', 'リポジトリ概要の作成・更新にかかった時間')
+metrics.describe('devbot_health_status', 'gauge', 'ヘルスチェックが正常なら1（チェック別）')
+metrics.describe('devbot_health_check_seconds', 'histogram', 'ヘルスチェック1件の所要時間')
+
+
+class StageTimer:
+    """1回のimplementを段階ごとに計測し、devbot_stage_secondsに記録"""
+    
+    def __init__(self):
+        self.stages = {}
+        self.resources = None
+        self.telemetry = None
+        self.exit_code = None
+        self._last = time.monotonic()
+    
+    @property
+    def succeeded(self):
+        """Claudeが正常終了したか（未終了・タイムアウト・is_errorの結果は失敗扱い）"""
+        return self.exit_code == 0 and not (self.telemetry is not None and self.telemetry.is_error)
+    
+    def record(self, stage, seconds):
+        self.stages[stage] = seconds
+        metrics.observe('devbot_stage_seconds', seconds, stage=stage)
+    
+    def mark(self, stage):
+        """前回のmark/生成時点からの経過時間をstageとして記録"""
+        now = time.monotonic()
+        self.record(stage, now - self._last)
+        self._last = now
+    
+    def record_resources(self, stats):
+        """Claude子プロセスツリーの資源使用量を記録（run_processのon_stats）"""
+        self.resources = stats
+        if stats.source == 'none':
+            return
+        metrics.observe('devbot_claude_cpu_seconds', stats.cpu_seconds)
+        metrics.observe('devbot_claude_max_rss_bytes', stats.max_rss)
+        metrics.inc('devbot_claude_io_bytes_total', stats.read_bytes, direction='read')
+        metrics.inc('devbot_claude_io_bytes_total', stats.write_bytes, direction='write')
+    
+    def record_telemetry(self, telemetry):
+        """Claude自身が報告したターン数・トークン数・コストを記録"""
+        self.telemetry = telemetry
+        if telemetry.cost_usd is not None:
+            metrics.inc('devbot_claude_cost_usd_total', telemetry.cost_usd)
+        if telemetry.turns is not None:
+            metrics.observe('devbot_claude_turns', telemetry.turns)
+        for kind in ('input', 'output', 'cache_read', 'cache_write'):
+            metrics.inc('devbot_claude_tokens_total', getattr(telemetry, f'{kind}_tokens'), kind=kind)
+    
+    def summary(self):
+        text = ' / '.join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages.items())
+        if self.resources is not None:
+            text += f" / {self.resources.summary()}"
+        if self.telemetry is not None:
+            text += f" / {self.telemetry.summary()}"
+        return text
+
+
+async def start_metrics_server(host, port):
+    """/metrics をHTTPで公開（aiohttpはdiscord.pyの依存として導入済み）"""
+    from aiohttp import web
+    
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+    
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"メトリクス公開: http://{host}:{port}/metrics")
+    return runner
+
+
+def format_tokens(count):
+    """トークン数を 1234 → 1.2k のように短く表記"""
+    if count >= 1_000_000:
+        return f"{count / 1_000_000:.1f}M"
+    if count >= 1000:
+        return f"{count / 1000:.1f}k"
+    return str(count)
+
+
+@dataclass
+class RunTelemetry:
+    """Claudeのresultイベントから取り出した1回分の使用量"""
+    cost_usd: float = None
+    turns: int = None
+    duration_ms: int = None
+    api_duration_ms: int = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    model: str = None
+    is_error: bool = False
+
+    @classmethod
+    def from_event(cls, event, model=None):
+        usage = event.get('usage') or {}
+        # 旧CLIは cost_usd、現行は total_cost_usd
+        cost = event.get('total_cost_usd', event.get('cost_usd'))
+        return cls(
+            cost_usd=float(cost) if isinstance(cost, (int, float)) else None,
+            turns=event.get('num_turns'),
+            duration_ms=event.get('duration_ms'),
+            api_duration_ms=event.get('duration_api_ms'),
+            input_tokens=int(usage.get('input_tokens') or 0),
+            output_tokens=int(usage.get('output_tokens') or 0),
+            cache_read_tokens=int(usage.get('cache_read_input_tokens') or 0),
+            cache_write_tokens=int(usage.get('cache_creation_input_tokens') or 0),
+            model=model,
+            is_error=bool(event.get('is_error'))
+        )
+
+    def summary(self):
+        parts = []
+        if self.turns is not None:
+            parts.append(f"{self.turns}ターン")
+        parts.append(
+            f"入力{format_tokens(self.input_tokens)}（キャッシュ読込{format_tokens(self.cache_read_tokens)}"
+            f" 書込{format_tokens(self.cache_write_tokens)}） 出力{format_tokens(self.output_tokens)}トークン"
+        )
+        if self.api_duration_ms is not None:
+            parts.append(f"API {self.api_duration_ms / 1000:.1f}秒")
+        if self.cost_usd is not None:
+            parts.append(f"${self.cost_usd:.4f}")
+        if self.model:
+            parts.append(self.model)
+        return ' / '.join(parts)
+
+
+class ClaudeStreamParser:
+    """
+    `--output-format stream-json` / `json` の出力を1行ずつ解釈する
+
+    stream-jsonは1行1イベント、jsonは最後に1行のresultイベントだけを出す。
+    どちらも届いた行をその場で処理し、出力全体を溜めてから解析することはしない
+    """
+
+    EDIT_TOOLS = ('Edit', 'MultiEdit', 'Write', 'NotebookEdit')
+
+    def __init__(self):
+        self.session_id = None
+        self.model = None
+        self.result_event = None
+        self.texts = []
+        self.raw_lines = []
+        # 最初にファイルを編集するツールを呼んだ時刻（time.monotonic）
+        self.first_edit = None
+
+    @property
+    def result_text(self):
+        """最終結果テキスト（resultイベントが無ければ途中のテキストを連結）"""
+        if self.result_event and self.result_event.get('result'):
+            return self.result_event['result']
+        if self.texts:
+            return '\n'.join(self.texts)
+        return '\n'.join(self.raw_lines)
+
+    @property
+    def telemetry(self):
+        """resultイベントの使用量（届いていなければNone）"""
+        if self.result_event is None:
+            return None
+        return RunTelemetry.from_event(self.result_event, self.model)
+
+    def feed(self, line):
+        """1行を解釈し、進捗表示用のテキストを返す（表示不要ならNone）"""
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            # JSONでない行（旧CLIなど）はそのまま扱う
+            self.raw_lines.append(line)
+            return line + '\n'
+        if not isinstance(event, dict):
+            return None
+
+        if event.get('session_id'):
+            self.session_id = event['session_id']
+
+        event_type = event.get('type')
+        if event_type == 'system' and event.get('model'):
+            self.model = event['model']
+            return None
+        if event_type == 'result':
+            self.result_event = event
+            return None
+        if event_type != 'assistant':
+            return None
+
+        parts = []
+        for block in event.get('message', {}).get('content', []):
+            if block.get('type') == 'text' and block.get('text'):
+                self.texts.append(block['text'])
+                parts.append(block['text'])
+            elif block.get('type') == 'tool_use':
+                if self.first_edit is None and block.get('name') in self.EDIT_TOOLS:
+                    self.first_edit = time.monotonic()
+                target = block.get('input', {})
+                detail = target.get('file_path') or target.get('command') or target.get('pattern') or ''
+                parts.append(f"🔧 {block.get('name', 'tool')} {str(detail)[:80]}".rstrip())
+        return '\n'.join(parts) + '\n' if parts else None
+
+
+class StreamingMessage:
+    """
+    進捗表示用メッセージを一定間隔でまとめて編集する
+
+    append()はバッファに積むだけで、実際の編集は最短interval秒ごとに1回に
+    まとめる。1通がlimit文字を超えたら新しいメッセージへ繰り越し、
+    max_messages通に達した後は最後の1通に末尾だけを表示し続ける。
+    """
+
+    def __init__(self, channel, *, header='', interval=1.5, limit=1900, max_messages=5):
+        self.channel = channel
+        self.header = header
+        self.interval = interval
+        self.limit = limit
+        self.max_messages = max_messages
+        self.messages = []
+        self._message = None
+        self._shown = None
+        self._pending = ''
+        self._truncated = False
+        self._last_edit = 0.0
+        self._dirty = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def start(self):
+        """最初のメッセージを即座に送信し、編集ループを開始"""
+        await self._render()
+        self._task = asyncio.create_task(self._run())
+
+    async def append(self, text):
+        """表示テキストを追加（編集は次の周期でまとめて行う）"""
+        if text:
+            self._pending += text
+            self._dirty.set()
+
+    async def close(self, footer=''):
+        """編集ループを止め、最終状態を反映"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if footer:
+            self._pending += footer
+        await self._flush()
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            wait = self._last_edit + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._dirty.clear()
+            await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            try:
+                # 上限を超えた分を確定させて次のメッセージへ繰り越す
+                while len(self._prefix()) + len(self._pending) > self.limit:
+                    used = len(self.messages) + (1 if self._message is None else 0)
+                    if used >= self.max_messages:
+                        # 通数上限に達したら末尾のみ表示
+                        self._truncated = True
+                        tail = self._pending[-(self.limit - len(self._prefix())):]
+                        # 行の途中から始まらないよう先頭の断片は捨てる
+                        self._pending = tail[tail.find('\n') + 1:]
+                        break
+                    room = self.limit - len(self._prefix())
+                    cut = self._pending.rfind('\n', 0, room)
+                    if cut <= 0:
+                        cut = room
+                    head, self._pending = self._pending[:cut], self._pending[cut:].lstrip('\n')
+                    await self._render(head)
+                    self._message = None
+                    self._shown = None
+                await self._render()
+            except Exception as e:
+                # 再接続で古いクライアントが閉じた場合も含め、進捗表示の失敗でジョブは止めない
+                logger.warning(f"進捗メッセージ更新失敗: {e}")
+
+    def _prefix(self):
+        if self._truncated:
+            return "…（前略）…\n"
+        return self.header if not self.messages or self._message is self.messages[0] else ''
+
+    async def _render(self, text=None):
+        body = self._pending if text is None else text
+        content = (self._prefix() + body) or "⏳"
+        if content == self._shown:
+            return
+        if self._message is None:
+            self._message = await self.channel.send(content)
+            self.messages.append(self._message)
+        else:
+            await self._message.edit(content=content)
+        self._shown = content
+        self._last_edit = time.monotonic()
+
+class CommandResolver:
+    """
+    実行ファイルのフルパス解決をキャッシュする
+    
+    TTL内はメモリ上の辞書を引くだけで返す。TTL切れ時は解決済みファイルの
+    mtimeだけを確認し、変化がなければそのまま延長する。解決結果は
+    ディスクにも保存し、次回起動時はmtimeが一致すれば再探索しない。
+    """
+    
+    # Windows実行可能ファイルの拡張子（優先順位順）
+    # .cmdが最優先（npmのグローバルコマンドの標準）
+    WINDOWS_EXTENSIONS = ['.cmd', '.bat', '.exe', '']
+    
+    def __init__(self, name, *, ttl=3600, cache_file=None):
+        self.name = name
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._load_disk_cache()
+    
+    def resolve(self, refresh=False) -> str:
+        """フルパスを返す（見つからない場合はコマンド名のまま）"""
+        entry = self._cache.get(self.name)
+        if entry and not refresh:
+            path, mtime, expires = entry
+            if time.monotonic() < expires:
+                return path
+            if self._mtime(path) == mtime:
+                self._cache[self.name] = (path, mtime, time.monotonic() + self.ttl)
+                return path
         
-        @self.command(name='implement')
-        async def implement(ctx, *, content: str):
-            """Claude Codeで実装を実行"""
-            logger.info(f"implement コマンド実行: {content[:50]}...")
+        with self._lock:
+            path = self._probe()
+            if path is None:
+                self._cache.pop(self.name, None)
+                fallback = f'{self.name}.cmd' if sys.platform == 'win32' else self.name
+                logger.warning(f"{self.name}コマンドのフルパスが見つかりません。{fallback}で試行")
+                return fallback
+            mtime = self._mtime(path)
+            self._cache[self.name] = (path, mtime, time.monotonic() + self.ttl)
+            self._save_disk_cache(path, mtime)
+            logger.info(f"使用する{self.name}コマンド: {path}")
+            return path
+    
+    def cached(self):
+        """キャッシュ済みのパス（未解決ならNone）"""
+        entry = self._cache.get(self.name)
+        return entry[0] if entry else None
+    
+    def candidate_dirs(self):
+        """PATH以外に探索するディレクトリ"""
+        home = Path.home()
+        if sys.platform == 'win32':
+            dirs = [
+                os.path.join(os.environ.get('APPDATA', ''), 'npm'),
+                os.path.join(os.environ.get('PROGRAMFILES', ''), 'nodejs'),
+                os.path.join(os.environ.get('PROGRAMFILES(X86)', ''), 'nodejs'),
+                str(home / 'AppData' / 'Roaming' / 'npm'),
+            ]
+        else:
+            dirs = [
+                str(home / '.claude' / 'local'),
+                str(home / '.npm-global' / 'bin'),
+                str(home / '.local' / 'bin'),
+                '/usr/local/bin',
+                '/opt/homebrew/bin',
+            ]
+        return [d for d in dirs if d and os.path.isdir(d)]
+    
+    def _probe(self):
+        """PATHと既知のインストール先からフルパスを探索"""
+        search_path = os.pathsep.join([os.environ.get('PATH', '')] + self.candidate_dirs())
+        if sys.platform == 'win32':
+            for ext in self.WINDOWS_EXTENSIONS:
+                found = shutil.which(f'{self.name}{ext}', path=search_path)
+                if found:
+                    return found
+            return None
+        return shutil.which(self.name, path=search_path)
+    
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+    
+    def _load_disk_cache(self):
+        if not self.cache_file or not self.cache_file.exists():
+            return
+        try:
+            data = json.loads(self.cache_file.read_text(encoding='utf-8')).get(self.name)
+        except (OSError, ValueError) as e:
+            logger.warning(f"パス解決キャッシュ読み込み失敗: {e}")
+            return
+        if data and data.get('mtime') is not None and self._mtime(data['path']) == data['mtime']:
+            self._cache[self.name] = (data['path'], data['mtime'], time.monotonic() + self.ttl)
+    
+    def _save_disk_cache(self, path, mtime):
+        if not self.cache_file:
+            return
+        try:
+            data = {}
+            if self.cache_file.exists():
+                data = json.loads(self.cache_file.read_text(encoding='utf-8'))
+            data[self.name] = {'path': path, 'mtime': mtime}
+            self.cache_file.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+        except (OSError, ValueError) as e:
+            logger.warning(f"パス解決キャッシュ保存失敗: {e}")
+
+
+class SessionManager:
+    """
+    Discordのチャンネル/スレッドごとにClaudeのセッションIDを保持する
+    
+    最後に使われてからidle_ttl秒経過したセッションは破棄し、
+    max_sessionsを超えたら最も長く使われていないものから追い出す（LRU）。
+    """
+    
+    def __init__(self, *, max_sessions=100, idle_ttl=3600):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+    
+    def get(self, key):
+        entry = self._sessions.get(key)
+        if entry is None:
+            return None
+        session_id, last_used = entry
+        if time.monotonic() - last_used > self.idle_ttl:
+            del self._sessions[key]
+            return None
+        self._sessions.move_to_end(key)
+        return session_id
+    
+    def set(self, key, session_id):
+        self._sessions[key] = (session_id, time.monotonic())
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+    
+    def reset(self, key):
+        """キーのセッションを破棄。破棄したらTrue"""
+        return self._sessions.pop(key, None) is not None
+    
+    def reset_channel(self, channel_id):
+        """チャンネルに紐づく全プロジェクトのセッションを破棄し、破棄数を返す"""
+        keys = [key for key in self._sessions if key[0] == channel_id]
+        for key in keys:
+            del self._sessions[key]
+        return len(keys)
+    
+    def __len__(self):
+        return len(self._sessions)
+
+
+@dataclass
+class Project:
+    """Botが扱うリポジトリ"""
+    name: str
+    path: str
+    channels: list = field(default_factory=list)
+    concurrency: int = 1
+    worktrees: bool = False
+
+
+class ProjectRegistry:
+    """
+    設定のprojectsからプロジェクトを引く
+    
+    project_dirは "default" プロジェクトとして常に登録される。
+    """
+    
+    def __init__(self, config):
+        self.projects = {}
+        if config.project_dir:
+            self.projects['default'] = Project(
+                name='default',
+                path=config.project_dir,
+                concurrency=config.project_concurrency
+            )
+        for name, entry in config.projects.items():
+            self.projects[name] = Project(
+                name=name,
+                path=entry['path'],
+                channels=[int(c) for c in entry.get('channels', [])],
+                concurrency=entry.get('concurrency', config.project_concurrency),
+                worktrees=entry.get('worktrees', False)
+            )
+        self._by_channel = {
+            channel_id: project
+            for project in self.projects.values()
+            for channel_id in project.channels
+        }
+    
+    def get(self, name):
+        return self.projects.get(name)
+    
+    def resolve(self, name=None, channel_ids=()):
+        """--project指定 > チャンネル（スレッドなら親チャンネル）割り当て > default の順で決定"""
+        if name:
+            project = self.projects.get(name)
+            if project is None:
+                raise KeyError(name)
+            return project
+        project = next(
+            (self._by_channel[c] for c in channel_ids if c in self._by_channel),
+            self.projects.get('default')
+        )
+        if project is None:
+            raise KeyError('default')
+        return project
+    
+    def limit(self, name):
+        project = self.projects.get(name)
+        return project.concurrency if project else 1
+
+
+@dataclass
+class Worktree:
+    """ジョブ専用のgit worktree"""
+    path: str
+    branch: str
+    base: str
+    changed: bool = False
+    diffstat: str = ''  # 例: "+20 -5（3ファイル）"
+    kept: bool = False  # 失敗したジョブの変更を未コミットのまま残した
+
+
+async def run_git(args, cwd, timeout=60):
+    """gitコマンドを実行し、失敗したら例外を送出"""
+    result = await run_process(['git', *args], cwd=cwd, timeout=timeout)
+    if result.returncode != 0:
+        raise Exception(f"git {args[0]} 失敗: {result.stderr.strip() or result.stdout.strip()}")
+    return result
+
+
+@dataclass
+class DiffStat:
+    """git diff --numstat の集計"""
+    files: int = 0
+    insertions: int = 0
+    deletions: int = 0
+    
+    def __str__(self):
+        return f"+{self.insertions} -{self.deletions}（{self.files}ファイル）"
+
+
+async def diff_numstat(cwd, base, head='HEAD'):
+    """baseからheadまでの変更量（差分本文は読まず、バイナリは行数0で数える）"""
+    result = await run_git(['diff', '--numstat', base, head], cwd=cwd)
+    stat = DiffStat()
+    for line in result.stdout.splitlines():
+        added, deleted, _ = line.split('\t', 2)
+        stat.files += 1
+        stat.insertions += int(added) if added.isdigit() else 0
+        stat.deletions += int(deleted) if deleted.isdigit() else 0
+    return stat
+
+
+@dataclass
+class GitCommit:
+    """implement後に作成したコミット"""
+    sha: str
+    branch: str
+    stat: DiffStat
+
+
+@dataclass
+class PendingPush:
+    """リポジトリ1つ分のpush待ち（window秒の間のコミットをまとめる）"""
+    cwd: str
+    branches: dict = field(default_factory=dict)  # ブランチ→ジョブIDのリスト
+    channels: dict = field(default_factory=dict)  # チャンネルID→ジョブIDのリスト
+    task: object = None
+
+
+class GitPipeline:
+    """
+    implement後のコミットとpush
+    
+    コミットはジョブの実行中に（リポジトリごとに直列で）行う。pushはリポジトリごとに
+    window秒の間のコミットをまとめ、バックグラウンドで1回のgit pushにする。
+    push・ネットワーク待ちの間もジョブの実行枠は空いている
+    """
+    
+    def __init__(self, services, *, remote='origin', window=10, timeout=120):
+        self.services = services
+        self.remote = remote
+        self.window = window
+        self.timeout = timeout
+        self.pending = {}
+        self._locks = {}
+        # 予約済み・実行中のpushタスク（flushで終わるまで待つ）
+        self._tasks = set()
+    
+    def _lock(self, cwd):
+        key = os.path.realpath(cwd)
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+    
+    @staticmethod
+    async def is_repo(cwd):
+        result = await run_process(['git', 'rev-parse', '--is-inside-work-tree'], cwd=cwd, timeout=30)
+        return result.returncode == 0 and result.stdout.strip() == 'true'
+    
+    async def commit(self, job, cwd):
+        """作業ツリーの変更をすべてコミット（変更がなければNone）"""
+        async with self._lock(cwd):
+            await run_git(['add', '-A'], cwd=cwd)
+            staged = await run_process(['git', 'diff', '--cached', '--quiet'], cwd=cwd, timeout=60)
+            if staged.returncode == 0:
+                return None
+            await run_git(['commit', '-q', '-m', f"[Bot] {job.prompt[:50]}"], cwd=cwd)
+            sha = (await run_git(['rev-parse', 'HEAD'], cwd=cwd)).stdout.strip()
+            branch = (await run_git(['rev-parse', '--abbrev-ref', 'HEAD'], cwd=cwd)).stdout.strip()
+            # 初回コミットには親がないため空ツリーと比較
+            parent = await run_process(['git', 'rev-parse', '--verify', '-q', 'HEAD~1'], cwd=cwd, timeout=30)
+            base = parent.stdout.strip() if parent.returncode == 0 else '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+            stat = await diff_numstat(cwd, base, sha)
+        metrics.inc('devbot_git_commits_total')
+        logger.info(f"コミット: ジョブ#{job.id} {sha[:8]} {branch} {stat}")
+        return GitCommit(sha=sha, branch=branch, stat=stat)
+    
+    def schedule_push(self, cwd, branch, job):
+        """branchのpushを予約（window秒以内の同じリポジトリのpushは1回にまとめる）"""
+        key = os.path.realpath(cwd)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = PendingPush(cwd=cwd)
+            entry.task = asyncio.create_task(self._push_later(key))
+            self._tasks.add(entry.task)
+            entry.task.add_done_callback(self._tasks.discard)
+        entry.branches.setdefault(branch, []).append(job.id)
+        entry.channels.setdefault(job.channel_id, []).append(job.id)
+    
+    async def _push_later(self, key):
+        await asyncio.sleep(self.window)
+        try:
+            await self._push(key)
+        except Exception as e:
+            logger.error(f"pushの実行に失敗: {key}: {e}")
+    
+    async def flush(self):
+        """
+        待たずに予約済みのpushをすべて行い、実行中のpushの終了も待つ
+        
+        停止処理の途中で呼ぶため、失敗しても例外は送出しない（結果はチャンネルへ通知）
+        """
+        for key, entry in list(self.pending.items()):
+            # 待機中のタスクだけを止める（pendingから外れたタスクはpushの最中）
+            entry.task.cancel()
+            try:
+                await self._push(key)
+            except Exception as e:
+                logger.error(f"pushの実行に失敗: {entry.cwd}: {e}")
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    async def _push(self, key):
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        branches = list(entry.branches)
+        commits = sum(len(jobs) for jobs in entry.branches.values())
+        result = error = None
+        try:
+            # 認証情報の入力待ちで止まらないようにする
+            result = await run_process(
+                ['git', 'push', '--porcelain', self.remote, *branches],
+                cwd=entry.cwd,
+                timeout=self.timeout,
+                env={'GIT_TERMINAL_PROMPT': '0'}
+            ) if branches else None
+        except asyncio.TimeoutError:
+            error = f"タイムアウト（{self.timeout:g}秒超過）"
+        except OSError as e:
+            error = str(e)
+        ok = result is not None and result.returncode == 0
+        metrics.inc('devbot_git_pushes_total', result='ok' if ok else 'failed')
+        metrics.observe('devbot_git_push_commits', commits)
+        names = ', '.join(f"`{branch}`" for branch in branches)
+        if ok:
+            logger.info(f"push完了: {entry.cwd} {self.remote} {' '.join(branches)}（{commits}コミット）")
+        else:
+            detail = error or ((result.stderr.strip() or result.stdout.strip())[-800:] if result else '')
+            logger.warning(f"push失敗: {entry.cwd} {self.remote} {' '.join(branches)}: {detail}")
+        for channel_id, job_ids in entry.channels.items():
+            jobs = ', '.join(f"#{job_id}" for job_id in job_ids)
+            if ok:
+                text = f"⬆️ {names} を {self.remote} にpushしました（ジョブ {jobs}）"
+            else:
+                text = f"⚠️ {names} のpushに失敗しました（ジョブ {jobs}）\n```\n{detail}\n```"
+            try:
+                channel = await self.services.channel(channel_id)
+                await channel.send(text)
+            except Exception as e:
+                logger.warning(f"push結果の通知失敗: {e}")
+
+
+async def repo_state(cwd):
+    """
+    作業ツリーの状態を表す文字列（HEAD＋未コミット変更のハッシュ）
+    
+    ファイルが変わると値も変わる。gitリポジトリでなければNone
+    """
+    try:
+        head = (await run_git(['rev-parse', 'HEAD'], cwd=cwd)).stdout.strip()
+        status = (await run_git(['status', '--porcelain', '-z', '--untracked-files=all'], cwd=cwd)).stdout
+        if not status:
+            return head
+        digest = hashlib.sha256(status.encode('utf-8'))
+        diff = await run_git(['diff', 'HEAD', '--no-ext-diff', '--binary'], cwd=cwd)
+        digest.update(diff.stdout.encode('utf-8'))
+    except Exception:
+        return None
+    # 未追跡ファイルは内容の代わりにサイズと更新時刻で判定
+    for entry in status.split('\0'):
+        if entry.startswith('?? '):
+            try:
+                stat = os.stat(os.path.join(cwd, entry[3:]))
+            except OSError:
+                continue
+            digest.update(f"{entry}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    return f"{head}+{digest.hexdigest()[:16]}"
+
+
+def format_size(size):
+    """バイト数を 1.2MB のように短く表記"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+@dataclass
+class RepoSnapshot:
+    """RepoContextが保持する1リポジトリ分の概要"""
+    head: str
+    files: dict  # パス→サイズ（HEADで追跡しているファイル）
+    text: str
+    updated_at: float = field(default_factory=time.time)
+
+
+class RepoContext:
+    """
+    Claudeに渡すリポジトリ概要（ディレクトリ構成・最近の変更・大きいファイル）
+    
+    毎回作り直さず、HEADが変わったときだけ前回のHEADとの差分
+    （git diff --name-status）でファイル一覧を更新する。HEADの確認は
+    .git/HEADと参照先を読むだけでgitは起動しない。run()は使われたリポジトリを
+    定期的に確認し、コミット後の最初の実行でも概要ができている状態にしておく
+    """
+    
+    MARKER = "# リポジトリ概要"
+    RECENT_COMMITS = 15
+    LARGEST_FILES = 10
+    
+    def __init__(self, *, max_chars=6000, interval=30):
+        self.max_chars = max_chars
+        self.interval = interval
+        self._snapshots = {}
+        self._locks = {}
+    
+    @staticmethod
+    def read_head(path):
+        """HEADのコミットID（gitリポジトリでない・コミットが無ければNone）"""
+        git_dir = Path(path) / '.git'
+        try:
+            if git_dir.is_file():
+                # worktree・サブモジュールは "gitdir: <パス>"
+                git_dir = Path(path) / git_dir.read_text(encoding='utf-8').strip().removeprefix('gitdir: ')
+            head = (git_dir / 'HEAD').read_text(encoding='utf-8').strip()
+            if not head.startswith('ref: '):
+                return head
+            ref = head[5:]
+            # worktreeのブランチ参照は本体側（commondir）にある
+            common = git_dir
+            if (git_dir / 'commondir').exists():
+                common = git_dir / (git_dir / 'commondir').read_text(encoding='utf-8').strip()
+            if (common / ref).exists():
+                return (common / ref).read_text(encoding='utf-8').strip()
+            with open(common / 'packed-refs', encoding='utf-8') as f:
+                for line in f:
+                    if line.rstrip('\n').endswith(' ' + ref):
+                        return line.split(' ', 1)[0]
+        except OSError:
+            pass
+        return None
+    
+    async def get(self, path):
+        """概要テキスト（gitリポジトリでなければNone）。HEADが変わっていれば更新してから返す"""
+        path = os.path.realpath(path)
+        head = await asyncio.to_thread(self.read_head, path)
+        if head is None:
+            return None
+        snapshot = self._snapshots.get(path)
+        if snapshot is not None and snapshot.head == head:
+            metrics.inc('devbot_context_total', result='hit')
+            return snapshot.text
+        async with self._locks.setdefault(path, asyncio.Lock()):
+            snapshot = self._snapshots.get(path)
+            if snapshot is None or snapshot.head != head:
+                started = time.monotonic()
+                mode = 'full' if snapshot is None else 'incremental'
+                snapshot = await self._update(path, head, snapshot)
+                self._snapshots[path] = snapshot
+                metrics.inc('devbot_context_total', result=mode)
+                metrics.observe('devbot_context_build_seconds', time.monotonic() - started, mode=mode)
+                logger.info(f"リポジトリ概要を更新: {path} HEAD {head[:8]}（{mode}、{len(snapshot.files)}ファイル、"
+                            f"{time.monotonic() - started:.2f}秒）")
+        return snapshot.text
+    
+    async def _update(self, path, head, previous):
+        changed = None
+        if previous is not None:
+            try:
+                diff = await run_git(['diff', '--name-status', '--no-renames', '-z', previous.head, head], cwd=path)
+                entries = diff.stdout.split('\0')
+                changed = list(zip(entries[0::2], entries[1::2]))
+            except Exception as e:
+                # 前回のコミットがgcで消えた場合などは作り直す
+                logger.info(f"リポジトリ概要の差分更新ができないため作り直します: {e}")
+        if changed is None:
+            listing = await run_git(['ls-files', '-z'], cwd=path)
+            files = await asyncio.to_thread(self._stat, path, {}, [p for p in listing.stdout.split('\0') if p])
+        else:
+            files = dict(previous.files)
+            for status, name in changed:
+                if status == 'D':
+                    files.pop(name, None)
+            names = [name for status, name in changed if status != 'D']
+            files = await asyncio.to_thread(self._stat, path, files, names)
+        log = await run_git(['log', f'-n{self.RECENT_COMMITS}', '--date=short', '--name-only',
+                             '--format=%x1e%h %ad %s', head], cwd=path)
+        text = await asyncio.to_thread(self._render, head, files, log.stdout)
+        return RepoSnapshot(head=head, files=files, text=text)
+    
+    @staticmethod
+    def _stat(path, files, names):
+        for name in names:
+            try:
+                files[name] = os.stat(os.path.join(path, name)).st_size
+            except OSError:
+                # 作業ツリーで消されている・サブモジュールなど
+                files[name] = 0
+        return files
+    
+    def _render(self, head, files, log):
+        """概要テキスト（重要な順に並べ、max_charsを超える分は末尾から削る）"""
+        lines = [
+            f"{self.MARKER}（Botが自動生成。HEAD {head[:8]} / {len(files)}ファイル / {format_size(sum(files.values()))}）",
+            "ファイル構成を調べる前にこの概要を参照してください。",
+            "",
+            "## 最近のコミット（変更ファイル）",
+        ]
+        for entry in log.split('\x1e'):
+            if not entry.strip():
+                continue
+            subject, *names = [line for line in entry.strip().splitlines() if line]
+            shown = ', '.join(names[:8]) + (f" ほか{len(names) - 8}件" if len(names) > 8 else '')
+            lines.append(f"- {subject}" + (f"（{shown}）" if shown else ''))
+        
+        # 上位2階層のディレクトリごとのファイル数・合計サイズ
+        dirs = {}
+        top = []
+        for name, size in files.items():
+            parts = name.split('/')
+            if len(parts) == 1:
+                top.append(name)
+            for depth in range(1, min(len(parts), 3)):
+                key = '/'.join(parts[:depth]) + '/'
+                count, total = dirs.get(key, (0, 0))
+                dirs[key] = (count + 1, total + size)
+        lines += ["", "## ディレクトリ構成（ファイル数・合計サイズ）"]
+        if top:
+            lines.append(f"（直下）{', '.join(sorted(top)[:30])}" + (" ほか" if len(top) > 30 else ''))
+        for key in sorted(dirs):
+            count, total = dirs[key]
+            indent = '  ' * (key.count('/') - 1)
+            lines.append(f"{indent}{key} {count}ファイル {format_size(total)}")
+        
+        lines += ["", "## 大きいファイル"]
+        for name, size in sorted(files.items(), key=lambda item: -item[1])[:self.LARGEST_FILES]:
+            lines.append(f"- {name} {format_size(size)}")
+        
+        text = '\n'.join(lines)
+        if len(text) > self.max_chars:
+            text = text[:text.rfind('\n', 0, self.max_chars - 20)] + "\n…（省略）"
+        return text
+    
+    async def run(self):
+        """使われたリポジトリのHEADを定期的に確認し、変わっていれば概要を作り直しておく"""
+        while True:
+            await asyncio.sleep(self.interval or 60)
+            if not self.interval:
+                continue
+            for path in list(self._snapshots):
+                try:
+                    await self.get(path)
+                except Exception as e:
+                    logger.warning(f"リポジトリ概要の更新失敗: {path}: {e}")
+
+
+WORD_PATTERN = re.compile(r'\w+')
+FENCE_PATTERN = re.compile(r'^[ \t]*(```+|~~~+)(.*)$', re.MULTILINE)
+
+
+def split_message(text, limit=2000, first_limit=None):
+    """
+    テキストをDiscordの文字数制限に収まるよう分割するジェネレータ
+    
+    インデックスを進めるだけで残り文字列を作り直さないため、出力サイズに対して
+    線形時間で動く。できるだけ改行位置で区切り、コードブロックの途中で
+    区切る場合はチャンク末尾で閉じて次のチャンク先頭で開き直す。
+    """
+    pos = 0
+    length = len(text)
+    fence = None  # 開いているコードブロックの開始行（例: "```python"）
+    marker = None  # 開始行のフェンス記号の並び（閉じるときも同じものを使う。例: "````"）
+    current_limit = first_limit or limit
+    while pos < length:
+        prefix = fence + '\n' if fence else ''
+        # 閉じフェンス（"\n" + marker）の分を確保（途中で開く場合に備えて最低でも"\n```"）
+        room = max(current_limit - len(prefix) - 1 - max(len(marker or ''), 3), 1)
+        end = min(length, pos + room)
+        if end < length:
+            cut = text.rfind('\n', pos, end)
+            if cut > pos:
+                end = cut + 1
+        for match in FENCE_PATTERN.finditer(text, pos, end):
+            if fence is None:
+                fence = match.group(0).strip()
+                marker = match.group(1)
+            elif (match.group(1)[0] == marker[0] and len(match.group(1)) >= len(marker)
+                  and not match.group(2).strip()):
+                # 同じ記号で開始以上の長さの行だけが閉じフェンス（CommonMarkと同じ）
+                fence = marker = None
+        chunk = prefix + text[pos:end]
+        if fence and end < length:
+            chunk = chunk.rstrip('\n') + '\n' + marker
+        yield chunk
+        pos = end
+        current_limit = limit
+
+
+class OutputDelivery:
+    """
+    Claudeの出力をサイズに応じてDiscordへ届ける
+    
+    - inline_limit文字以下: Embed本文 + 続きを通常メッセージで分割送信
+    - それ以上: プレビュー付きEmbed + ファイル添付
+      （一時ファイル経由で送り、attachment_limitを超える場合はgzip圧縮。
+      圧縮しても超える場合は末尾を省略して注記を付ける）
+    """
+    
+    # Embed全体（タイトル・本文・フィールド・フッター）の文字数の上限（Discordの制限）
+    EMBED_TOTAL_LIMIT = 6000
+    
+    def __init__(self, *, embed_limit=4000, message_limit=2000,
+                 inline_limit=10000, attachment_limit=8 * 1024 * 1024):
+        self.embed_limit = embed_limit
+        self.message_limit = message_limit
+        self.inline_limit = inline_limit
+        self.attachment_limit = attachment_limit
+    
+    async def deliver(self, channel, embed, text, filename='claude_output.txt'):
+        """embedに出力を載せて送信"""
+        if len(text) <= self.inline_limit:
+            room = self._description_room(embed)
+            if len(text) > room:
+                embed.add_field(
+                    name="⚠️ 出力が長いため分割表示",
+                    value=f"全体: {len(text)}文字",
+                    inline=False
+                )
+                room = self._description_room(embed)
+            chunks = split_message(text, self.message_limit, first_limit=room)
+            embed.description = next(chunks, '')
+            await channel.send(embed=embed)
+            # Discord上の順序を保つため1通ずつ送る（レート制限はdiscord.pyが待機）
+            for chunk in chunks:
+                await channel.send(chunk)
+            return
+        
+        preview = next(split_message(text, 500), '')
+        description = f"出力が非常に長いため、ファイルとして添付しました。\n\n**プレビュー（先頭500文字）:**\n{preview}\n..."
+        embed.add_field(
+            name="📊 出力統計",
+            value=f"全体: {len(text)}文字 / {text.count(chr(10)) + 1}行",
+            inline=False
+        )
+        
+        spool, filename, kept = await asyncio.to_thread(self._spool, text, filename)
+        with spool:
+            if kept < len(text):
+                embed.add_field(
+                    name="⚠️ 添付を省略",
+                    value=f"圧縮しても添付の上限（{format_size(self.attachment_limit)}）を超えるため、"
+                          f"先頭{kept}文字のみ添付しました",
+                    inline=False
+                )
+            embed.description = description[:self._description_room(embed)]
+            await channel.send(embed=embed)
+            await channel.send(file=discord.File(spool, filename=filename))
+    
+    def _description_room(self, embed):
+        """本文に使える文字数（embed_limitと、本文以外を除いたEmbed全体の残りの小さい方）"""
+        embed.description = None
+        return max(1, min(self.embed_limit, self.EMBED_TOTAL_LIMIT - len(embed)))
+    
+    @staticmethod
+    def _write(text, step=256 * 1024):
+        spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        for start in range(0, len(text), step):
+            spool.write(text[start:start + step].encode('utf-8'))
+        return spool
+    
+    @staticmethod
+    def _gzip(spool, step=256 * 1024):
+        compressed = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        spool.seek(0)
+        with spool, gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=6) as gz:
+            shutil.copyfileobj(spool, gz, step)
+        return compressed
+    
+    def _spool(self, text, filename):
+        """
+        出力を一時ファイルへ書き出す（大きすぎる場合はgzip圧縮）
+        
+        戻り値は (ファイル, ファイル名, 添付した文字数)。圧縮してもattachment_limitを
+        超える場合は、圧縮率から収まる長さを見積もって末尾を省略する
+        """
+        spool = self._write(text)
+        if spool.tell() <= self.attachment_limit:
+            spool.seek(0)
+            return spool, filename, len(text)
+        
+        compressed = self._gzip(spool)
+        kept = len(text)
+        while compressed.tell() > self.attachment_limit and kept > 0:
+            # 見積もりが外れても次の周回で縮むよう1割の余裕を取る
+            kept = max(0, min(kept - 1, int(kept * self.attachment_limit / compressed.tell() * 0.9)))
+            compressed.close()
+            notice = f"\n\n…（添付の上限を超えるため、全{len(text)}文字のうち先頭{kept}文字のみ添付しました）\n"
+            compressed = self._gzip(self._write(text[:kept] + notice))
+        compressed.seek(0)
+        return compressed, filename + '.gz', kept
+
+
+def parse_command_flags(content, known):
+    """
+    先頭の `--name value` / `--name` 形式のフラグを取り出す
+
+    knownはフラグ名→値を取るか(bool)の辞書。戻り値は (flags, 残りの本文)。
+    """
+    flags = {}
+    rest = content.strip()
+    while rest.startswith('--'):
+        head, _, tail = rest.partition(' ')
+        name = head[2:]
+        if name not in known:
+            break
+        if known[name]:
+            value, _, tail = tail.strip().partition(' ')
+            flags[name] = value
+        else:
+            flags[name] = True
+        rest = tail.strip()
+    return flags, rest
+
+
+def parse_batch_tasks(text, filename=''):
+    """
+    バッチのタスク一覧を [(指示, プロジェクト名またはNone), ...] で返す
+
+    JSON/YAMLの配列（文字列、またはprompt・projectを持つオブジェクト。
+    {"tasks": [...]} も可）か、1行1タスクのテキスト（箇条書きの記号・番号、
+    #で始まるコメント行は除く）。YAMLはPyYAMLが入っていれば使い、
+    無ければ `- ` で始まる行を1タスク（字下げした続きの行を含む）として読む。
+    形式が不正ならValueError
+    """
+    suffix = Path(filename).suffix.lower()
+    stripped = text.strip()
+    data = None
+    if suffix == '.json' or (not suffix and stripped[:1] in ('[', '{')):
+        try:
+            data = json.loads(stripped)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSONとして読めません: {e}")
+    elif suffix in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            yaml = None
+        if yaml is not None:
+            try:
+                data = yaml.safe_load(stripped)
+            except yaml.YAMLError as e:
+                raise ValueError(f"YAMLとして読めません: {e}")
+    if data is None:
+        data = _parse_task_lines(stripped)
+    if isinstance(data, dict):
+        data = data.get('tasks')
+    if not isinstance(data, list):
+        raise ValueError("タスクの配列が必要です")
+    
+    tasks = []
+    for item in data:
+        if isinstance(item, dict):
+            prompt, project = item.get('prompt') or item.get('task'), item.get('project')
+        else:
+            prompt, project = item, None
+        if not isinstance(prompt, str) or (project is not None and not isinstance(project, str)):
+            raise ValueError(f"タスクの形式が不正です: {item!r}")
+        if prompt.strip():
+            tasks.append((prompt.strip(), project))
+    return tasks
+
+
+def _parse_task_lines(text):
+    """箇条書き・1行1タスクのテキストを文字列のリストにする"""
+    item_pattern = re.compile(r'^(?:[-*•]|\d+[.)])\s+(.*)$')
+    lines = [line for line in text.splitlines()
+             if line.strip() and not line.lstrip().startswith('#') and line.strip() != 'tasks:']
+    if not any(item_pattern.match(line.strip()) for line in lines):
+        return [line.strip() for line in lines]
+    
+    tasks = []
+    for line in lines:
+        match = item_pattern.match(line.strip())
+        if match:
+            tasks.append(match.group(1).strip().strip('"\''))
+        elif tasks and line[:1].isspace():
+            # 字下げされた行は直前のタスクの続き
+            tasks[-1] += '\n' + line.strip()
+        else:
+            tasks.append(line.strip())
+    return tasks
+
+
+class TokenBucket:
+    """トークンバケット（最大burst個、1秒あたりrate個ずつ補充）"""
+    
+    __slots__ = ('burst', 'rate', 'tokens', 'updated')
+    
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def retry_after(self, now, count=1, allow_debt=False):
+        """
+        count個取り出せるまでの秒数（今すぐ取り出せるなら0）
+        
+        前借りしない場合、burstを超える個数はいつまでも取り出せないので無限大
+        """
+        self.refill(now)
+        if self.tokens >= count:
+            return 0.0
+        if count > self.burst and not allow_debt:
+            return math.inf
+        return (count - self.tokens) / self.rate
+    
+    def take(self, now, allow_debt=False, count=1):
+        """count個取り出す。allow_debtなら不足分を前借りする（延期実行用）"""
+        self.refill(now)
+        if self.tokens >= count or allow_debt:
+            self.tokens -= count
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    ユーザー単位・チャンネル単位のトークンバケットでClaude実行の頻度を制限する
+    
+    check()は両方のバケットから1個ずつ（バッチはタスク数分）取り出し、足りなければ
+    再試行までの秒数を返す。deferなら前借りして実行開始時刻を遅らせ、連打するほど後ろへずれる。
+    """
+    
+    # これ以上のバケットは満タンのものから捨てる
+    MAX_BUCKETS = 10000
+    
+    def __init__(self, config):
+        self.buckets = {}
+        self.configure(config)
+    
+    def configure(self, config):
+        self.limits = {
+            'user': (config.rate_limit_user_burst, config.rate_limit_user_per_hour / 3600),
+            'channel': (config.rate_limit_channel_burst, config.rate_limit_channel_per_hour / 3600),
+        }
+        for (scope, _), bucket in self.buckets.items():
+            bucket.burst, bucket.rate = self.limits[scope]
+    
+    def _bucket(self, scope, key):
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_BUCKETS:
+                self._prune()
+            bucket = self.buckets[(scope, key)] = TokenBucket(*self.limits[scope])
+        return bucket
+    
+    def _prune(self):
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+    
+    def check(self, user_id, channel_id, *, defer=False, cost=1):
+        """
+        cost回分の実行をしてよいか判定する
+        
+        戻り値は (待ち秒数, 制限に掛かった範囲)。0秒なら即実行可。
+        defer=Falseで制限に掛かった場合はトークンを消費しない。
+        costがburstを超える場合、defer=Falseなら待ち秒数は無限大になる
+        """
+        now = time.monotonic()
+        buckets = [
+            (scope, self._bucket(scope, key))
+            for scope, key in (('user', user_id), ('channel', channel_id))
+            if self.limits[scope][1] > 0
+        ]
+        waits = [(bucket.retry_after(now, cost, allow_debt=defer), scope) for scope, bucket in buckets]
+        wait, scope = max(waits, default=(0.0, None))
+        if wait > 0 and not defer:
+            return wait, scope
+        for _, bucket in buckets:
+            bucket.take(now, allow_debt=True, count=cost)
+        return wait, scope
+
+
+class FairShare:
+    """
+    ユーザーごとの実行時間の使用量（重み付き・指数減衰）
+    
+    使用量の少ないユーザーのジョブから実行することで、1人が大量に投入しても
+    他のユーザーの待ち時間が延びないようにする
+    """
+    
+    def __init__(self, *, half_life=3600, weights=None):
+        self.half_life = half_life
+        self.weights = weights or {}
+        self._usage = {}
+    
+    def weight(self, user_id):
+        return self.weights.get(str(user_id), 1)
+    
+    def _decayed(self, user_id, now):
+        value, updated = self._usage.get(user_id, (0.0, now))
+        return value * 0.5 ** ((now - updated) / self.half_life)
+    
+    def charge(self, user_id, seconds):
+        now = time.monotonic()
+        self._usage[user_id] = (self._decayed(user_id, now) + seconds / self.weight(user_id), now)
+    
+    def usage(self, user_id, running_seconds=0.0):
+        """減衰後の使用量（実行中ジョブの経過時間も含める）"""
+        return self._decayed(user_id, time.monotonic()) + running_seconds / self.weight(user_id)
+
+
+@dataclass
+class Job:
+    """実行待ち・実行中のジョブ"""
+    id: int
+    prompt: str
+    project_dir: str
+    channel_id: int
+    author_id: int
+    author_name: str = ''
+    project: str = 'default'
+    priority: int = 0
+    status: str = 'queued'
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    error: str = None
+    not_before: float = None
+    batch_id: int = None
+
+
+class JobStore:
+    """ジョブキューのSQLite永続化（!dev restart を跨いで待ちジョブを保持）"""
+    
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                prompt TEXT NOT NULL,
+                project_dir TEXT NOT NULL,
+                channel_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                author_name TEXT NOT NULL DEFAULT '',
+                project TEXT NOT NULL DEFAULT 'default',
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT,
+                not_before REAL,
+                batch_id INTEGER
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        
+        # 旧バージョンのDBに不足している列を追加
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if 'project' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN project TEXT NOT NULL DEFAULT 'default'")
+        if 'not_before' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+        if 'batch_id' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN batch_id INTEGER")
+    
+    def add(self, job):
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (prompt, project_dir, channel_id, author_id, author_name,"
+                " project, priority, status, created_at, not_before, batch_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.prompt, job.project_dir, job.channel_id, job.author_id, job.author_name,
+                 job.project, job.priority, job.status, job.created_at, job.not_before, job.batch_id)
+            )
+            job.id = cur.lastrowid
+        return job
+    
+    def add_batch(self, channel_id, author_id):
+        """バッチの番号を払い出す"""
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO batches (channel_id, author_id, created_at) VALUES (?, ?, ?)",
+                (channel_id, author_id, time.time())
+            )
+            return cur.lastrowid
+    
+    def update(self, job):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, finished_at = ?, error = ? WHERE id = ?",
+                (job.status, job.started_at, job.finished_at, job.error, job.id)
+            )
+    
+    def load_pending(self):
+        """未完了ジョブを読み込む（前回プロセスで実行中・停止時に中断したものは待ちに戻す）"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, finished_at = NULL"
+                " WHERE status IN ('running', 'interrupted')"
+            )
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY id"
+            ).fetchall()
+        return [Job(**dict(row)) for row in rows]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class JobCheckpoint:
+    """
+    停止・再起動で中断したジョブの途中経過（次回起動時の報告と再実行で使う）
+    
+    stageが'claude_done'ならClaudeの実行は終わっており（outputは最終結果）、
+    次回起動時は再実行せず後処理と結果の送信から再開する
+    """
+    job_id: int
+    channel_id: int
+    prompt: str
+    output: str
+    session_id: str = None
+    interrupted_at: float = field(default_factory=time.time)
+    reported: bool = False
+    stage: str = 'running'
+    exit_code: int = None
+    telemetry: dict = None
+    worktree: dict = None
+
+
+class CheckpointStore:
+    """JobCheckpointをジョブごとに1ファイル（JSON）で保存する"""
+    
+    def __init__(self, directory):
+        self.directory = Path(directory)
+    
+    def _path(self, job_id):
+        return self.directory / f"{job_id}.json"
+    
+    def save(self, checkpoint):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(checkpoint.job_id)
+        # 書き込み途中で終了しても壊れたファイルを残さない
+        temp = path.with_suffix('.tmp')
+        temp.write_text(json.dumps(asdict(checkpoint), ensure_ascii=False), encoding='utf-8')
+        os.replace(temp, path)
+    
+    def load(self, job_id):
+        try:
+            return JobCheckpoint(**json.loads(self._path(job_id).read_text(encoding='utf-8')))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"ジョブ#{job_id} の中断時の記録を読めません: {e}")
+            return None
+    
+    def remove(self, job_id):
+        self._path(job_id).unlink(missing_ok=True)
+    
+    def job_ids(self):
+        if not self.directory.exists():
+            return []
+        return sorted(int(path.stem) for path in self.directory.glob('*.json') if path.stem.isdigit())
+
+
+class ResultCache:
+    """
+    読み取り専用プロンプト（!dev ask）の結果キャッシュ
+    
+    キーはプロンプト・作業ツリーの状態・CLIバージョンのハッシュ。同じプロジェクトの
+    状態が変わったら古いエントリは削除し、合計サイズがmax_bytesを超えたら
+    最後に使われたのが古い順に削除する。
+    """
+    
+    def __init__(self, path, *, max_bytes=50 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                project_dir TEXT NOT NULL,
+                state TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used_at)")
+    
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+    
+    def put(self, key, project_dir, state, result):
+        now = time.time()
+        size = len(result.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # 作業ツリーが変わった後の古い結果はもう当たらないので削除
+            self._conn.execute(
+                "DELETE FROM results WHERE project_dir = ? AND state != ?", (project_dir, state)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, project_dir, state, result, size, now, now)
+            )
+            self._evict()
+    
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY used_at"):
+            if total <= self.max_bytes:
+                break
+            expired.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM results WHERE key = ?", expired)
+    
+    def clear(self, project_dir=None):
+        """キャッシュを削除し、削除件数を返す"""
+        with self._lock:
+            if project_dir is None:
+                cur = self._conn.execute("DELETE FROM results")
+            else:
+                cur = self._conn.execute("DELETE FROM results WHERE project_dir = ?", (project_dir,))
+        return cur.rowcount
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class RunRecord:
+    """実行履歴の1件（_run_claude_headlessが作り、RunHistory.addで保存）"""
+    started_at: float
+    prompt: str
+    project_dir: str
+    project: str = None
+    kind: str = 'implement'
+    job_id: int = None
+    channel_id: int = None
+    author: str = ''
+    read_only: bool = False
+    output_format: str = 'text'
+    exit_code: int = None
+    duration: float = 0.0
+    first_byte: float = None
+    timings: dict = field(default_factory=dict)
+    telemetry: RunTelemetry = None
+    output: str = ''
+
+
+class RunHistory:
+    """
+    Claude実行の履歴（指示・結果の全文・所要時間・使用量）
+    
+    出力はzlib圧縮して保存し、指示と出力の先頭INDEX_LIMIT文字をFTS5で全文検索できるようにする
+    （3文字以上の語はtrigram、2文字以下の語は2文字ずつ区切った索引で探す）。書き込みは専用スレッドがキューからまとめて
+    1トランザクションで行うため、add()はイベントループを止めない。
+    DBはWALモードで、読み取り（検索・集計）は書き込み中も待たされない。
+    text形式で実行した回はClaude側の使用量が無いため、時間と終了コードだけ残る
+    """
+    
+    INDEX_LIMIT = 64_000
+    BATCH_SIZE = 200
+    COLUMNS = {
+        'job_id': 'INTEGER', 'project': 'TEXT', 'kind': 'TEXT', 'channel_id': 'INTEGER',
+        'author': "TEXT NOT NULL DEFAULT ''", 'prompt': "TEXT NOT NULL DEFAULT ''", 'timings': 'TEXT',
+        'output': 'BLOB', 'output_chars': 'INTEGER',
+    }
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                project_dir TEXT NOT NULL,
+                read_only INTEGER NOT NULL DEFAULT 0,
+                output_format TEXT NOT NULL,
+                exit_code INTEGER,
+                duration REAL NOT NULL,
+                first_byte REAL,
+                api_duration REAL,
+                turns INTEGER,
+                cost_usd REAL,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_read_tokens INTEGER,
+                cache_write_tokens INTEGER,
+                model TEXT
+            )
+        """)
+        # 旧バージョンのDBに不足している列を追加
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(runs)")}
+        for name, definition in self.COLUMNS.items():
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {definition}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS runs_started ON runs (started_at)")
+        try:
+            # 本文は持たず索引だけの表（日本語は単語で区切れないのでtrigram）
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(prompt, output, content='', tokenize='trigram')"
+            )
+            # trigramでは探せない2文字以下の語用（_bigramsで2文字ずつに区切ったものを入れる）
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS runs_bigram USING fts5(prompt, output, content='',"
+                " tokenize='unicode61 remove_diacritics 0')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLiteのFTS5(trigram)が使えないため、履歴は指示だけを部分一致で検索します: {e}")
+            self.fts = False
+        
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='run-history', daemon=True)
+        self._writer.start()
+    
+    def _connect(self):
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # WALではコミットごとのfsyncを省いても壊れない（電源断で直近の数件を失う程度）
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    @staticmethod
+    def _bigrams(text):
+        """
+        語（英数字・かなカナ漢字の連続）を2文字ずつずらして空白で区切る
+        
+        各語の最後の1文字も加えるので、1文字の語は「その文字で始まるトークン」で探せる。
+        2文字の語は1トークン、3文字以上の語は連続したトークンの並び（フレーズ）になる
+        """
+        tokens = []
+        for word in WORD_PATTERN.findall(text.lower()):
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            tokens.append(word[-1])
+        return ' '.join(tokens)
+    
+    def add(self, record):
+        """保存を予約（すぐ戻る）"""
+        self._queue.put(record)
+    
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            # 溜まっている分をまとめて書く（負荷が高いほど1回あたりの件数が増える）
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    self._write(conn, records)
+            except Exception as e:
+                logger.error(f"実行履歴の保存に失敗（{len(records)}件）: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if None in batch:
+                conn.close()
+                return
+    
+    def _write(self, conn, records):
+        rows = []
+        for r in records:
+            t = r.telemetry
+            if t is not None:
+                api_duration = t.api_duration_ms / 1000 if t.api_duration_ms is not None else None
+                usage = (api_duration, t.turns, t.cost_usd, t.input_tokens, t.output_tokens,
+                         t.cache_read_tokens, t.cache_write_tokens, t.model)
+            else:
+                usage = (None,) * 8
+            rows.append((
+                r.started_at, r.project_dir, int(r.read_only), r.output_format, r.exit_code, r.duration,
+                r.first_byte, *usage, r.job_id, r.project, r.kind, r.channel_id, r.author, r.prompt,
+                json.dumps(r.timings), zlib.compress(r.output.encode('utf-8'), 6), len(r.output)
+            ))
+        with conn:
+            conn.execute("BEGIN")
+            ids = []
+            for row in rows:
+                cur = conn.execute(
+                    "INSERT INTO runs (started_at, project_dir, read_only, output_format, exit_code, duration,"
+                    " first_byte, api_duration, turns, cost_usd, input_tokens, output_tokens,"
+                    " cache_read_tokens, cache_write_tokens, model, job_id, project, kind, channel_id, author,"
+                    " prompt, timings, output, output_chars)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                ids.append(cur.lastrowid)
+            if self.fts:
+                conn.executemany(
+                    "INSERT INTO runs_fts (rowid, prompt, output) VALUES (?, ?, ?)",
+                    [(run_id, r.prompt, r.output[:self.INDEX_LIMIT]) for run_id, r in zip(ids, records)]
+                )
+                conn.executemany(
+                    "INSERT INTO runs_bigram (rowid, prompt, output) VALUES (?, ?, ?)",
+                    [(run_id, self._bigrams(r.prompt), self._bigrams(r.output[:self.INDEX_LIMIT]))
+                     for run_id, r in zip(ids, records)]
+                )
+    
+    def flush(self):
+        """予約済みの書き込みが終わるまで待つ（ブロックするのでto_threadから呼ぶ）"""
+        self._queue.join()
+    
+    def search(self, query='', *, before=None, limit=10):
+        """
+        新しい順に最大limit件（beforeより小さいIDのみ）
+        
+        queryは空白区切りのAND検索。すべて3文字以上ならtrigramの索引、2文字以下の語を
+        含む場合は2文字ずつ区切った索引（runs_bigram）を使う。どちらも範囲は指示と出力の
+        先頭INDEX_LIMIT文字。FTS5が使えない場合は指示だけを部分一致で探す
+        （出力は圧縮しているので1件ずつ展開する走査はしない）
+        """
+        terms = query.split()
+        table = None
+        if terms and self.fts:
+            if all(len(term) >= 3 for term in terms):
+                table = 'runs_fts'
+                match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+            else:
+                phrases = []
+                for term in terms:
+                    tokens = self._bigrams(term).split()
+                    if len(tokens) == 1:
+                        # 1文字の語はその文字で始まるトークン（2文字の組か語末の1文字）に一致
+                        phrases.append(f'"{tokens[0]}"' + ('*' if len(tokens[0]) == 1 else ''))
+                    elif tokens:
+                        # 語末の1文字はフレーズの途中に来ないので除く
+                        phrases.append('"' + ' '.join(tokens[:-1]) + '"')
+                if phrases:
+                    table = 'runs_bigram'
+                    match = ' AND '.join(phrases)
+        if table:
+            sql = f"SELECT runs.* FROM {table} JOIN runs ON runs.id = {table}.rowid WHERE {table} MATCH ?"
+            params = [match]
+            if before is not None:
+                sql += f" AND {table}.rowid < ?"
+                params.append(before)
+            sql += f" ORDER BY {table}.rowid DESC LIMIT ?"
+            params.append(limit)
+        else:
+            where = []
+            params = []
+            if before is not None:
+                where.append("runs.id < ?")
+                params.append(before)
+            for term in terms:
+                where.append("runs.prompt LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+            sql = ("SELECT runs.* FROM runs" + (" WHERE " + ' AND '.join(where) if where else '') +
+                   " ORDER BY runs.id DESC LIMIT ?")
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+    
+    def get(self, run_id):
+        """1件を出力の全文付きで返す（無ければNone）"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        run = dict(row)
+        run['output'] = zlib.decompress(run['output']).decode('utf-8') if run['output'] else ''
+        run['timings'] = json.loads(run['timings']) if run['timings'] else {}
+        return run
+    
+    def daily(self, days=7):
+        """直近days日の日別集計（新しい日が先）"""
+        since = time.time() - days * 86400
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT date(started_at, 'unixepoch', 'localtime') AS day,
+                       COUNT(*) AS runs,
+                       SUM(exit_code IS NULL OR exit_code != 0) AS failed,
+                       SUM(cost_usd) AS cost_usd,
+                       AVG(duration) AS avg_duration,
+                       MAX(duration) AS max_duration,
+                       AVG(first_byte) AS avg_first_byte,
+                       AVG(turns) AS avg_turns,
+                       SUM(input_tokens + cache_read_tokens + cache_write_tokens) AS input_tokens,
+                       SUM(output_tokens) AS output_tokens
+                FROM runs WHERE started_at >= ?
+                GROUP BY day ORDER BY day DESC
+            """, (since,)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def close(self):
+        """書き込みを終えてから閉じる"""
+        self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            self._conn.close()
+
+
+class JobScheduler:
+    """
+    ジョブの受付と実行を管理するスケジューラ
+    
+    全体の同時実行数をmax_workersで、プロジェクトごとの同時実行数を
+    project_limit(プロジェクト名)の戻り値で制限する。待ちジョブは優先度の高い順、
+    同順位は実行時間の使用量（FairShare）が少ないユーザー順、さらに到着順に取り出す。
+    not_beforeが未来のジョブ（レート制限で延期）はその時刻まで開始しない。
+    バッチのジョブ（batch_idあり）は専用のworktreeで動くため、プロジェクトの制限を
+    受けず、max_workersの枠のうち最大batch_workers件まで実行する。
+    drain()の後は新しいジョブを開始せず（受け付けたジョブは次回起動時に実行）、
+    interrupt()で止めたジョブはinterruptedとして保存して次回起動時に待ちへ戻す。
+    
+    待ち順の通知（on_queue_change）と終了通知（on_finish）はDiscordへの送信を伴うため、
+    _dispatch・_run_jobからは待たない。待ち順は変化をPOSITION_INTERVAL秒ごとに
+    まとめ、先頭POSITION_TOP件だけ通知する（待ちが長いほど編集が増えないように）
+    """
+    
+    POSITION_INTERVAL = 2.0
+    POSITION_TOP = 10
+    
+    def __init__(self, store, runner, *, max_workers=2, batch_workers=2, project_limit=None, fair_share=None):
+        self.store = store
+        self.runner = runner
+        self.max_workers = max_workers
+        self.batch_workers = batch_workers
+        self.project_limit = project_limit or (lambda project: 1)
+        self.fair_share = fair_share or FairShare()
+        self.queued = []
+        self.running = {}
+        self.on_queue_change = None
+        self.on_finish = None
+        self.draining = False
+        self._interrupted = set()
+        self._started = False
+        self._wakeup = None
+        self._wake_task = None
+        self._positions_dirty = asyncio.Event()
+        self._position_task = None
+        self.pending_notifications = set()
+    
+    async def start(self):
+        """永続化された待ちジョブを復元して実行を開始"""
+        if self._started:
+            return
+        self._started = True
+        restored = await asyncio.to_thread(self.store.load_pending)
+        self.queued.extend(restored)
+        self._position_task = asyncio.create_task(self._position_loop())
+        if restored:
+            logger.info(f"待ちジョブを復元: {len(restored)}件")
+        await self._dispatch()
+    
+    async def submit(self, job):
+        """ジョブを登録し、待ち順（0なら即実行）を返す"""
+        await asyncio.to_thread(self.store.add, job)
+        self.queued.append(job)
+        if self._started:
+            await self._dispatch()
+        return self.position(job.id)
+    
+    def position(self, job_id):
+        """待ち順（1始まり）。実行中なら0、存在しなければNone"""
+        if job_id in self.running:
+            return 0
+        for index, job in enumerate(self._ordered()):
+            if job.id == job_id:
+                return index + 1
+        return None
+    
+    def get(self, job_id):
+        if job_id in self.running:
+            return self.running[job_id][0]
+        return next((job for job in self.queued if job.id == job_id), None)
+    
+    def ordered_queue(self):
+        return list(self._ordered())
+    
+    async def cancel(self, job_id):
+        """ジョブを取り消す。取り消せたらTrue"""
+        if job_id in self.running:
+            self.running[job_id][1].cancel()
+            return True
+        job = next((job for job in self.queued if job.id == job_id), None)
+        if job is None:
+            return False
+        self.queued.remove(job)
+        job.status = 'cancelled'
+        job.finished_at = time.time()
+        await asyncio.to_thread(self.store.update, job)
+        self._positions_changed()
+        if self.on_finish:
+            await self.on_finish(job)
+        return True
+    
+    async def resize(self, max_workers, batch_workers=None):
+        """全体の同時実行数を変更（減らした場合は実行中のジョブの終了を待って反映）"""
+        self.max_workers = max_workers
+        if batch_workers is not None:
+            self.batch_workers = batch_workers
+        if self._started:
+            await self._dispatch()
+    
+    async def drain(self, timeout):
+        """新しいジョブの開始を止め、実行中のジョブの終了を最大timeout秒待つ。終わらなかったジョブを返す"""
+        self.draining = True
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        tasks = [task for _, task in self.running.values()]
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+        return [job for job, _ in self.running.values()]
+    
+    async def interrupt(self):
+        """実行中のジョブを止め、次回起動時に再実行するよう保存する"""
+        tasks = []
+        for job_id, (job, task) in list(self.running.items()):
+            self._interrupted.add(job_id)
+            task.cancel()
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _ordered(self):
+        now = time.time()
+        running = {}
+        for job, _ in self.running.values():
+            running[job.author_id] = running.get(job.author_id, 0.0) + now - (job.started_at or now)
+        usage = {}
+        for job in self.queued:
+            if job.author_id not in usage:
+                usage[job.author_id] = self.fair_share.usage(job.author_id, running.get(job.author_id, 0.0))
+        return sorted(self.queued, key=lambda job: (-job.priority, usage[job.author_id], job.id))
+    
+    def running_in_project(self, project):
+        return sum(1 for job, _ in self.running.values() if job.project == project and job.batch_id is None)
+    
+    def running_batches(self):
+        return sum(1 for job, _ in self.running.values() if job.batch_id is not None)
+    
+    def _has_capacity(self, job):
+        if len(self.running) >= self.max_workers:
+            return False
+        if job.batch_id is not None:
+            return self.running_batches() < self.batch_workers
+        return self.running_in_project(job.project) < self.project_limit(job.project)
+    
+    def _next_runnable(self):
+        if self.draining:
+            return None
+        now = time.time()
+        for job in self._ordered():
+            if job.not_before and job.not_before > now:
+                continue
+            if self._has_capacity(job):
+                return job
+        return None
+    
+    def _schedule_wakeup(self):
+        """延期中のジョブのうち最も早い開始時刻に_dispatchを予約"""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        now = time.time()
+        pending = [job.not_before for job in self.queued if job.not_before and job.not_before > now]
+        if pending:
+            self._wakeup = asyncio.get_running_loop().call_later(min(pending) - now, self._wake)
+    
+    def _wake(self):
+        self._wakeup = None
+        self._wake_task = asyncio.create_task(self._dispatch())
+    
+    async def _dispatch(self):
+        """空きがある限り待ちジョブを実行開始"""
+        started = False
+        while True:
+            job = self._next_runnable()
+            if job is None:
+                break
+            self.queued.remove(job)
+            job.status = 'running'
+            job.started_at = time.time()
+            self.running[job.id] = (job, asyncio.create_task(self._run_job(job)))
+            started = True
+        self._schedule_wakeup()
+        metrics.set('devbot_queue_depth', len(self.queued))
+        metrics.set('devbot_running_jobs', len(self.running))
+        if started:
+            self._positions_changed()
+    
+    async def _run_job(self, job):
+        try:
+            await asyncio.to_thread(self.store.update, job)
+            await self.runner(job)
+            job.status = 'done'
+        except asyncio.CancelledError:
+            job.status = 'interrupted' if job.id in self._interrupted else 'cancelled'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)[:1000]
+            logger.error(f"ジョブ#{job.id} 失敗: {e}\n{traceback.format_exc()}")
+        finally:
+            job.finished_at = time.time()
+            self.running.pop(job.id, None)
+            if job.started_at:
+                self.fair_share.charge(job.author_id, job.finished_at - job.started_at)
+            metrics.inc('devbot_jobs_total', status=job.status)
+            await asyncio.to_thread(self.store.update, job)
+            await self._dispatch()
+            if self.on_finish:
+                # 通知の送信を待たずに次のジョブへ進む
+                task = asyncio.create_task(self._notify_finish(job))
+                self.pending_notifications.add(task)
+                task.add_done_callback(self.pending_notifications.discard)
+    
+    async def _notify_finish(self, job):
+        try:
+            await self.on_finish(job)
+        except Exception as e:
+            logger.warning(f"ジョブ#{job.id} の終了通知失敗: {e}")
+    
+    def _positions_changed(self):
+        """待ち順の通知を予約（実際の通知は_position_loopがまとめて行う）"""
+        self._positions_dirty.set()
+    
+    async def _position_loop(self):
+        """待ち順の変化をまとめ、先頭POSITION_TOP件の待ち順を通知する"""
+        while True:
+            await self._positions_dirty.wait()
+            await asyncio.sleep(self.POSITION_INTERVAL)
+            self._positions_dirty.clear()
+            if not self.on_queue_change:
+                continue
+            for index, job in enumerate(self._ordered()[:self.POSITION_TOP]):
+                if job.status != 'queued':
+                    # 通知中に開始・取り消しされた
+                    continue
+                try:
+                    await self.on_queue_change(job, index + 1)
+                except Exception as e:
+                    logger.warning(f"待ち順通知失敗: {e}")
+
+
+class BatchRun:
+    """
+    !dev batch 1回分の進捗と結果
+
+    ジョブはスケジューラと同じJobオブジェクトを参照する。状態が変わるたびに
+    touch()し、集計Embedの編集は最短interval秒ごとに1回にまとめる
+    """
+    
+    ICONS = {'queued': '⏳', 'running': '🔄', 'done': '✅', 'failed': '❌', 'cancelled': '🚫', 'interrupted': '⏸️'}
+    FINISHED = ('done', 'failed', 'cancelled')
+    
+    def __init__(self, batch_id, jobs, *, channel_id, interval=1.5, prefix='!dev '):
+        self.id = batch_id
+        self.jobs = jobs
+        self.channel_id = channel_id
+        self.interval = interval
+        self.prefix = prefix
+        self.created_at = time.time()
+        self.results = {}
+        self.message = None
+        self._last_edit = 0.0
+        self._dirty = asyncio.Event()
+        self._task = None
+    
+    @property
+    def finished(self):
+        return all(job.status in self.FINISHED for job in self.jobs)
+    
+    def record(self, job, *, output=None, error=None, worktree=None, resources=None):
+        """タスクの結果を記録"""
+        self.results[job.id] = {'output': output, 'error': error, 'worktree': worktree, 'resources': resources}
+        self.touch()
+    
+    def touch(self):
+        self._dirty.set()
+    
+    async def start(self, channel):
+        """集計メッセージを送信し、編集ループを開始"""
+        self.message = await channel.send(embed=self.embed())
+        self._last_edit = time.monotonic()
+        if not self.finished:
+            self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        """編集ループを止め、最終状態を反映"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._edit()
+    
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            wait = self._last_edit + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._dirty.clear()
+            await self._edit()
+    
+    async def _edit(self):
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(embed=self.embed())
+        except Exception as e:
+            # 再接続で古いクライアントが閉じた場合も含め、表示の失敗でバッチは止めない
+            logger.warning(f"バッチ#{self.id} の進捗更新失敗: {e}")
+        self._last_edit = time.monotonic()
+    
+    def counts(self):
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+    
+    @staticmethod
+    def duration(job):
+        if not job.started_at:
+            return None
+        return (job.finished_at or time.time()) - job.started_at
+    
+    def line(self, job, width=40):
+        """タスク1件の1行表示"""
+        prompt = job.prompt.splitlines()[0]
+        prompt = prompt if len(prompt) <= width else prompt[:width - 1] + '…'
+        parts = [f"{self.ICONS.get(job.status, '❔')} `#{job.id}` {prompt}"]
+        duration = self.duration(job)
+        if duration is not None:
+            parts.append(f"{duration:.0f}秒")
+        worktree = (self.results.get(job.id) or {}).get('worktree')
+        if worktree and worktree.diffstat:
+            parts.append(worktree.diffstat)
+        elif job.status == 'done':
+            parts.append("変更なし")
+        return ' — '.join(parts)
+    
+    def embed(self):
+        counts = self.counts()
+        finished = sum(counts.get(status, 0) for status in self.FINISHED)
+        if not self.finished:
+            title = f"📦 バッチ #{self.id} 実行中（{finished}/{len(self.jobs)}完了）"
+            color = discord.Color.blue()
+        elif counts.get('done', 0) == len(self.jobs):
+            title = f"📦 バッチ #{self.id} 完了"
+            color = discord.Color.green()
+        else:
+            title = f"📦 バッチ #{self.id} 終了（失敗・取消あり）"
+            color = discord.Color.orange()
+        lines = [self.line(job) for job in self.jobs]
+        description = ''
+        for index, line in enumerate(lines):
+            if len(description) + len(line) > 3900:
+                description += f"…ほか{len(lines) - index}件"
+                break
+            description += line + '\n'
+        embed = discord.Embed(title=title, description=description, color=color)
+        elapsed = time.time() - self.created_at
+        footer = f"経過 {elapsed:.0f}秒"
+        if not self.finished:
+            footer += f" / 取り消し: {self.prefix}batch cancel {self.id}"
+        embed.set_footer(text=footer)
+        return embed
+    
+    def report_embed(self):
+        """最終報告のEmbed（本文はreport()をOutputDeliveryで載せる）"""
+        counts = self.counts()
+        elapsed = max(job.finished_at or 0 for job in self.jobs) - self.created_at
+        total = sum(self.duration(job) or 0 for job in self.jobs)
+        embed = discord.Embed(
+            title=f"📦 バッチ #{self.id} の結果",
+            color=discord.Color.green() if counts.get('done', 0) == len(self.jobs) else discord.Color.orange(),
+            timestamp=datetime.now()
+        )
+        embed.add_field(
+            name="結果",
+            value=f"✅ {counts.get('done', 0)} / ❌ {counts.get('failed', 0)} / 🚫 {counts.get('cancelled', 0)}",
+            inline=True
+        )
+        embed.add_field(name="所要時間", value=f"{elapsed:.0f}秒（各タスクの合計 {total:.0f}秒）", inline=True)
+        return embed
+    
+    def report(self):
+        """全タスクの結果（Markdown）"""
+        sections = [f"# バッチ #{self.id}", '\n'.join(self.line(job, width=80) for job in self.jobs)]
+        for job in self.jobs:
+            result = self.results.get(job.id) or {}
+            lines = [f"## {self.ICONS.get(job.status, '❔')} #{job.id} {job.prompt.splitlines()[0][:80]}"]
+            worktree = result.get('worktree')
+            if worktree and worktree.changed:
+                lines.append(f"- ブランチ: `{worktree.branch}` {worktree.diffstat}")
+            duration = self.duration(job)
+            if duration is not None:
+                lines.append(f"- 所要時間: {duration:.1f}秒")
+            if result.get('resources') is not None:
+                lines.append(f"- リソース: {result['resources'].summary()}")
+            sections.append('\n'.join(lines))
+            body = '\n\n'.join(part.strip() for part in (result.get('error') or job.error, result.get('output')) if part)
+            if body:
+                sections.append(body)
+        return '\n\n'.join(sections)
+
+
+@dataclass
+class CheckResult:
+    """ヘルスチェック1件の結果"""
+    name: str
+    label: str
+    status: str  # 'ok' / 'warn' / 'error'
+    detail: str
+    duration: float
+    checked_at: float
+
+    ICONS = {'ok': '✅', 'warn': '⚠️', 'error': '❌'}
+
+    @property
+    def icon(self):
+        return self.ICONS.get(self.status, '❔')
+
+
+class HealthMonitor:
+    """
+    環境の診断をバックグラウンドで定期実行し、最新の結果を保持する
+
+    各チェックは並行に実行し、個別のタイムアウトを掛ける。diagnose・statusは
+    保持している結果を返すだけなのでイベントループを止めない。
+    チェックは register(name, label, check) で追加できる。checkは
+    (status, detail) を返すasync関数
+    """
+
+    CLAUDE_LIMIT_PATTERN = re.compile(r'usage limit|rate limit|quota|credit balance|overloaded', re.IGNORECASE)
+
+    def __init__(self, services, *, interval=300, timeout=10):
+        self.services = services
+        self.interval = interval
+        self.timeout = timeout
+        self.checks = {}
+        self.results = {}
+        self.refreshed_at = None
+        self.claude_limit_notice = None  # (時刻, メッセージ)
+        self._refreshing = None
+        self._wake = asyncio.Event()
+        self.register('claude', 'Claude', self.check_claude)
+        self.register('claude_auth', 'Claude認証・利用枠', self.check_claude_auth)
+        self.register('git', 'Git', self.check_git)
+        self.register('repos', 'リポジトリ', self.check_repos)
+        self.register('disk', 'ディスク空き容量', self.check_disk)
+        self.register('path', 'PATH', self.check_path)
+
+    def register(self, name, label, check, *, timeout=None):
+        self.checks[name] = (label, check, timeout)
+
+    async def _run_check(self, name):
+        label, check, timeout = self.checks[name]
+        started = time.monotonic()
+        try:
+            status, detail = await asyncio.wait_for(check(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            status, detail = 'error', f"{timeout or self.timeout}秒以内に応答がありません"
+        except Exception as e:
+            status, detail = 'error', str(e) or type(e).__name__
+        duration = time.monotonic() - started
+        metrics.set('devbot_health_status', 1 if status == 'ok' else 0, check=name)
+        metrics.observe('devbot_health_check_seconds', duration, check=name)
+        if status != 'ok':
+            logger.warning(f"ヘルスチェック {name}: {status} {detail}")
+        return CheckResult(name, label, status, detail, duration, time.time())
+
+    async def refresh(self):
+        """全チェックを並行に実行（実行中なら同じ実行を待つ）"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        return await asyncio.shield(self._refreshing)
+
+    async def _refresh(self):
+        results = await asyncio.gather(*(self._run_check(name) for name in self.checks))
+        self.results = {result.name: result for result in results}
+        self.refreshed_at = time.time()
+        return self.results
+
+    def snapshot(self):
+        """最新の結果（一度も実行していなければ空）"""
+        return list(self.results.values())
+
+    def age(self):
+        return time.time() - self.refreshed_at if self.refreshed_at else None
+
+    def summary(self):
+        """statusに出す1行の要約"""
+        if not self.results:
+            return "確認中..."
+        bad = [result for result in self.results.values() if result.status != 'ok']
+        text = ' '.join(f"{result.icon}{result.label}" for result in bad) or f"✅ {len(self.results)}件すべて正常"
+        return f"{text}（<t:{int(self.refreshed_at)}:R>）"
+
+    def note_claude_output(self, text):
+        """Claudeの出力に利用上限のメッセージがあれば記録（次のチェックで警告）"""
+        match = self.CLAUDE_LIMIT_PATTERN.search(text or '')
+        if match:
+            line = next((l for l in text.splitlines() if match.group(0) in l), match.group(0))
+            self.claude_limit_notice = (time.time(), line.strip()[:200])
+
+    async def run(self):
+        """interval秒ごとに更新（request_refreshで前倒し）"""
+        while True:
+            await self.refresh()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def request_refresh(self):
+        self._wake.set()
+
+    async def check_claude(self):
+        resolver = self.services.claude_resolver
+        path = await asyncio.to_thread(resolver.resolve)
+        if not resolver.cached():
+            return 'error', f"claudeコマンドが見つかりません（`{path}` で試行します）"
+        version = await self.services.claude_version()
+        return 'ok', f"`{path}`\n{version}"
+
+    async def check_claude_auth(self):
+        notice = self.claude_limit_notice
+        if notice and time.time() - notice[0] < 3600:
+            return 'warn', f"直近の実行で利用上限に達した可能性があります（<t:{int(notice[0])}:R>）: {notice[1]}"
+        if os.environ.get('ANTHROPIC_API_KEY') or os.environ.get('CLAUDE_CODE_OAUTH_TOKEN'):
+            return 'ok', "環境変数のAPIキー・トークンを使用"
+        credentials = Path.home() / '.claude' / '.credentials.json'
+        if await asyncio.to_thread(credentials.exists):
+            return 'ok', "ログイン済み（~/.claude/.credentials.json）"
+        if sys.platform == 'darwin':
+            # macOSはキーチェーンに保存されるためファイルでは確認できない
+            return 'ok', "キーチェーンの認証情報を使用（未確認）"
+        return 'warn', "認証情報が見つかりません。`claude` を起動してログインしてください"
+
+    async def check_git(self):
+        result = await run_process(['git', '--version'], timeout=self.timeout)
+        if result.returncode != 0:
+            return 'error', result.stderr.strip() or f"終了コード {result.returncode}"
+        return 'ok', result.stdout.strip()
+
+    async def check_repos(self):
+        projects = list(self.services.projects.projects.values())
+
+        async def inspect(project):
+            if not await asyncio.to_thread(os.path.isdir, project.path):
+                return 'error', f"{project.name}: ディレクトリがありません"
+            result = await run_process(['git', 'status', '--porcelain'], cwd=project.path, timeout=self.timeout)
+            if result.returncode != 0:
+                return 'warn', f"{project.name}: gitリポジトリではありません"
+            changes = len(result.stdout.splitlines())
+            if changes:
+                return 'warn', f"{project.name}: 未コミットの変更 {changes}件"
+            return 'ok', f"{project.name}: クリーン"
+
+        results = await asyncio.gather(*(inspect(project) for project in projects))
+        return self._worst(results), '\n'.join(detail for _, detail in results) or "プロジェクトなし"
+
+    async def check_disk(self):
+        minimum = self.services.config.health_disk_min_free * 1024 * 1024
+        paths = {str(DATA_DIR)} | {project.path for project in self.services.projects.projects.values()}
+
+        def usage():
+            results = []
+            for path in sorted(paths):
+                try:
+                    free = shutil.disk_usage(path).free
+                except OSError as e:
+                    results.append(('error', f"`{path}`: {e}"))
+                    continue
+                status = 'warn' if free < minimum else 'ok'
+                results.append((status, f"`{path}`: {free / 1024 ** 3:.1f}GB"))
+            return results
+
+        results = await asyncio.to_thread(usage)
+        return self._worst(results), '\n'.join(detail for _, detail in results)
+
+    async def check_path(self):
+        def inspect():
+            path_env = os.environ.get('PATH', '')
+            lines = [f"`{p}`" for p in path_env.split(os.pathsep)[:5]]
+            if sys.platform == 'win32':
+                # npmのグローバルコマンドの置き場所
+                npm_path = os.path.join(os.environ.get('APPDATA', ''), 'npm')
+                found = [ext or '(拡張子なし)' for ext in CommandResolver.WINDOWS_EXTENSIONS
+                         if os.path.exists(os.path.join(npm_path, f'claude{ext}'))]
+                lines.insert(0, f"npm: `{npm_path}` claude{'/'.join(found) or 'なし'}")
+                if npm_path not in path_env:
+                    return 'warn', '\n'.join(["npmパスがPATHに含まれていません", *lines])
+            return 'ok', '\n'.join(lines)
+
+        return await asyncio.to_thread(inspect)
+
+    @staticmethod
+    def _worst(results):
+        order = ('ok', 'warn', 'error')
+        return max((status for status, _ in results), key=order.index, default='ok')
+
+
+class BotServices:
+    """
+    Discordクライアントより長く生きる状態
+    
+    ジョブキュー・セッション・キャッシュなどを保持し、再接続でDevBotを
+    作り直しても実行中・待ちのジョブはそのまま引き継がれる
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        # 再起動が必要な項目の比較用（起動時の設定）
+        self.initial_config = config
+        self.start_time = datetime.now()
+        self.bot = None
+        self.connected = asyncio.Event()
+        # restartコマンド・トレイから再起動を求められた（main終了後に起動し直す）
+        self.restart_requested = False
+        # 停止・再起動の準備中（新しいジョブを開始しない）・準備完了
+        self.draining = False
+        self.drained = asyncio.Event()
+        
+        # プロジェクト一覧（チャンネル・--projectで振り分け）
+        self.projects = ProjectRegistry(config)
+        
+        # ジョブキュー（全体・プロジェクト単位の同時実行数を制限）
+        # 実行は常にその時点のDevBotに任せる
+        self.scheduler = JobScheduler(
+            JobStore(DATA_DIR / 'jobs.db'),
+            self._run_job,
+            max_workers=config.max_workers,
+            batch_workers=config.batch_concurrency,
+            project_limit=lambda name: self.projects.limit(name),
+            fair_share=FairShare(half_life=config.fair_share_half_life, weights=config.user_weights)
+        )
+        
+        # ユーザー・チャンネルごとの実行頻度の制限
+        self.rate_limiter = RateLimiter(config)
+        self.scheduler.on_queue_change = self._on_queue_change
+        self.scheduler.on_finish = self._on_job_finished
+        # 実行中の!dev batch（バッチ番号→BatchRun）
+        self.batches = {}
+        
+        # 出力の送信方法（文字数に応じて分割・添付）
+        self.delivery = OutputDelivery(
+            inline_limit=config.output_inline_limit,
+            attachment_limit=config.attachment_limit
+        )
+        
+        # チャンネル/スレッドごとのClaudeセッション（--resume用）
+        self.sessions = SessionManager(
+            max_sessions=config.max_sessions,
+            idle_ttl=config.session_idle_ttl
+        )
+        
+        # claudeコマンドのパス解決キャッシュ
+        self.claude_resolver = CommandResolver(
+            'claude',
+            ttl=config.claude_resolve_ttl,
+            cache_file=DATA_DIR / 'resolver_cache.json'
+        )
+        
+        # askの結果キャッシュ（同じ質問・同じ作業ツリーなら再実行しない）
+        self.result_cache = ResultCache(
+            DATA_DIR / 'result_cache.db',
+            max_bytes=config.result_cache_size
+        )
+        self.claude_versions = {}
+        
+        # Claude実行の履歴（!dev history・show・usage）
+        self.runs = RunHistory(DATA_DIR / 'runs.db')
+        
+        # 停止・再起動で中断したジョブの途中までの出力（次回起動時に報告・再実行）
+        self.checkpoints = CheckpointStore(DATA_DIR / 'checkpoints')
+        
+        # Claude子プロセスの資源制限（cgroup v2が使えなければrlimit）
+        self.cgroups = CgroupManager.create() if config.cgroups else None
+        if config.cgroups is True and self.cgroups is None:
+            logger.warning("cgroups: true ですがcgroup v2を利用できないためrlimitで制限します")
+        
+        # implement後のコミットと（まとめて行う）push
+        self.git = GitPipeline(
+            self,
+            remote=config.git_remote,
+            window=config.push_window,
+            timeout=config.git_push_timeout
+        )
+        
+        # Claudeに渡すリポジトリ概要（context_prefetch、HEADが変わった分だけ更新）
+        self.context = RepoContext(
+            max_chars=config.context_max_chars,
+            interval=config.context_refresh_interval
+        )
+        
+        # 環境の定期診断（mainで開始、diagnose・statusは最新の結果を返す）
+        self.health = HealthMonitor(
+            self,
+            interval=config.health_check_interval,
+            timeout=config.health_check_timeout
+        )
+        
+        # config.jsonの変更を監視して反映（mainで開始）
+        self.watcher = ConfigWatcher(CONFIG_FILE, self.apply_config, interval=config.config_reload_interval)
+    
+    def pending_restart(self):
+        """変更済みだが再起動するまで反映されない項目"""
+        return [
+            name for name in Settings.RESTART_REQUIRED
+            if getattr(self.config, name) != getattr(self.initial_config, name)
+        ]
+    
+    async def apply_config(self, config):
+        """
+        新しい設定に差し替える（接続・実行中のジョブはそのまま）
+        
+        変更された項目名を返す
+        """
+        changed = self.config.changed_fields(config)
+        if not changed:
+            return changed
+        self.config = config
+        
+        if {'project_dir', 'project_concurrency', 'projects'} & set(changed):
+            # 実行中のジョブはJobが持つproject_dirで動き続ける
+            self.projects = ProjectRegistry(config)
+        self.delivery.inline_limit = config.output_inline_limit
+        self.delivery.attachment_limit = config.attachment_limit
+        self.sessions.max_sessions = config.max_sessions
+        self.sessions.idle_ttl = config.session_idle_ttl
+        self.claude_resolver.ttl = config.claude_resolve_ttl
+        self.result_cache.max_bytes = config.result_cache_size
+        self.rate_limiter.configure(config)
+        self.scheduler.fair_share.half_life = config.fair_share_half_life
+        self.scheduler.fair_share.weights = config.user_weights
+        self.watcher.interval = config.config_reload_interval
+        self.git.remote = config.git_remote
+        self.git.window = config.push_window
+        self.git.timeout = config.git_push_timeout
+        self.context.max_chars = config.context_max_chars
+        self.context.interval = config.context_refresh_interval
+        self.health.interval = config.health_check_interval
+        self.health.timeout = config.health_check_timeout
+        configure_logging(config)
+        if self.bot is not None:
+            self.bot.apply_config(config)
+        # 同時実行数が増えた場合は待ちジョブをすぐ開始
+        await self.scheduler.resize(config.max_workers, config.batch_concurrency)
+        
+        restart = [name for name in changed if name in self.pending_restart()]
+        logger.info(f"設定を再読み込み: {', '.join(changed)}")
+        if restart:
+            logger.warning(f"再起動後に反映される項目: {', '.join(restart)}")
+        return changed
+    
+    async def claude_version(self):
+        """claude --version の結果（実行ファイルが更新されるまで再取得しない）"""
+        path = self.claude_resolver.resolve()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        cached = self.claude_versions.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        result = await run_process([path, '--version'], timeout=10)
+        if result.returncode != 0 or not result.stdout.strip():
+            raise Exception(result.stderr.strip() or f"終了コード {result.returncode}")
+        version = result.stdout.strip()
+        self.claude_versions[path] = (mtime, version)
+        return version
+    
+    def attach(self, bot):
+        """新しいクライアントを現在のBotにする（接続完了まではconnectedを下ろす）"""
+        self.bot = bot
+        self.set_connected(False)
+    
+    def set_connected(self, connected):
+        if connected:
+            self.connected.set()
+        else:
+            self.connected.clear()
+        metrics.set('devbot_connected', 1 if connected else 0)
+    
+    async def channel(self, channel_id, timeout=600):
+        """現在のクライアントでチャンネルを取得（再接続中なら接続を待つ）"""
+        await asyncio.wait_for(self.connected.wait(), timeout)
+        bot = self.bot
+        return bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+    
+    async def _run_job(self, job):
+        await asyncio.wait_for(self.connected.wait(), 600)
+        await self.bot.execute_job(job)
+    
+    async def _on_queue_change(self, job, position):
+        if self.bot is not None and self.connected.is_set():
+            await self.bot._on_queue_change(job, position)
+    
+    async def _on_job_finished(self, job):
+        """バッチのタスクが終わったら進捗を更新し、全件終わったら結果をまとめて送る"""
+        batch = self.batches.get(job.batch_id) if job.batch_id else None
+        if batch is None:
+            return
+        batch.touch()
+        if not batch.finished:
+            return
+        del self.batches[batch.id]
+        await batch.close()
+        counts = batch.counts()
+        logger.info(f"バッチ#{batch.id} 終了: {counts}")
+        channel = await self.channel(batch.channel_id)
+        await self.delivery.deliver(channel, batch.report_embed(), batch.report(), filename=f"batch_{batch.id}.md")
+    
+    async def drain(self, timeout):
+        """
+        停止・再起動の前に実行中のジョブを片付ける（2回目以降の呼び出しは1回目の完了を待つだけ）
+        
+        新しいジョブの開始を止めて実行中のジョブをtimeout秒まで待ち、終わらなければ
+        途中までの出力を保存して中断する（次回起動時に待ちへ戻して再実行）。
+        最後に予約済みのpushを待たずに行う
+        """
+        if self.draining:
+            await self.drained.wait()
+            return
+        self.draining = True
+        try:
+            running = len(self.scheduler.running)
+            if running:
+                logger.info(f"実行中のジョブ{running}件の終了を最大{timeout:g}秒待ちます")
+            left = await self.scheduler.drain(timeout)
+            if left:
+                logger.warning(f"終了しなかったジョブを中断し、次回起動時に再実行します: "
+                               f"{', '.join(f'#{job.id}' for job in left)}")
+                await self.scheduler.interrupt()
+            await self.git.flush()
+        finally:
+            self.drained.set()
+    
+    def close(self):
+        self.scheduler.store.close()
+        self.result_cache.close()
+        self.runs.close()
+
+
+def build_intents(config):
+    """
+    必要なGatewayインテントだけを有効にする
+    
+    プレフィックスコマンドを使わなければメッセージ関連のイベントを受け取らない
+    （特権インテントのmessage_contentも不要になる）
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True  # チャンネル・スレッドのキャッシュ（get_channel）
+    if config.prefix_commands:
+        intents.guild_messages = True
+        intents.dm_messages = True
+        intents.message_content = True
+    return intents
+
+
+class InteractionReply:
+    """
+    スラッシュコマンドへの返信先（チャンネルと同じsend()で使える）
+    
+    defer済みのinteractionに対し、トークンが有効な間（15分）はフォローアップの
+    Webhookで返信する。期限が近づいたら通常のチャンネル送信に切り替える
+    """
+    
+    TOKEN_LIFETIME = 15 * 60
+    MARGIN = 30
+    
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.channel = interaction.channel
+        self.id = interaction.channel_id
+        self.parent_id = getattr(interaction.channel, 'parent_id', None)
+        self.expires_at = interaction.created_at.timestamp() + self.TOKEN_LIFETIME
+    
+    def remaining(self):
+        """トークンの残り秒数"""
+        return self.expires_at - time.time()
+    
+    async def send(self, content=None, *, embed=None, file=None):
+        if self.remaining() < self.MARGIN:
+            return await self.channel.send(content, embed=embed, file=file)
+        params = {name: value for name, value in (('content', content), ('embed', embed), ('file', file))
+                  if value is not None}
+        return await self.interaction.followup.send(wait=True, **params)
+
+
+class InteractionContext:
+    """スラッシュコマンドからプレフィックスコマンドの処理を呼ぶためのcommands.Context相当"""
+    
+    def __init__(self, bot, interaction):
+        self.bot = bot
+        self.interaction = interaction
+        self.reply = InteractionReply(interaction)
+        self.channel = interaction.channel
+        self.author = interaction.user
+    
+    async def send(self, content=None, **kwargs):
+        return await self.reply.send(content, **kwargs)
+    
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        # defer(thinking=True) で「考え中…」が表示されている
+        yield
+
+
+class DevBot(commands.Bot):
+    """開発支援Discord Bot"""
+    
+    # 停止・再起動で中断したジョブを同じ作業ツリーで再実行するときに指示の前に付ける
+    RESUME_NOTE = (
+        "（この作業は前回、Botの停止・再起動で中断されました。作業ツリーに途中までの変更が"
+        "残っている場合があるため、現在の状態を確認してから続きを行ってください）"
+    )
+    
+    def __init__(self, config, tray_icon, services=None):
+        intents = build_intents(config)
+        
+        super().__init__(
+            command_prefix=config.command_prefix,
+            intents=intents
+        )
+        
+        self.tray_icon = tray_icon
+        self.is_shutting_down = False
+        
+        # ジョブキュー・設定等は再接続を跨いで引き継ぐ
+        self.services = services or BotServices(config)
+        self.services.attach(self)
+        self.start_time = self.services.start_time
+        # 受付メッセージはこのクライアントで送ったものだけ編集できる
+        self._queue_messages = {}
+        # スラッシュコマンドで受け付けたジョブの返信先（ジョブID→InteractionReply）
+        self._interactions = {}
+        
+        # ゲートウェイレイテンシの定期サンプリング
+        self.latency_sampler = tasks.loop(
+            seconds=config.latency_sample_interval
+        )(self._sample_latency)
+        
+        # コマンド登録
+        self.add_commands()
+        if config.slash_commands:
+            self.add_app_commands()
+        
+        logger.info("Bot初期化完了")
+    
+    # 設定・ジョブキュー等はBotServicesのものを参照（設定の再読み込みで差し替わる）
+    @property
+    def config(self):
+        return self.services.config
+    
+    @property
+    def projects(self):
+        return self.services.projects
+    
+    @property
+    def scheduler(self):
+        return self.services.scheduler
+    
+    @property
+    def delivery(self):
+        return self.services.delivery
+    
+    @property
+    def sessions(self):
+        return self.services.sessions
+    
+    @property
+    def claude_resolver(self):
+        return self.services.claude_resolver
+    
+    @property
+    def result_cache(self):
+        return self.services.result_cache
+    
+    def apply_config(self, config):
+        """クライアント側の設定を反映"""
+        self.command_prefix = config.command_prefix
+        self.latency_sampler.change_interval(seconds=config.latency_sample_interval)
+    
+    def _drain_note(self):
+        """stop・restartの返信に添える、実行中のジョブの扱い"""
+        running = len(self.scheduler.running)
+        if not running:
+            return ''
+        return (f"\n実行中のジョブ{running}件の終了を最大{self.config.drain_timeout:g}秒待ちます"
+                "（終わらなければ中断して次回起動時に再実行）。")
+    
+    async def shutdown(self, restart=False):
+        """実行中のジョブを片付けてからBotを終了（restart=Trueならmain終了後に起動し直す）"""
+        self.is_shutting_down = True
+        self.services.restart_requested = restart
+        await self.services.drain(self.config.drain_timeout)
+        await self.close()
+        
+        # トレイアイコンも終了
+        if self.tray_icon:
+            self.tray_icon.stop()
+    
+    def add_commands(self):
+        """コマンド登録"""
+        
+        @self.command(name='implement')
+        async def implement(ctx, *, content: str):
+            """Claude Codeで実装を実行（ジョブキュー経由）"""
+            logger.info(f"implement コマンド実行: {content[:50]}...")
+            
+            flags, content = parse_command_flags(content, {'priority': True, 'project': True})
+            try:
+                priority = int(flags.get('priority', 0))
+            except ValueError:
+                await ctx.send("❌ `--priority` には整数を指定してください。")
+                return
+            if not content:
+                await ctx.send("❌ 実装内容を指定してください。")
+                return
+            try:
+                project = self.projects.resolve(
+                    flags.get('project'),
+                    (ctx.channel.id, getattr(ctx.channel, 'parent_id', None))
+                )
+            except KeyError as e:
+                await ctx.send(f"❌ プロジェクト {e} は登録されていません。`{self.config.command_prefix}projects` で確認してください。")
+                return
+            
+            # レート制限（deferなら受け付けて開始を遅らせる）
+            defer = self.config.rate_limit_action == 'defer'
+            wait, scope = self.services.rate_limiter.check(ctx.author.id, ctx.channel.id, defer=defer)
+            if wait > 0 and not defer:
+                metrics.inc('devbot_rate_limited_total', scope=scope, action='rejected')
+                await ctx.send(embed=self._rate_limit_embed(wait, scope))
+                return
+            
+            job = Job(
+                id=None,
+                prompt=content,
+                project_dir=project.path,
+                channel_id=ctx.channel.id,
+                author_id=ctx.author.id,
+                author_name=str(ctx.author),
+                project=project.name,
+                priority=priority,
+                not_before=time.time() + wait if wait > 0 else None
+            )
+            position = await self.scheduler.submit(job)
+            if isinstance(ctx, InteractionContext):
+                # 進捗と結果もスラッシュコマンドへのフォローアップとして返す
+                self._interactions[job.id] = ctx.reply
+            embed = None
+            if wait > 0:
+                metrics.inc('devbot_rate_limited_total', scope=scope, action='deferred')
+                embed = self._rate_limit_embed(wait, scope, job)
+            if position:
+                # 停止・再起動の準備中は開始せず、待ちジョブとして次回起動時に実行する
+                note = "\n⏸️ 停止・再起動の準備中のため、次回起動後に開始します" if self.services.draining else ''
+                message = await ctx.send(
+                    f"📥 ジョブ #{job.id} を受け付けました（待ち順: {position}）{note}\n"
+                    f"取り消し: `{self.config.command_prefix}cancel {job.id}`",
+                    embed=embed
+                )
+                if self.scheduler.position(job.id):
+                    self._queue_messages[job.id] = (message, position)
+            elif isinstance(ctx, InteractionContext):
+                # deferした応答はここで返しておく（結果をチャンネルへ送る場合も「考え中…」のまま残さない）
+                await ctx.send(
+                    f"📥 ジョブ #{job.id} を受け付けました。まもなく開始します\n"
+                    f"取り消し: `{self.config.command_prefix}cancel {job.id}`",
+                    embed=embed
+                )
+        
+        @self.command(name='batch')
+        async def batch(ctx, *, content: str = ''):
+            """複数の実装タスクを専用worktreeで並列実行（1行1タスク、またはYAML/JSON/テキストを添付）"""
+            logger.info(f"batch コマンド実行: {content[:50]}...")
+            
+            first, _, body = content.strip().partition('\n')
+            command, _, argument = first.strip().partition(' ')
+            if command == 'cancel':
+                await self._cancel_batch(ctx, argument.strip())
+                return
+            if self.services.draining:
+                await ctx.send("⏸️ 停止・再起動の準備中のため、新しいバッチは受け付けられません。")
+                return
+            flags, first = parse_command_flags(first, {'priority': True, 'project': True})
+            try:
+                priority = int(flags.get('priority', 0))
+            except ValueError:
+                await ctx.send("❌ `--priority` には整数を指定してください。")
+                return
+            
+            # 本文と添付ファイルからタスクを集める
+            try:
+                tasks = parse_batch_tasks('\n'.join(part for part in (first, body) if part.strip()))
+                for attachment in ctx.message.attachments:
+                    if attachment.size > 1024 * 1024:
+                        raise ValueError(f"{attachment.filename}: 1MBを超える添付は読み込めません")
+                    data = await attachment.read()
+                    tasks += parse_batch_tasks(data.decode('utf-8', errors='replace'), attachment.filename)
+            except ValueError as e:
+                await ctx.send(f"❌ タスク一覧を読み込めません: {e}")
+                return
+            if not tasks:
+                await ctx.send(
+                    "❌ タスクを指定してください（1行1タスク、またはYAML/JSON/テキストファイルを添付）。\n"
+                    f"例: `{self.config.command_prefix}batch`の後に改行して `- モジュールAに型ヒントを追加` を並べる"
+                )
+                return
+            if len(tasks) > self.config.batch_max_tasks:
+                await ctx.send(f"❌ 1回のバッチは{self.config.batch_max_tasks}件までです（{len(tasks)}件）。")
+                return
+            
+            # タスクごとのプロジェクト（指定がなければ--project・チャンネルから決める）
+            location = (ctx.channel.id, getattr(ctx.channel, 'parent_id', None))
+            try:
+                projects = [self.projects.resolve(name or flags.get('project'), location) for _, name in tasks]
+            except KeyError as e:
+                await ctx.send(f"❌ プロジェクト {e} は登録されていません。`{self.config.command_prefix}projects` で確認してください。")
+                return
+            for project in {project.name: project for project in projects}.values():
+                # 各タスクはworktreeで分離して実行するためgitリポジトリが必要
+                check = await run_process(['git', 'rev-parse', '--is-inside-work-tree'], cwd=project.path, timeout=30)
+                if check.returncode != 0:
+                    await ctx.send(f"❌ プロジェクト {project.name} (`{project.path}`) はgitリポジトリではありません。")
+                    return
+            
+            # レート制限はタスク1件につき1回分
+            defer = self.config.rate_limit_action == 'defer'
+            wait, scope = self.services.rate_limiter.check(ctx.author.id, ctx.channel.id,
+                                                           defer=defer, cost=len(tasks))
+            if wait == math.inf:
+                metrics.inc('devbot_rate_limited_total', scope=scope, action='rejected')
+                who = "あなた" if scope == 'user' else "このチャンネル"
+                await ctx.send(f"❌ {len(tasks)}件は{who}のレート制限（連続実行の上限）を超えるため実行できません。"
+                               "タスクを分けて投入してください。")
+                return
+            if wait > 0 and not defer:
+                metrics.inc('devbot_rate_limited_total', scope=scope, action='rejected')
+                await ctx.send(embed=self._rate_limit_embed(wait, scope))
+                return
+            if wait > 0:
+                metrics.inc('devbot_rate_limited_total', scope=scope, action='deferred')
+            
+            batch_id = await asyncio.to_thread(self.scheduler.store.add_batch, ctx.channel.id, ctx.author.id)
+            jobs = [
+                Job(
+                    id=None,
+                    prompt=prompt,
+                    project_dir=project.path,
+                    channel_id=ctx.channel.id,
+                    author_id=ctx.author.id,
+                    author_name=str(ctx.author),
+                    project=project.name,
+                    priority=priority,
+                    not_before=time.time() + wait if wait > 0 else None,
+                    batch_id=batch_id
+                )
+                for (prompt, _), project in zip(tasks, projects)
+            ]
+            run = BatchRun(
+                batch_id,
+                jobs,
+                channel_id=ctx.channel.id,
+                interval=self.config.stream_edit_interval,
+                prefix=self.config.command_prefix
+            )
+            # 登録より先に開始したタスクも結果をBatchRunに記録できるよう先に登録
+            self.services.batches[batch_id] = run
+            for job in jobs:
+                await self.scheduler.submit(job)
+            logger.info(f"バッチ#{batch_id} 受付: {len(jobs)}件（同時実行 {self.scheduler.batch_workers}）")
+            await run.start(ctx.channel)
+        
+        @self.command(name='ask')
+        async def ask(ctx, *, content: str):
+            """読み取り専用でClaude Codeに質問（同じ質問・同じ作業ツリーなら結果を再利用）"""
+            logger.info(f"ask コマンド実行: {content[:50]}...")
+            
+            flags, content = parse_command_flags(content, {'project': True, 'no-cache': False})
+            if not content:
+                await ctx.send("❌ 質問内容を指定してください。")
+                return
+            if self.services.draining:
+                await ctx.send("⏸️ 停止・再起動の準備中のため、質問は受け付けられません。")
+                return
+            try:
+                project = self.projects.resolve(
+                    flags.get('project'),
+                    (ctx.channel.id, getattr(ctx.channel, 'parent_id', None))
+                )
+            except KeyError as e:
+                await ctx.send(f"❌ プロジェクト {e} は登録されていません。`{self.config.command_prefix}projects` で確認してください。")
+                return
+            
+            key = state = None
+            if self.config.result_cache and not flags.get('no-cache'):
+                key, state = await self._ask_cache_key(content, project.path)
+            result = None
+            if key:
+                result = await asyncio.to_thread(self.result_cache.get, key)
+                metrics.inc('devbot_result_cache_total', result='hit' if result is not None else 'miss')
+            else:
+                metrics.inc('devbot_result_cache_total', result='bypass')
+            
+            cached = result is not None
+            if not cached:
+                # askは待たせられないため、制限中は断る
+                wait, scope = self.services.rate_limiter.check(ctx.author.id, ctx.channel.id)
+                if wait > 0:
+                    metrics.inc('devbot_rate_limited_total', scope=scope, action='rejected')
+                    await ctx.send(embed=self._rate_limit_embed(wait, scope))
+                    return
+                timer = StageTimer()
+                # 履歴に残すためのジョブ（キューには入れない）
+                job = Job(
+                    id=None,
+                    prompt=content,
+                    project_dir=project.path,
+                    channel_id=ctx.channel.id,
+                    author_id=ctx.author.id,
+                    author_name=str(ctx.author),
+                    project=project.name
+                )
+                try:
+                    async with ctx.typing():
+                        result = await self.run_claude_code(content, cwd=project.path, timer=timer,
+                                                            read_only=True, job=job)
+                except Exception as e:
+                    embed = discord.Embed(
+                        title="❌ エラー発生",
+                        description=f"```\n{str(e)[:4000]}\n```",
+                        color=discord.Color.red(),
+                        timestamp=datetime.now()
+                    )
+                    await ctx.send(embed=embed)
+                    return
+                if key:
+                    await asyncio.to_thread(self.result_cache.put, key, project.path, state, result)
+            
+            embed = discord.Embed(
+                title="💬 回答",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            embed.add_field(name="質問", value=content[:1024], inline=False)
+            embed.add_field(name="プロジェクト", value=f"{project.name} (`{project.path}`)", inline=False)
+            if cached:
+                embed.set_footer(text="💾 キャッシュから応答（--no-cache で再実行）")
+            elif timer.telemetry is not None:
+                embed.add_field(name="使用量", value=timer.telemetry.summary(), inline=False)
+            await self.delivery.deliver(ctx.channel, embed, result, filename='claude_answer.txt')
+        
+        @self.command(name='projects')
+        async def projects(ctx):
+            """登録プロジェクトの一覧を表示"""
+            logger.info("projects コマンド実行")
+            
+            embed = discord.Embed(
+                title="📁 プロジェクト一覧",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            for project in list(self.projects.projects.values())[:25]:
+                channels = ' '.join(f"<#{c}>" for c in project.channels) or "なし（--project で指定）"
+                running = self.scheduler.running_in_project(project.name)
+                embed.add_field(
+                    name=project.name,
+                    value=(
+                        f"`{project.path}`\n"
+                        f"チャンネル: {channels}\n"
+                        f"同時実行: {running}/{project.concurrency}"
+                        + (" / worktree分離" if project.worktrees else "")
+                    ),
+                    inline=False
+                )
+            await ctx.send(embed=embed)
+        
+        @self.command(name='metrics')
+        async def show_metrics(ctx):
+            """実行統計を表示"""
+            logger.info("metrics コマンド実行")
+            
+            embed = discord.Embed(
+                title="📈 メトリクス",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            
+            stage_lines = []
+            for labels, hist in metrics.series('devbot_stage_seconds'):
+                p50 = Metrics.quantile(hist, 0.5)
+                p95 = Metrics.quantile(hist, 0.95)
+                stage_lines.append(
+                    f"`{labels['stage']}` p50 {p50:.2f}s / p95 {p95:.2f}s / {hist['count']}回"
+                )
+            embed.add_field(name="段階別所要時間", value='\n'.join(stage_lines) or "データなし", inline=False)
+            
+            runs = metrics.series('devbot_claude_runs_total')
+            run_str = ' / '.join(f"exit {labels['exit_code']}: {value}" for labels, value in runs)
+            timeouts = metrics.get('devbot_claude_timeouts_total') or 0
+            embed.add_field(name="Claude実行", value=f"{run_str or 'なし'}\nタイムアウト: {timeouts}", inline=False)
+            
+            jobs = metrics.series('devbot_jobs_total')
+            embed.add_field(
+                name="ジョブ",
+                value=' / '.join(f"{labels['status']}: {value}" for labels, value in jobs) or "なし",
+                inline=False
+            )
+            
+            limited = metrics.series('devbot_rate_limited_total')
+            if limited:
+                embed.add_field(
+                    name="レート制限",
+                    value=' / '.join(
+                        f"{'ユーザー' if labels['scope'] == 'user' else 'チャンネル'}"
+                        f"{'拒否' if labels['action'] == 'rejected' else '延期'}: {value}"
+                        for labels, value in limited
+                    ),
+                    inline=False
+                )
+            
+            output = metrics.get('devbot_output_chars')
+            if output and output['count']:
+                embed.add_field(
+                    name="出力サイズ",
+                    value=f"平均 {output['sum'] / output['count']:.0f}文字 / p95 {Metrics.quantile(output, 0.95):.0f}文字",
+                    inline=False
+                )
+            
+            latency = metrics.get('devbot_gateway_latency_seconds')
+            if latency and latency['count']:
+                embed.add_field(
+                    name="ゲートウェイレイテンシ",
+                    value=f"p50 {Metrics.quantile(latency, 0.5) * 1000:.0f}ms / p95 {Metrics.quantile(latency, 0.95) * 1000:.0f}ms",
+                    inline=False
+                )
+            
+            await ctx.send(embed=embed)
+        
+        @self.command(name='usage')
+        async def show_usage(ctx, days: int = 7):
+            """Claude実行のコスト・所要時間の日別推移を表示"""
+            logger.info("usage コマンド実行")
+            
+            days = max(1, min(days, 90))
+            rows = await asyncio.to_thread(self.services.runs.daily, days)
+            embed = discord.Embed(
+                title=f"💰 Claude使用量（直近{days}日）",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            if not rows:
+                embed.description = "実行履歴がありません。"
+                await ctx.send(embed=embed)
+                return
+            
+            lines = []
+            for row in rows:
+                line = f"`{row['day']}` {row['runs']}回"
+                if row['failed']:
+                    line += f"（失敗{row['failed']}）"
+                line += f" / 平均{row['avg_duration']:.1f}秒 最長{row['max_duration']:.1f}秒"
+                if row['avg_first_byte'] is not None:
+                    line += f" / 初回出力{row['avg_first_byte']:.1f}秒"
+                if row['avg_turns'] is not None:
+                    line += f" / {row['avg_turns']:.1f}ターン"
+                if row['input_tokens'] is not None:
+                    line += f" / 入力{format_tokens(row['input_tokens'])} 出力{format_tokens(row['output_tokens'])}"
+                if row['cost_usd'] is not None:
+                    line += f" / ${row['cost_usd']:.2f}"
+                lines.append(line)
+            embed.description = '\n'.join(lines)[:4000]
+            
+            total_runs = sum(row['runs'] for row in rows)
+            total_cost = sum(row['cost_usd'] or 0 for row in rows)
+            embed.add_field(
+                name="合計",
+                value=f"{total_runs}回 / ${total_cost:.2f}（1回平均 ${total_cost / total_runs:.4f}）",
+                inline=False
+            )
+            if self.config.claude_output_format == 'text':
+                embed.set_footer(text="進捗表示のない実行（ask・batch）はtext形式のためコスト・トークン数が記録されません（claude_output_format）")
+            await ctx.send(embed=embed)
+        
+        @self.command(name='history')
+        async def history(ctx, *, query: str = ''):
+            """実行履歴を新しい順に表示（検索語を指定すると指示・出力を全文検索）"""
+            logger.info(f"history コマンド実行: {query[:50]}")
+            
+            flags, query = parse_command_flags(query, {'before': True})
+            try:
+                before = int(flags['before'].lstrip('#')) if 'before' in flags else None
+            except ValueError:
+                await ctx.send("❌ `--before` には履歴番号を指定してください。")
+                return
+            runs = self.services.runs
+            # 直前に終わった実行も見えるよう書き込み待ちを済ませてから読む
+            await asyncio.to_thread(runs.flush)
+            page_size = 10
+            rows = await asyncio.to_thread(runs.search, query, before=before, limit=page_size)
+            
+            embed = discord.Embed(
+                title="📜 実行履歴" + (f"「{query[:50]}」" if query else ""),
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            if not rows:
+                embed.description = "該当する実行はありません。"
+                await ctx.send(embed=embed)
+                return
+            
+            lines = []
+            for run in rows:
+                icon = '✅' if run['exit_code'] == 0 else '⏱️' if run['exit_code'] is None else '❌'
+                started = datetime.fromtimestamp(run['started_at']).strftime('%m/%d %H:%M')
+                line = f"`#{run['id']}` {icon} {started} {run['kind'] or '-'} {run['project'] or '-'} {run['duration']:.0f}秒"
+                if run['cost_usd'] is not None:
+                    line += f" ${run['cost_usd']:.2f}"
+                if run['author']:
+                    line += f" ({run['author']})"
+                prompt = ' '.join(run['prompt'].split())
+                lines.append(f"{line}\n　{prompt[:80] or '-'}")
+            embed.description = '\n'.join(lines)[:4000]
+            
+            prefix = self.config.command_prefix
+            footer = f"詳細: {prefix}show <番号>"
+            if len(rows) == page_size:
+                footer += f" / 続き: {prefix}history --before {rows[-1]['id']} {query}".rstrip()
+            embed.set_footer(text=footer)
+            await ctx.send(embed=embed)
+        
+        @self.command(name='show')
+        async def show(ctx, run_id: str):
+            """実行履歴の1件を出力の全文付きで表示"""
+            logger.info(f"show コマンド実行: {run_id}")
+            
+            try:
+                run_id = int(run_id.lstrip('#'))
+            except ValueError:
+                await ctx.send("❌ 履歴番号を指定してください。")
+                return
+            runs = self.services.runs
+            await asyncio.to_thread(runs.flush)
+            run = await asyncio.to_thread(runs.get, run_id)
+            if run is None:
+                await ctx.send(f"❌ 履歴 #{run_id} はありません。")
+                return
+            
+            if run['exit_code'] == 0:
+                title, color = f"📜 実行 #{run_id}", discord.Color.green()
+            elif run['exit_code'] is None:
+                title, color = f"⏱️ 実行 #{run_id}（タイムアウト）", discord.Color.orange()
+            else:
+                title, color = f"❌ 実行 #{run_id}（終了コード {run['exit_code']}）", discord.Color.red()
+            embed = discord.Embed(
+                title=title,
+                color=color,
+                timestamp=datetime.fromtimestamp(run['started_at'])
+            )
+            embed.add_field(name="指示", value=run['prompt'][:1024] or "-", inline=False)
+            embed.add_field(
+                name="プロジェクト",
+                value=f"{run['project'] or '-'} (`{run['project_dir']}`)"[:1024],
+                inline=False
+            )
+            origin = run['kind'] or '-'
+            if run['job_id']:
+                origin += f" / ジョブ #{run['job_id']}"
+            if run['author']:
+                origin += f" / {run['author']}"
+            embed.add_field(name="種別", value=origin, inline=True)
+            embed.add_field(name="開始", value=f"<t:{int(run['started_at'])}:f>", inline=True)
+            timings = ' / '.join(f"{stage} {seconds:.2f}s" for stage, seconds in run['timings'].items())
+            embed.add_field(
+                name="所要時間",
+                value=f"{run['duration']:.1f}秒" + (f"（{timings}）" if timings else ""),
+                inline=False
+            )
+            if run['input_tokens'] is not None:
+                telemetry = RunTelemetry(
+                    cost_usd=run['cost_usd'],
+                    turns=run['turns'],
+                    api_duration_ms=run['api_duration'] * 1000 if run['api_duration'] is not None else None,
+                    input_tokens=run['input_tokens'],
+                    output_tokens=run['output_tokens'],
+                    cache_read_tokens=run['cache_read_tokens'],
+                    cache_write_tokens=run['cache_write_tokens'],
+                    model=run['model']
+                )
+                embed.add_field(name="使用量", value=telemetry.summary(), inline=False)
+            await self.delivery.deliver(ctx.channel, embed, run['output'] or "（出力なし）",
+                                        filename=f"run_{run_id}.txt")
+        
+        @self.command(name='config')
+        async def show_config(ctx, *, options: str = ''):
+            """現在有効な設定を表示（--reload でconfig.jsonを再読み込み）"""
+            logger.info("config コマンド実行")
+            
+            flags, _ = parse_command_flags(options, {'reload': False})
+            watcher = self.services.watcher
+            if flags.get('reload'):
+                old = self.config
+                if await watcher.reload() is None:
+                    await ctx.send(f"❌ config.jsonを読み込めません（現在の設定を維持）:\n```\n{watcher.last_error[:1800]}\n```")
+                    return
+                changed = old.changed_fields(self.config)
+                await ctx.send(f"🔄 再読み込みしました（変更: {', '.join(changed) or 'なし'}）")
+            
+            lines = []
+            for name, value in self.config.to_dict().items():
+                if name == 'discord_token':
+                    value = '********' if value else '(未設定)'
+                elif name == 'projects':
+                    value = ', '.join(value) or 'なし'
+                else:
+                    value = json.dumps(value, ensure_ascii=False)
+                lines.append(f"{name} = {value}")
+            
+            embed = discord.Embed(
+                title="⚙️ 現在の設定",
+                description="```ini\n" + '\n'.join(lines)[:3900] + "\n```",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            embed.add_field(name="設定ファイル", value=f"`{CONFIG_FILE}`", inline=False)
+            if watcher.interval > 0:
+                reload_str = f"{watcher.interval:g}秒ごとに変更を確認"
+            else:
+                reload_str = "自動再読み込み無効"
+            if watcher.last_reload:
+                reload_str += f" / 最終再読み込み: {watcher.last_reload.strftime('%Y-%m-%d %H:%M:%S')}"
+            embed.add_field(name="再読み込み", value=reload_str, inline=False)
+            pending = self.services.pending_restart()
+            if pending:
+                embed.add_field(name="⚠️ 再起動後に反映", value=', '.join(pending), inline=False)
+            if watcher.last_error:
+                embed.add_field(name="❌ 直近の読み込みエラー", value=watcher.last_error[:1024], inline=False)
+            await ctx.send(embed=embed)
+        
+        @self.command(name='new')
+        async def new_session(ctx):
+            """このチャンネルのClaudeセッションをリセット"""
+            logger.info("new コマンド実行")
+            
+            count = self.sessions.reset_channel(ctx.channel.id)
+            if count:
+                await ctx.send("🆕 セッションをリセットしました。次の実装は新しい会話で開始します。")
+            else:
+                await ctx.send("ℹ️ このチャンネルに継続中のセッションはありません。")
+        
+        @self.command(name='queue')
+        async def queue(ctx):
+            """ジョブキューの状況を表示"""
+            logger.info("queue コマンド実行")
             
-            await ctx.send("🤖 実装を開始します...")
+            embed = discord.Embed(
+                title="📋 ジョブキュー",
+                color=discord.Color.blue(),
+                timestamp=datetime.now()
+            )
+            running = [job for job, _ in self.scheduler.running.values()]
+            running_lines = [
+                f"{'📦' if job.batch_id else ''}#{job.id} {job.prompt[:50]} ({job.author_name}, {int(time.time() - job.started_at)}秒経過)"
+                for job in running
+            ]
+            queued_lines = [
+                f"{index + 1}. {'📦' if job.batch_id else ''}#{job.id} {job.prompt[:50]} ({job.author_name})"
+                + (f" ⏳<t:{int(job.not_before)}:R>" if job.not_before and job.not_before > time.time() else "")
+                for index, job in enumerate(self.scheduler.ordered_queue()[:15])
+            ]
+            batches = self.scheduler.running_batches()
+            embed.add_field(
+                name=f"実行中 ({len(running)}/{self.scheduler.max_workers}"
+                     f"・うちバッチ {batches}/{self.scheduler.batch_workers})",
+                value='\n'.join(running_lines) or "なし",
+                inline=False
+            )
+            embed.add_field(
+                name=f"待ち ({len(self.scheduler.queued)})",
+                value='\n'.join(queued_lines) or "なし",
+                inline=False
+            )
+            await ctx.send(embed=embed)
+        
+        @self.command(name='cancel')
+        async def cancel(ctx, job_id: int):
+            """ジョブを取り消し"""
+            logger.info(f"cancel コマンド実行: #{job_id}")
             
-            try:
-                # プロジェクトディレクトリに移動
-                os.chdir(self.config['project_dir'])
-                
-                # Claude Code実行
-                result = await self.run_claude_code(content)
-                
-                # 結果が空またはNoneの場合の処理
-                if not result:
-                    result = "実行完了（出力なし）"
-                
-                # 結果通知
-                embed = discord.Embed(
-                    title="✅ 実装完了",
-                    color=discord.Color.green(),
-                    timestamp=datetime.now()
-                )
-                embed.add_field(name="コマンド", value=content[:1024], inline=False)
-                embed.add_field(name="プロジェクト", value=self.config['project_dir'], inline=False)
-                
-                # 出力の長さに応じて処理を分岐
-                if len(result) <= 4000:
-                    # 4000文字以内ならDescriptionに収まる（Markdownとして表示）
-                    embed.description = result
-                    await ctx.send(embed=embed)
-                    
-                elif len(result) <= 10000:
-                    # 10000文字以内なら分割してEmbed複数で送信
-                    embed.description = result[:4000]
-                    embed.add_field(
-                        name="⚠️ 出力が長いため分割表示",
-                        value=f"全体: {len(result)}文字",
-                        inline=False
-                    )
-                    await ctx.send(embed=embed)
-                    
-                    # 残りを追加のメッセージで送信
-                    remaining = result[4000:]
-                    while remaining:
-                        chunk = remaining[:2000]
-                        remaining = remaining[2000:]
-                        await ctx.send(chunk)
-                        
-                else:
-                    # 10000文字以上ならファイルとして送信
-                    embed.description = f"出力が非常に長いため、ファイルとして添付しました。\n\n**プレビュー（先頭500文字）:**\n{result[:500]}\n..."
-                    embed.add_field(
-                        name="📊 出力統計",
-                        value=f"全体: {len(result)}文字 / {len(result.splitlines())}行",
-                        inline=False
-                    )
-                    await ctx.send(embed=embed)
-                    
-                    # ファイルとして送信
-                    import io
-                    file_content = result.encode('utf-8')
-                    file = discord.File(
-                        io.BytesIO(file_content),
-                        filename='claude_output.txt'
-                    )
-                    await ctx.send(file=file)
-                
-                logger.info(f"実装完了: 出力{len(result)}文字")
-                
-            except Exception as e:
-                error_msg = f"エラー: {str(e)}"
-                logger.error(f"実装エラー: {error_msg}\n{traceback.format_exc()}")
-                
-                embed = discord.Embed(
-                    title="❌ エラー発生",
-                    description=f"```\n{error_msg[:4000]}\n```",
-                    color=discord.Color.red(),
-                    timestamp=datetime.now()
-                )
-                await ctx.send(embed=embed)
+            if await self.scheduler.cancel(job_id):
+                await ctx.send(f"🚫 ジョブ #{job_id} を取り消しました。")
+            else:
+                await ctx.send(f"❌ ジョブ #{job_id} は待ち・実行中にありません。")
         
         @self.command(name='status')
         async def status(ctx):
@@ -205,9 +4581,14 @@ class DevBot(commands.Bot):
             )
             embed.add_field(name="状態", value="✅ 稼働中", inline=True)
             embed.add_field(name="稼働時間", value=uptime_str, inline=True)
-            embed.add_field(name="プロジェクト", value=self.config['project_dir'], inline=False)
+            embed.add_field(
+                name="プロジェクト",
+                value='\n'.join(f"{p.name}: `{p.path}`" for p in self.projects.projects.values())[:1024] or "未設定",
+                inline=False
+            )
             embed.add_field(name="起動時刻", value=self.start_time.strftime('%Y-%m-%d %H:%M:%S'), inline=True)
             embed.add_field(name="Ping", value=f"{round(self.latency * 1000)}ms", inline=True)
+            embed.add_field(name="環境", value=self.services.health.summary(), inline=False)
             
             await ctx.send(embed=embed)
         
@@ -218,155 +4599,677 @@ class DevBot(commands.Bot):
             
             embed = discord.Embed(
                 title="🛑 Bot停止",
-                description="Botを停止します。\n次回PC起動時に自動的に再開されます。",
+                description="Botを停止します。\n次回PC起動時に自動的に再開されます。" + self._drain_note(),
                 color=discord.Color.orange(),
                 timestamp=datetime.now()
             )
             await ctx.send(embed=embed)
-            
-            self.is_shutting_down = True
-            await asyncio.sleep(1)
-            await self.close()
-            
-            # トレイアイコンも終了
-            if self.tray_icon:
-                self.tray_icon.stop()
+            await self.shutdown()
         
         @self.command(name='restart')
         async def restart_bot(ctx):
             """Botを再起動"""
             logger.info("restart コマンド実行")
             
-            await ctx.send("🔄 Botを再起動します...")
-            
-            self.is_shutting_down = True
-            await asyncio.sleep(1)
-            
-            # 再起動スクリプト実行
-            script_path = Path(__file__).parent / "start_bot.vbs"
-            subprocess.Popen(['wscript', str(script_path)], shell=True)
-            
-            await self.close()
-            if self.tray_icon:
-                self.tray_icon.stop()
+            await ctx.send("🔄 Botを再起動します..." + self._drain_note())
+            # 終了処理の後、restart_methodに従って起動し直す
+            await self.shutdown(restart=True)
         
         @self.command(name='diagnose')
-        async def diagnose(ctx):
-            """Claude環境の診断"""
+        async def diagnose(ctx, *, options: str = ''):
+            """環境診断の結果を表示（--refresh で再診断）"""
             logger.info("diagnose コマンド実行")
             
+            flags, _ = parse_command_flags(options, {'refresh': False})
+            health = self.services.health
+            if flags.get('refresh'):
+                # パスの再探索を含めて今すぐ診断し直す（各チェックは並行・個別タイムアウト）
+                async with ctx.typing():
+                    await asyncio.to_thread(self.claude_resolver.resolve, True)
+                    await health.refresh()
+            elif not health.results:
+                # 起動直後で一度も診断していない場合のみ待つ
+                async with ctx.typing():
+                    await health.refresh()
+            
             embed = discord.Embed(
-                title="🔍 Claude環境診断",
+                title="🔍 環境診断",
+                description=f"最終診断: <t:{int(health.refreshed_at)}:R>（{health.interval:.0f}秒ごとに自動更新）",
                 color=discord.Color.blue(),
                 timestamp=datetime.now()
             )
-            
-            # claudeコマンドの検索
-            try:
-                claude_path = self._find_claude_command()
-                embed.add_field(name="✅ Claude検出", value=f"`{claude_path}`", inline=False)
-            except Exception as e:
-                embed.add_field(name="❌ Claude検出失敗", value=str(e), inline=False)
-            
-            # npm\claudeファイルの確認（拡張子ごと）
-            npm_path = os.path.join(os.environ.get('APPDATA', ''), 'npm')
-            if os.path.exists(npm_path):
-                extensions = ['.cmd', '.bat', '.exe', '']
-                found_files = []
-                for ext in extensions:
-                    file_path = os.path.join(npm_path, f'claude{ext}')
-                    if os.path.exists(file_path):
-                        found_files.append(f"✅ `claude{ext}`")
-                    else:
-                        found_files.append(f"❌ `claude{ext}`")
-                
+            for result in health.snapshot():
                 embed.add_field(
-                    name="npm内のclaudeファイル",
-                    value='\n'.join(found_files),
+                    name=f"{result.icon} {result.label}",
+                    value=result.detail[:1024] or "-",
                     inline=False
                 )
+            embed.add_field(name="プロジェクト", value=f"`{self.config.project_dir}`", inline=False)
             
-            # claudeバージョン確認（フルパス使用）
+            await ctx.send(embed=embed)
+    
+    def add_app_commands(self):
+        """
+        スラッシュコマンド登録（処理は同名のプレフィックスコマンドと共通）
+        
+        3秒以内に応答しないと失敗になるため、まずdeferしてから処理し、
+        結果はフォローアップで送る
+        """
+        
+        async def run(interaction, name, **kwargs):
+            await interaction.response.defer(thinking=True)
+            logger.info(f"/{name} スラッシュコマンド: {interaction.user}")
+            ctx = InteractionContext(self, interaction)
+            await self.get_command(name).callback(ctx, **kwargs)
+        
+        @self.tree.command(name='implement', description='Claude Codeで実装を実行（ジョブキュー経由）')
+        @app_commands.describe(content='実装内容', project='実行するプロジェクト', priority='優先度（大きいほど先に実行）')
+        async def implement(interaction: discord.Interaction, content: str, project: str = None, priority: int = 0):
+            flags = f"--project {project} " if project else ''
+            if priority:
+                flags += f"--priority {priority} "
+            await run(interaction, 'implement', content=flags + content)
+        
+        @implement.autocomplete('project')
+        async def implement_project(interaction: discord.Interaction, current: str):
+            return [
+                app_commands.Choice(name=name, value=name)
+                for name in self.projects.projects if current.lower() in name.lower()
+            ][:25]
+        
+        @self.tree.command(name='status', description='Bot稼働状況を表示')
+        async def status(interaction: discord.Interaction):
+            await run(interaction, 'status')
+        
+        @self.tree.command(name='queue', description='ジョブキューの状況を表示')
+        async def queue(interaction: discord.Interaction):
+            await run(interaction, 'queue')
+        
+        @self.tree.command(name='diagnose', description='環境診断の結果を表示')
+        @app_commands.describe(refresh='キャッシュを使わず今すぐ再診断する')
+        async def diagnose(interaction: discord.Interaction, refresh: bool = False):
+            await run(interaction, 'diagnose', options='--refresh' if refresh else '')
+        
+        self.tree.on_error = self.on_app_command_error
+    
+    async def setup_hook(self):
+        """ログイン後・ゲートウェイ接続前に1回呼ばれる（再接続でクライアントを作り直すたびに呼ばれる）"""
+        await self.sync_app_commands()
+    
+    async def sync_app_commands(self):
+        """
+        スラッシュコマンドをDiscordに登録
+        
+        登録内容のハッシュを data/app_commands.json に残し、前回から変わった
+        場合だけ同期する（再接続のたびに登録APIを呼ばない）。slash_guildsを指定すると
+        そのサーバーにだけ登録する（即時反映。グローバル登録は反映に時間がかかる）
+        """
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        empty = hashlib.sha256(b'[]').hexdigest()
+        state_file = DATA_DIR / 'app_commands.json'
+        try:
+            synced = json.loads(state_file.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            synced = {}
+        
+        changed = False
+        for guild_id in self.config.slash_guilds or [None]:
+            key = f"{self.application_id}:{guild_id or 'global'}"
+            # 一度も登録していなければ「空」が登録済みとみなす（無効のまま起動しても同期しない）
+            if synced.get(key, empty) == digest:
+                continue
+            guild = discord.Object(id=guild_id) if guild_id else None
+            if guild is not None:
+                self.tree.copy_global_to(guild=guild)
             try:
-                claude_path = self._find_claude_command()
-                result = subprocess.run(
-                    [claude_path, '--version'],
-                    capture_output=True,
-                    text=True,
-                    timeout=5,
-                    shell=True  # .cmdファイル実行にshellが必要
+                await self.tree.sync(guild=guild)
+            except discord.HTTPException as e:
+                logger.warning(f"スラッシュコマンドの登録失敗（{guild_id or 'グローバル'}）: {e}")
+                continue
+            synced[key] = digest
+            changed = True
+            logger.info(f"スラッシュコマンドを登録: {guild_id or 'グローバル'}（{len(payload)}件）")
+        if changed:
+            state_file.write_text(json.dumps(synced, indent=2), encoding='utf-8')
+    
+    async def on_app_command_error(self, interaction, error):
+        """スラッシュコマンドのエラーハンドリング"""
+        logger.error(f"スラッシュコマンドエラー: {error}\n{traceback.format_exc()}")
+        message = f"❌ エラーが発生しました: {str(error)}"
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+
+    async def execute_job(self, job):
+        """ジョブを実行し、結果をジョブのチャンネルへ通知"""
+        batch = self.services.batches.get(job.batch_id) if job.batch_id else None
+        if batch is not None:
+            await self._execute_batch_task(job, batch)
+            return
+        
+        channel = await self.services.channel(job.channel_id)
+        self._queue_messages.pop(job.id, None)
+        # スラッシュコマンドで受け付けたジョブは、結果の送信までトークンが持つならフォローアップで返す
+        # （持たなければチャンネルへ送る。受付時にフォローアップを1通返しているので応答は失敗にならない）
+        reply = self._interactions.pop(job.id, None)
+        if reply is not None and reply.remaining() > self.config.claude_timeout + 60:
+            channel = reply
+        else:
+            reply = None
+        
+        # Claudeの実行後（後処理・結果送信中）に中断したジョブは再実行しない
+        checkpoint = await asyncio.to_thread(self.services.checkpoints.load, job.id)
+        resumed = checkpoint is not None and checkpoint.stage == 'claude_done'
+        
+        stream = None
+        if resumed:
+            await channel.send(f"🔄 ジョブ #{job.id} は前回Claudeの実行まで完了しているため、結果の送信から再開します...")
+        elif self.config.stream_output:
+            # 進捗を1通のメッセージにまとめて逐次表示
+            stream = StreamingMessage(
+                channel,
+                header=f"🤖 ジョブ #{job.id} の実装を開始します...\n",
+                interval=self.config.stream_edit_interval
+            )
+            await stream.start()
+        else:
+            await channel.send(f"🤖 ジョブ #{job.id} の実装を開始します...")
+        
+        project = self.projects.get(job.project)
+        worktree = None
+        timer = StageTimer()
+        timer.record('queue_wait', max(0.0, (job.started_at or time.time()) - job.created_at))
+        claude_done = resumed
+        try:
+            # プロセス全体のchdirはせず、ジョブごとの作業ディレクトリをcwdで渡す
+            cwd = job.project_dir
+            if resumed:
+                result, worktree = await self._resume_claude_done(job, checkpoint, timer)
+            else:
+                # バッチのタスクは再起動で個別実行に戻っても必ずworktreeで分離する
+                if (project and project.worktrees) or job.batch_id:
+                    worktree = await self._create_worktree(job)
+                    cwd = worktree.path
+                
+                # worktreeは毎回別ディレクトリなのでセッションは引き継がない
+                session_key = None
+                if self.config.session_reuse and worktree is None:
+                    session_key = (job.channel_id, job.project_dir)
+                
+                prompt = job.prompt
+                # 前回の停止・再起動で中断したジョブは、同じ作業ツリーなら中断したセッションの続きから
+                if checkpoint is not None:
+                    await asyncio.to_thread(self.services.checkpoints.remove, job.id)
+                    if worktree is None:
+                        prompt = f"{self.RESUME_NOTE}\n\n{job.prompt}"
+                        if session_key is not None and checkpoint.session_id:
+                            self.sessions.set(session_key, checkpoint.session_id)
+                
+                # Claude Code実行
+                try:
+                    result = await self.run_claude_code(
+                        prompt,
+                        on_progress=stream.append if stream else None,
+                        session_key=session_key,
+                        cwd=cwd,
+                        timer=timer,
+                        job=job
+                    )
+                    await self._save_claude_done(job, result, timer, worktree)
+                    claude_done = True
+                finally:
+                    if stream:
+                        await stream.close()
+                    if worktree:
+                        # 異常終了・中断したジョブの途中の変更はコミットしない
+                        await self._close_worktree(job, worktree, commit=timer.succeeded)
+            
+            # 結果が空またはNoneの場合の処理
+            if not result:
+                result = "実行完了（出力なし）"
+            
+            if timer.succeeded:
+                # コミット・push予約（pushは待たずにバックグラウンドで行う）
+                git_note = await self._git_post_process(job, cwd, worktree)
+                embed = discord.Embed(
+                    title="✅ 実装完了",
+                    color=discord.Color.green(),
+                    timestamp=datetime.now()
                 )
-                version = result.stdout.strip() if result.returncode == 0 else f"エラー: {result.stderr}"
-                embed.add_field(name="Claude Version", value=version or "取得失敗", inline=False)
-            except Exception as e:
-                embed.add_field(name="❌ Version確認失敗", value=str(e), inline=False)
+            else:
+                git_note = self._uncommitted_note(worktree)
+                embed = discord.Embed(
+                    title=f"⚠️ 実装失敗（終了コード {timer.exit_code}）",
+                    color=discord.Color.orange(),
+                    timestamp=datetime.now()
+                )
+            embed.add_field(name="コマンド", value=job.prompt[:1024], inline=False)
+            embed.add_field(name="プロジェクト", value=f"{job.project} (`{job.project_dir}`)", inline=False)
+            if worktree and timer.succeeded:
+                embed.add_field(
+                    name="ブランチ",
+                    value=f"`{worktree.branch}` {worktree.diffstat}" if worktree.changed else "変更なし",
+                    inline=False
+                )
+            if git_note:
+                embed.add_field(name="Git", value=git_note[:1024], inline=False)
+            if timer.resources is not None:
+                embed.add_field(name="リソース", value=timer.resources.summary(), inline=False)
+            if timer.telemetry is not None:
+                embed.add_field(name="使用量", value=timer.telemetry.summary(), inline=False)
             
-            # PATH確認（npmパスが含まれているか）
-            path_env = os.environ.get('PATH', '')
-            npm_in_path = npm_path in path_env
-            embed.add_field(
-                name="npmパスがPATHに含まれているか",
-                value="✅ はい" if npm_in_path else f"❌ いいえ\nnpmパス: `{npm_path}`",
-                inline=False
-            )
+            # 出力の長さに応じて分割送信・ファイル添付
+            # （実行中に再接続していれば新しいクライアントで送る）
+            channel = reply or await self.services.channel(job.channel_id)
+            await self.delivery.deliver(channel, embed, result)
+            timer.mark('deliver')
+            await asyncio.to_thread(self.services.checkpoints.remove, job.id)
             
-            # PATH確認（最初の5つ）
-            paths = path_env.split(os.pathsep)[:5]
-            path_str = '\n'.join([f"`{p}`" for p in paths])
-            embed.add_field(name="PATH (先頭5件)", value=path_str or "なし", inline=False)
+            logger.info(f"実装完了: ジョブ#{job.id} 出力{len(result)}文字 ({timer.summary()})")
             
-            # プロジェクトディレクトリ
-            embed.add_field(name="プロジェクト", value=f"`{self.config['project_dir']}`", inline=False)
+        except asyncio.CancelledError:
+            if self.services.draining and self.services.connected.is_set():
+                channel = reply or await self.services.channel(job.channel_id)
+                if claude_done:
+                    await channel.send(
+                        f"⏸️ ジョブ #{job.id} は停止・再起動のため結果の送信前に中断しました。"
+                        "Claudeは再実行せず、次回起動時に結果の送信から再開します。"
+                    )
+                else:
+                    await channel.send(
+                        f"⏸️ ジョブ #{job.id} は停止・再起動のため中断しました。"
+                        "途中までの出力を保存し、次回起動時に再実行します。"
+                    )
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self.services.checkpoints.remove, job.id)
+            error_msg = f"エラー: {str(e)}"
             
-            await ctx.send(embed=embed)
-
-        @self.command(name='test')
-    async def run_claude_code(self, content: str) -> str:
-        """Claude Codeを実行（非インタラクティブモード）"""
+            embed = discord.Embed(
+                title="❌ エラー発生",
+                description=f"```\n{error_msg[:4000]}\n```",
+                color=discord.Color.red(),
+                timestamp=datetime.now()
+            )
+            if worktree and worktree.kept:
+                embed.add_field(name="Git", value=self._uncommitted_note(worktree), inline=False)
+            if timer.resources is not None:
+                embed.add_field(name="リソース", value=timer.resources.summary(), inline=False)
+            if timer.telemetry is not None:
+                embed.add_field(name="使用量", value=timer.telemetry.summary(), inline=False)
+            logger.warning(f"実装失敗: ジョブ#{job.id} ({timer.summary()})")
+            channel = reply or await self.services.channel(job.channel_id)
+            await channel.send(embed=embed)
+            raise
+    
+    async def _cancel_batch(self, ctx, argument):
+        """バッチの待ち・実行中のタスクをすべて取り消す"""
         try:
-            # 非インタラクティブモード（-pフラグ）で実行
-            result = await asyncio.get_event_loop().run_in_executor(
-                None,
-                self._run_claude_headless,
-                content
+            batch_id = int(argument.lstrip('#'))
+        except ValueError:
+            await ctx.send(f"❌ バッチ番号を指定してください: `{self.config.command_prefix}batch cancel <番号>`")
+            return
+        run = self.services.batches.get(batch_id)
+        if run is None:
+            await ctx.send(f"❌ バッチ #{batch_id} は実行中ではありません。")
+            return
+        pending = [job for job in run.jobs if job.status not in BatchRun.FINISHED]
+        # 待ちを先に取り消す（実行中を先に止めると空いた枠で待ちが開始されるため）
+        pending.sort(key=lambda job: job.status == 'running')
+        cancelled = 0
+        for job in pending:
+            if await self.scheduler.cancel(job.id):
+                cancelled += 1
+        await ctx.send(f"🚫 バッチ #{batch_id} のタスク{cancelled}件を取り消しました。")
+    
+    async def _execute_batch_task(self, job, batch):
+        """バッチの1タスクを専用worktreeで実行し、結果をバッチにまとめる（個別の通知はしない）"""
+        batch.touch()
+        timer = StageTimer()
+        timer.record('queue_wait', max(0.0, (job.started_at or time.time()) - job.created_at))
+        worktree = output = None
+        try:
+            worktree = await self._create_worktree(job)
+            try:
+                output = await self.run_claude_code(job.prompt, cwd=worktree.path, timer=timer, job=job)
+                await self._save_claude_done(job, output, timer, worktree)
+            finally:
+                await self._close_worktree(job, worktree, commit=timer.succeeded)
+            if not timer.succeeded:
+                raise Exception(f"終了コード {timer.exit_code}（{self._uncommitted_note(worktree)}）")
+            await self._git_post_process(job, worktree.path, worktree)
+        except Exception as e:
+            await asyncio.to_thread(self.services.checkpoints.remove, job.id)
+            batch.record(job, output=output, error=f"エラー: {e}", worktree=worktree, resources=timer.resources)
+            raise
+        await asyncio.to_thread(self.services.checkpoints.remove, job.id)
+        batch.record(job, output=output, worktree=worktree, resources=timer.resources)
+        logger.info(f"バッチ#{batch.id} タスク完了: ジョブ#{job.id} ({timer.summary()})")
+    
+    async def _save_claude_done(self, job, output, timer, worktree):
+        """Claudeの実行結果を後処理の前に記録（後処理・結果送信中に中断しても二重に実行しないため）"""
+        await asyncio.to_thread(self.services.checkpoints.save, JobCheckpoint(
+            job_id=job.id,
+            channel_id=job.channel_id,
+            prompt=job.prompt,
+            output=output,
+            stage='claude_done',
+            exit_code=timer.exit_code,
+            telemetry=asdict(timer.telemetry) if timer.telemetry is not None else None,
+            worktree=asdict(worktree) if worktree is not None else None
+        ))
+    
+    async def _resume_claude_done(self, job, checkpoint, timer):
+        """
+        Claudeの実行後に中断したジョブの結果とworktreeを復元する
+        
+        worktreeが残っていれば前回と同じく閉じ、削除済みならブランチから差分を求める
+        """
+        timer.exit_code = checkpoint.exit_code
+        if checkpoint.telemetry:
+            timer.telemetry = RunTelemetry(**checkpoint.telemetry)
+        worktree = None
+        if checkpoint.worktree:
+            worktree = Worktree(**checkpoint.worktree)
+            if os.path.isdir(worktree.path):
+                await self._close_worktree(job, worktree, commit=timer.succeeded)
+            else:
+                # ブランチへのコミットとworktreeの削除は前回済んでいる（変更がなければブランチもない）
+                head = await run_process(['git', 'rev-parse', '--verify', '--quiet', worktree.branch],
+                                         cwd=job.project_dir, timeout=30)
+                if head.returncode == 0 and head.stdout.strip() != worktree.base:
+                    worktree.changed = True
+                    worktree.diffstat = str(await diff_numstat(job.project_dir, worktree.base, head.stdout.strip()))
+        logger.info(f"ジョブ#{job.id} はClaudeの実行後に中断していたため、結果の送信から再開します")
+        return checkpoint.output, worktree
+    
+    async def _git_post_process(self, job, cwd, worktree=None):
+        """
+        実行後のコミットとpush予約を行い、結果Embedに載せる文言を返す
+        
+        worktreeで実行したジョブは_close_worktreeでブランチにコミット済みなので
+        pushの予約だけ行う。コミットに失敗してもジョブ自体は成功扱い
+        """
+        git = self.services.git
+        if worktree is not None:
+            if not worktree.changed or not self.config.auto_push:
+                return None
+            git.schedule_push(job.project_dir, worktree.branch, job)
+            return f"⏳ `{worktree.branch}` を{git.window:.0f}秒以内にpushします"
+        if not self.config.auto_commit or not await git.is_repo(cwd):
+            return None
+        try:
+            commit = await git.commit(job, cwd)
+        except Exception as e:
+            logger.warning(f"ジョブ#{job.id} のコミット失敗: {e}")
+            return f"⚠️ コミット失敗: {e}"
+        if commit is None:
+            return "変更なし"
+        note = f"`{commit.sha[:8]}` {commit.stat}"
+        if not self.config.auto_push:
+            return note
+        if commit.branch == 'HEAD':
+            return note + "\n⚠️ ブランチ上にないため（detached HEAD）pushしません"
+        git.schedule_push(cwd, commit.branch, job)
+        return note + f"\n⏳ `{commit.branch}` を{git.window:.0f}秒以内にpushします"
+    
+    async def _create_worktree(self, job):
+        """ジョブ専用のgit worktreeを作成"""
+        path = DATA_DIR / 'worktrees' / f"{job.project}-{job.id}"
+        branch = f"bot/job-{job.id}"
+        base = (await run_git(['rev-parse', 'HEAD'], cwd=job.project_dir)).stdout.strip()
+        if path.exists():
+            # 再起動前に作られたworktreeは作り直す
+            await run_git(['worktree', 'remove', '--force', str(path)], cwd=job.project_dir)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        await run_git(['worktree', 'add', '-B', branch, str(path), base], cwd=job.project_dir)
+        logger.info(f"worktree作成: {path} ({branch})")
+        return Worktree(path=str(path), branch=branch, base=base)
+    
+    async def _close_worktree(self, job, worktree, commit=True):
+        """
+        worktreeの変更をジョブのブランチにコミットし、作業ディレクトリを削除
+        
+        コミットに失敗した場合は変更を失わないようworktreeを残す。
+        commit=False（Claudeが異常終了・中断した）なら変更があれば未コミットのまま残す
+        """
+        try:
+            status = await run_git(['status', '--porcelain'], cwd=worktree.path)
+            if not commit and status.stdout.strip():
+                worktree.kept = True
+                logger.warning(f"ジョブ#{job.id} は正常終了しなかったため変更をコミットせず残します: {worktree.path}")
+                return
+            if status.stdout.strip():
+                await run_git(['add', '-A'], cwd=worktree.path)
+                await run_git(['commit', '-m', f"[Bot] {job.prompt[:50]}"], cwd=worktree.path)
+            head = (await run_git(['rev-parse', 'HEAD'], cwd=worktree.path)).stdout.strip()
+            worktree.changed = head != worktree.base
+            if worktree.changed:
+                worktree.diffstat = str(await diff_numstat(worktree.path, worktree.base, head))
+        except Exception as e:
+            logger.error(f"worktreeの後処理失敗（{worktree.path} を残します）: {e}")
+            return
+        await run_git(['worktree', 'remove', '--force', worktree.path], cwd=job.project_dir)
+        if not worktree.changed:
+            await run_git(['branch', '-D', worktree.branch], cwd=job.project_dir)
+    
+    @staticmethod
+    def _uncommitted_note(worktree):
+        """異常終了したジョブの変更の扱い（結果Embed用）"""
+        if worktree is None:
+            return "⚠️ 正常終了しなかったためコミット・pushしていません（変更は作業ツリーに残っています）"
+        if worktree.kept:
+            return f"⚠️ 正常終了しなかったためコミットしていません（変更は `{worktree.path}` に残っています）"
+        return "⚠️ 正常終了しなかったためコミットしていません（変更なし）"
+    
+    def _rate_limit_embed(self, wait, scope, job=None):
+        """レート制限の通知（jobを渡すと延期、省略すると拒否）"""
+        who = "あなた" if scope == 'user' else "このチャンネル"
+        retry_at = int(time.time() + wait)
+        if job is None:
+            return discord.Embed(
+                title="⏳ レート制限中",
+                description=f"{who}の実行回数が上限に達しました。\n"
+                            f"<t:{retry_at}:R>（約{math.ceil(wait)}秒後）に再実行できます。",
+                color=discord.Color.orange()
             )
-            
-            return result
+        return discord.Embed(
+            title="⏳ 実行を延期しました",
+            description=f"{who}の実行回数が上限に達したため、ジョブ #{job.id} は "
+                        f"<t:{retry_at}:R>（約{math.ceil(wait)}秒後）以降に開始します。",
+            color=discord.Color.orange()
+        )
+    
+    async def _on_queue_change(self, job, position):
+        """待ち順が変わったら受付メッセージを更新"""
+        entry = self._queue_messages.get(job.id)
+        if entry is None or entry[1] == position:
+            return
+        message = entry[0]
+        self._queue_messages[job.id] = (message, position)
+        await message.edit(
+            content=f"📥 ジョブ #{job.id} を受け付けました（待ち順: {position}）\n"
+                    f"取り消し: `{self.config.command_prefix}cancel {job.id}`"
+        )
+    
+    async def _ask_cache_key(self, content, cwd):
+        """askの結果キャッシュのキーと作業ツリーの状態。キャッシュできなければ (None, None)"""
+        state = await repo_state(cwd)
+        if state is None:
+            # gitリポジトリ以外は変更を検知できないのでキャッシュしない
+            return None, None
+        try:
+            version = await self.services.claude_version()
+        except Exception as e:
+            logger.warning(f"claudeバージョン取得失敗（キャッシュ無効）: {e}")
+            return None, None
+        key = ResultCache.make_key('ask', content.strip(), os.path.realpath(cwd), state, version)
+        return key, state
+    
+    async def run_claude_code(self, content: str, on_progress=None, session_key=None,
+                              cwd=None, timer=None, read_only=False, job=None) -> str:
+        """
+        Claude Codeを実行（非インタラクティブモード）
+        
+        cwdを省略するとdefaultプロジェクトで実行する。
+        session_keyを渡すと、同じキーの前回セッションを --resume で引き継ぐ。
+        read_onlyなら読み取り系のツールのみ許可し、異常終了は例外にする。
+        jobのプロジェクト・実行者は実行履歴に残す
+        """
+        resume = self.sessions.get(session_key) if session_key else None
+        cwd = cwd or self.config.project_dir
+        timer = timer or StageTimer()
+        try:
+            # 非インタラクティブモード（-pフラグ）で実行
+            return await self._run_claude_headless(content, cwd, on_progress, session_key, resume, timer,
+                                                   read_only=read_only, job=job)
             
         except Exception as e:
             logger.error(f"Claude Code実行エラー: {e}")
             raise
     
-    def _run_claude_headless(self, content: str) -> str:
-        """Claude Codeを非インタラクティブモードで同期実行（内部用）"""
+    async def _repo_context(self, path):
+        """リポジトリ概要（作れなければNoneで、概要なしで実行する）"""
         try:
-            # claudeコマンドのフルパスを検索
-            claude_cmd = self._find_claude_command()
+            return await self.services.context.get(path)
+        except Exception as e:
+            logger.warning(f"リポジトリ概要を作成できません: {path}: {e}")
+            return None
+    
+    async def _run_claude_headless(self, content: str, cwd, on_progress=None,
+                                   session_key=None, resume=None, timer=None, read_only=False,
+                                   job=None) -> str:
+        """
+        Claude Codeを非インタラクティブモードで非同期実行（内部用）
+        
+        on_progressまたはsession_keyを渡すとstream-json形式で実行し、
+        進捗テキストの逐次通知とセッションIDの取得を行う。それ以外は
+        claude_output_formatの形式で実行する。json・stream-jsonでは
+        ターン数・トークン数・コストをtimerに記録し、どの形式でも実行履歴に残す。
+        停止・再起動で中断されたジョブは途中までの出力をチェックポイントに保存する
+        """
+        timeout = self.config.claude_timeout
+        parser = record = None
+        partial = []
+        try:
+            # claudeコマンドのフルパス（通常はキャッシュ参照のみ）
+            claude_cmd = self.claude_resolver.resolve()
+            timer.mark('resolve')
             
-            command = [
-                claude_cmd,
-                '-p',  # 非インタラクティブモード（--print）
-                '--dangerously-skip-permissions',  # 全権限をスキップ（自動化用）
-                '--output-format', 'text',  # テキスト形式で出力
-                content
-            ]
+            command = [claude_cmd, '-p']  # 非インタラクティブモード（--print）
+            if read_only:
+                # 読み取り系ツールのみ許可（編集・コマンド実行は拒否される）
+                command += ['--allowedTools', 'Read,Grep,Glob,LS']
+            else:
+                command.append('--dangerously-skip-permissions')  # 全権限をスキップ（自動化用）
+            if resume:
+                # 前回の会話コンテキストを引き継ぐ
+                command += ['--resume', resume]
+            parser = None
+            on_stdout = None
+            if on_progress is not None or session_key is not None:
+                # 進捗とセッションIDが必要なのでストリーミング（1行1イベントのJSON）
+                output_format = 'stream-json'
+            else:
+                output_format = self.config.claude_output_format
+            command += ['--output-format', output_format]
+            if output_format == 'stream-json':
+                command.append('--verbose')  # -pでstream-jsonを使うには必須
+            if self.config.context_prefetch:
+                # ファイル構成を探索する手間を省くため、リポジトリ概要をシステムプロンプトに追加
+                summary = await self._repo_context(job.project_dir if job else cwd)
+                timer.mark('context')
+                if summary:
+                    command += ['--append-system-prompt', summary]
+            if output_format != 'text':
+                parser = ClaudeStreamParser()
+                
+                async def on_stdout(line):
+                    text = parser.feed(line)
+                    if text and on_progress is not None:
+                        await on_progress(text)
+            elif job is not None and job.id is not None:
+                # 中断時に途中までの出力を残せるよう行単位で受け取る
+                async def on_stdout(line):
+                    partial.append(line)
+            command.append(content)
             
-            logger.info(f"Claude Code実行: {' '.join(command)}")
+            # プロンプト本文はログに残さず長さのみ記録
+            logger.info(f"Claude Code実行: {' '.join(command[:-1])} <プロンプト {len(content)}文字> (cwd: {cwd})")
             
-            result = subprocess.run(
+            record = RunRecord(
+                started_at=time.time(),
+                prompt=content,
+                project_dir=str(cwd),
+                project=job.project if job else None,
+                kind='ask' if read_only else 'batch' if job and job.batch_id else 'implement',
+                job_id=job.id if job else None,
+                channel_id=job.channel_id if job else None,
+                author=job.author_name if job else '',
+                read_only=read_only,
+                output_format=output_format
+            )
+            
+            # イベントループ上で直接実行（executorのスレッドを占有しない）
+            limits = ResourceLimits.from_config(self.config)
+            launched = time.monotonic()
+            result = await run_process(
                 command,
-                capture_output=True,
-                text=True,
-                encoding='utf-8',  # UTF-8エンコーディングを明示
-                errors='replace',  # デコードエラーを置換文字で処理
-                timeout=300,  # 5分タイムアウト
-                cwd=self.config['project_dir'],
-                shell=True  # Windowsの.cmdファイル実行にはshellが必要
+                cwd=cwd,
+                timeout=timeout,
+                on_stdout=on_stdout,
+                limits=limits,
+                cgroups=self.services.cgroups,
+                on_stats=timer.record_resources
             )
+            metrics.inc('devbot_claude_runs_total', exit_code=result.returncode)
+            timer.record('spawn', result.spawn_time)
+            if result.first_byte_time is not None:
+                timer.record('first_byte', result.first_byte_time)
+            if parser is not None and parser.first_edit is not None:
+                timer.record('first_edit', parser.first_edit - launched)
+            timer.mark('exit')
+            
+            if resume and result.returncode != 0 and parser.result_event is None:
+                # セッションがClaude側で失効している場合は新規セッションでやり直す
+                logger.warning(f"セッション再開失敗、新規セッションで再実行: {resume}")
+                self.sessions.reset(session_key)
+                return await self._run_claude_headless(content, cwd, on_progress, session_key,
+                                                       timer=timer, read_only=read_only, job=job)
+            
+            if session_key is not None and parser.session_id:
+                self.sessions.set(session_key, parser.session_id)
+            
+            record.exit_code = timer.exit_code = result.returncode
+            record.duration = result.duration
+            record.first_byte = result.first_byte_time
+            record.telemetry = parser.telemetry if parser else None
+            if record.telemetry is not None:
+                timer.record_telemetry(record.telemetry)
+            
+            if result.returncode != 0:
+                # 利用上限などはヘルスチェックの警告に出す
+                self.services.health.note_claude_output(
+                    result.stderr + '\n' + (parser.result_text if parser else result.stdout)
+                )
+            
+            if read_only and result.returncode != 0:
+                # 失敗した応答はキャッシュさせない
+                detail = result.stderr.strip() or (parser.result_text if parser else result.stdout)
+                self._record_run(record, timer, detail)
+                raise Exception(f"終了コード {result.returncode}: {detail[:1000]}")
             
-            output = result.stdout if result.stdout else ""
+            if parser is not None:
+                output = parser.result_text
+            else:
+                output = result.stdout if result.stdout else ""
             if result.stderr:
                 output += f"\n\nエラー出力:\n{result.stderr}"
+            if result.returncode < 0 and limits:
+                # RLIMIT_CPU超過はSIGXCPU、メモリ・プロセス数超過はSIGKILLなどで終わる
+                output += f"\n\n⚠️ シグナル{-result.returncode}で終了しました（資源制限を超えた可能性があります）"
             
             # 出力が空の場合の処理
             if not output or output.strip() == "":
@@ -374,12 +5277,32 @@ class DevBot(commands.Bot):
             
             # 実行結果をログに記録
             logger.info(f"Claude Code終了コード: {result.returncode}")
-            logger.info(f"出力の長さ: {len(output)} 文字")
+            logger.info(f"出力の長さ: {len(output)} 文字 / 実行時間: {result.duration:.1f}秒")
+            metrics.observe('devbot_output_chars', len(output))
+            self._record_run(record, timer, output)
             
             return output
             
-        except subprocess.TimeoutExpired:
-            raise Exception("Claude Code実行がタイムアウトしました（5分超過）")
+        except asyncio.CancelledError:
+            # askなどジョブ以外の実行（job=None）は再開しないので保存しない
+            if record is not None and job is not None and job.id is not None and self.services.draining:
+                output = parser.result_text if parser else '\n'.join(partial)
+                await asyncio.to_thread(self.services.checkpoints.save, JobCheckpoint(
+                    job_id=job.id,
+                    channel_id=job.channel_id,
+                    prompt=job.prompt,
+                    output=output,
+                    session_id=parser.session_id if parser else None
+                ))
+                record.duration = time.time() - record.started_at
+                self._record_run(record, timer, output + "\n\n（停止・再起動のため中断）")
+                logger.info(f"ジョブ#{job.id} を中断し、途中までの出力（{len(output)}文字）を保存しました")
+            raise
+        except asyncio.TimeoutError:
+            metrics.inc('devbot_claude_timeouts_total')
+            record.duration = time.time() - record.started_at
+            self._record_run(record, timer, f"タイムアウト（{timeout}秒超過）")
+            raise Exception(f"Claude Code実行がタイムアウトしました（{timeout}秒超過）")
         except FileNotFoundError as e:
             # 詳細なエラーメッセージ
             raise Exception(
@@ -389,93 +5312,77 @@ class DevBot(commands.Bot):
                 "2. コマンドプロンプトで 'claude --version' が動作するか\n"
                 "3. npm global binがPATHに含まれているか: npm config get prefix"
             )
-        except UnicodeDecodeError as e:
-            raise Exception(f"文字コードエラー: {e}\nUTF-8でデコードできない文字が含まれています")
         except Exception as e:
             raise Exception(f"Claude実行エラー: {e}")
     
-    def _find_claude_command(self) -> str:
-        """claudeコマンドのフルパスを検索"""
-        # Windows実行可能ファイルの拡張子（優先順位順）
-        # .cmdが最優先（npmのグローバルコマンドの標準）
-        extensions = ['.cmd', '.bat', '.exe', '']
-        
-        # 候補パスのリスト
-        candidates = []
-        
-        # 1. whereコマンドで検索（Windows）
-        try:
-            result = subprocess.run(
-                ['where', 'claude'],
-                capture_output=True,
-                text=True,
-                timeout=5,
-                shell=True  # whereコマンドはshellが必要
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                where_paths = result.stdout.strip().split('\n')
-                # .cmdファイルを優先的に選択
-                for ext in extensions:
-                    for where_path in where_paths:
-                        where_path = where_path.strip()
-                        if where_path.endswith(ext) and os.path.exists(where_path):
-                            candidates.append(where_path)
-                            logger.info(f"whereコマンドで検出: {where_path}")
-                            break  # 見つかったら次の拡張子へ
-                    if candidates:
-                        break  # 既に見つかっていたら終了
-        except Exception as e:
-            logger.warning(f"whereコマンド失敗: {e}")
-        
-        # 2. npm global binのパス（よくある場所）
-        npm_paths = [
-            os.path.join(os.environ.get('APPDATA', ''), 'npm'),
-            os.path.join(os.environ.get('PROGRAMFILES', ''), 'nodejs'),
-            os.path.join(os.environ.get('PROGRAMFILES(X86)', ''), 'nodejs'),
-        ]
-        
-        for npm_path in npm_paths:
-            if not npm_path or not os.path.exists(npm_path):
+    def _record_run(self, record, timer, output):
+        """実行履歴に保存（書き込みは履歴のスレッドでまとめて行う）"""
+        record.output = output
+        record.timings = dict(timer.stages)
+        self.services.runs.add(record)
+    
+    async def _report_interrupted(self):
+        """前回の停止・再起動で中断したジョブを途中までの出力とともに報告（1ジョブ1回）"""
+        checkpoints = self.services.checkpoints
+        for job_id in await asyncio.to_thread(checkpoints.job_ids):
+            checkpoint = await asyncio.to_thread(checkpoints.load, job_id)
+            # Claudeの実行後に中断したジョブは、再開したジョブが結果を送る
+            if checkpoint is None or checkpoint.reported or checkpoint.stage == 'claude_done':
                 continue
-            
-            # 各拡張子を優先順位順に試す
-            for ext in extensions:
-                claude_path = os.path.join(npm_path, f'claude{ext}')
-                if os.path.exists(claude_path):
-                    # 既に見つかっていない場合のみ追加
-                    if claude_path not in candidates:
-                        candidates.append(claude_path)
-                        logger.info(f"npm pathで検出: {claude_path}")
-                    break  # 見つかったら次のnpm_pathへ
-        
-        # 3. ユーザーディレクトリ
-        username = os.environ.get('USERNAME', '')
-        if username:
-            user_npm = rf'C:\Users\{username}\AppData\Roaming\npm'
-            if os.path.exists(user_npm):
-                for ext in extensions:
-                    claude_path = os.path.join(user_npm, f'claude{ext}')
-                    if os.path.exists(claude_path):
-                        if claude_path not in candidates:
-                            candidates.append(claude_path)
-                            logger.info(f"ユーザーnpmで検出: {claude_path}")
-                        break  # 見つかったら終了
-        
-        # 最初に見つかったものを使用（.cmd優先なので安全）
-        if candidates:
-            selected = candidates[0]
-            logger.info(f"使用するClaudeコマンド: {selected}")
-            return selected
-        
-        # 見つからない場合は'claude.cmd'を試す
-        logger.warning("claudeコマンドのフルパスが見つかりません。claude.cmdで試行")
-        return 'claude.cmd'
-
+            embed = discord.Embed(
+                title=f"🔄 中断したジョブ #{job_id} を再実行します",
+                color=discord.Color.blue(),
+                timestamp=datetime.fromtimestamp(checkpoint.interrupted_at)
+            )
+            embed.add_field(name="コマンド", value=checkpoint.prompt[:1024], inline=False)
+            embed.add_field(
+                name="状況",
+                value="前回の停止・再起動で中断したため待ちジョブに戻しました（本文は中断時点の出力）",
+                inline=False
+            )
+            try:
+                channel = await self.services.channel(checkpoint.channel_id)
+                await self.delivery.deliver(
+                    channel, embed, checkpoint.output or "（出力なし）", filename=f"job_{job_id}_partial.md"
+                )
+            except Exception as e:
+                logger.warning(f"ジョブ#{job_id} の中断報告に失敗: {e}")
+                continue
+            checkpoint.reported = True
+            await asyncio.to_thread(checkpoints.save, checkpoint)
+    
+    async def _prune_checkpoints(self):
+        """待ち・実行中のジョブがなくなったチェックポイント（取り消し済みなど）を削除"""
+        checkpoints = self.services.checkpoints
+        for job_id in await asyncio.to_thread(checkpoints.job_ids):
+            if self.scheduler.get(job_id) is None:
+                await asyncio.to_thread(checkpoints.remove, job_id)
+    
+    async def _sample_latency(self):
+        """ゲートウェイのレイテンシをメトリクスに記録"""
+        latency = self.latency
+        if math.isfinite(latency):
+            metrics.observe('devbot_gateway_latency_seconds', latency)
+            metrics.set('devbot_gateway_latency_last_seconds', latency)
+        metrics.set('devbot_log_dropped_total', queue_handler.dropped)
+    
     async def on_ready(self):
         """Bot起動完了時"""
         logger.info(f'Botログイン完了: {self.user.name}')
         logger.info(f'接続サーバー数: {len(self.guilds)}')
         
+        # claudeコマンドのパスを事前解決
+        await asyncio.to_thread(self.claude_resolver.resolve)
+        
+        # ジョブキュー開始（再接続時は何もしない）
+        self.services.set_connected(True)
+        await self._report_interrupted()
+        await self.scheduler.start()
+        await self._prune_checkpoints()
+        
+        if not self.latency_sampler.is_running():
+            self.latency_sampler.start()
+        
         # アクティビティ設定
         await self.change_presence(
             activity=discord.Activity(
@@ -488,6 +5395,22 @@ class DevBot(commands.Bot):
         if self.tray_icon:
             self.tray_icon.title = f"Discord Dev Bot - 稼働中\n{self.user.name}"
     
+    async def on_disconnect(self):
+        """ゲートウェイ切断（discord.pyが自動で再接続・再開する）"""
+        metrics.inc('devbot_gateway_disconnects_total')
+    
+    async def on_resumed(self):
+        metrics.inc('devbot_gateway_resumes_total')
+        logger.info("ゲートウェイセッション再開")
+    
+    async def close(self):
+        """クライアントを閉じる（ジョブキューはBotServicesに残る）"""
+        if self.latency_sampler.is_running():
+            self.latency_sampler.cancel()
+        if self.services.bot is self:
+            self.services.set_connected(False)
+        await super().close()
+    
     async def on_command_error(self, ctx, error):
         """コマンドエラーハンドリング"""
         if isinstance(error, commands.CommandNotFound):
@@ -497,8 +5420,144 @@ class DevBot(commands.Bot):
             await ctx.send(f"❌ エラーが発生しました: {str(error)}")
 
 
+class Supervisor:
+    """
+    Discordクライアントの起動・再接続を管理する
+    
+    - クライアントが例外で落ちたら作り直して再接続（ジョブはBotServicesに残る）
+    - 待機時間はdecorrelated jitter付きの指数バックオフ
+      （base〜前回の3倍の一様乱数、上限max_delay）
+    - crash_window秒以内にcrash_budget回を超えて落ちたら、max_delay秒休んでから再開
+    - Token無効（LoginFailure）と明示的な停止（close）では終了する
+    """
+    
+    # この時間以上つながっていたらバックオフを初期値に戻す
+    HEALTHY_UPTIME = 60
+    
+    def __init__(self, services, tray_icon=None):
+        self.services = services
+        self.tray_icon = tray_icon
+        self.bot = None
+        self._delay = self.base_delay
+        self._crashes = []
+        self._stopping = False
+    
+    # 設定の再読み込みに追従するため毎回BotServicesから読む
+    @property
+    def config(self):
+        return self.services.config
+    
+    @property
+    def base_delay(self):
+        return self.config.reconnect_base_delay
+    
+    @property
+    def max_delay(self):
+        return self.config.reconnect_max_delay
+    
+    @property
+    def window(self):
+        return self.config.crash_window
+    
+    @property
+    def budget(self):
+        return self.config.crash_budget
+    
+    def next_delay(self):
+        """次の再接続までの待機時間（decorrelated jitter）"""
+        self._delay = min(self.max_delay, random.uniform(self.base_delay, self._delay * 3))
+        return self._delay
+    
+    def record_crash(self, now=None):
+        """クラッシュを記録し、予算内ならTrue"""
+        now = time.monotonic() if now is None else now
+        self._crashes = [t for t in self._crashes if now - t < self.window]
+        self._crashes.append(now)
+        remaining = self.budget - len(self._crashes)
+        metrics.set('devbot_crash_budget_remaining', max(0, remaining))
+        return remaining >= 0
+    
+    async def stop(self, restart=False):
+        """実行中のジョブを片付けてから再接続せずに終了（restart=Trueならmain終了後に起動し直す）"""
+        self._stopping = True
+        self.services.restart_requested = restart
+        if self.bot is not None:
+            self.bot.is_shutting_down = True
+        await self.services.drain(self.config.drain_timeout)
+        if self.bot is not None:
+            await self.bot.close()
+    
+    async def run(self):
+        metrics.set('devbot_crash_budget_remaining', self.budget)
+        while not self._stopping:
+            self.bot = DevBot(self.config, self.tray_icon, self.services)
+            started = time.monotonic()
+            try:
+                logger.info("Bot接続開始...")
+                await self.bot.start(self.config.discord_token)
+                # closeされた（stop/restartコマンド・トレイ）
+                break
+            except discord.LoginFailure:
+                logger.error("ログイン失敗: Discord Tokenが無効です")
+                break
+            except Exception as e:
+                reason = type(e).__name__
+                logger.error(f"接続エラー: {e}\n{traceback.format_exc()}")
+            finally:
+                if not self.bot.is_closed():
+                    await self.bot.close()
+            
+            if self._stopping or not self.config.auto_reconnect:
+                break
+            if time.monotonic() - started >= self.HEALTHY_UPTIME:
+                self._delay = self.base_delay
+            if self.record_crash():
+                delay = self.next_delay()
+            else:
+                # 短時間に落ち続けている: 諦めずに長めに休む
+                logger.error(f"{self.window}秒間に{self.budget}回を超えて失敗したため{self.max_delay}秒休止します")
+                self._crashes.clear()
+                self._delay = self.base_delay
+                delay = self.max_delay
+            metrics.inc('devbot_reconnects_total', reason=reason)
+            metrics.set('devbot_reconnect_delay_seconds', delay)
+            logger.info(f"{delay:.1f}秒後にクライアントを作り直して再接続...")
+            await asyncio.sleep(delay)
+
+
+def tray_supported(config):
+    """
+    タスクトレイを使うか（config["tray"]: true / false / "auto"）
+    
+    autoの場合、Linux等ではDISPLAY/WAYLAND_DISPLAYがあるときだけ使う
+    """
+    setting = config.tray
+    if setting != 'auto':
+        return bool(setting)
+    if sys.platform in ('win32', 'darwin'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def start_tray(config, bot_loop, supervisor):
+    """タスクトレイを別スレッドで起動（使えない環境ではNone）"""
+    if not tray_supported(config):
+        logger.info("ヘッドレスモード（タスクトレイなし）")
+        return None
+    try:
+        tray_icon = create_tray_icon(bot_loop, supervisor)
+    except Exception as e:
+        # pystray/Pillow未インストール・表示環境なし
+        logger.warning(f"タスクトレイを起動できません（ヘッドレスで続行）: {e}")
+        return None
+    threading.Thread(target=tray_icon.run, daemon=True).start()
+    return tray_icon
+
+
 def create_tray_image():
     """トレイアイコン用画像作成"""
+    from PIL import Image, ImageDraw
+    
     # 簡単なロボットアイコンを生成
     width = 64
     height = 64
@@ -514,35 +5573,34 @@ def create_tray_image():
     return image
 
 
-def create_tray_icon(bot_loop, bot_instance):
+def create_tray_icon(bot_loop, supervisor):
     """タスクトレイアイコン作成"""
+    # トレイを使うときだけ読み込む（ヘッドレス環境では読み込めないことがある）
+    import pystray
     
     def on_status(icon, item):
         """ステータス確認"""
         logger.info("トレイ: ステータス確認")
-        # ブラウザでログファイルを開く
+        # 既定のアプリでログファイルを開く
         log_file = log_dir / 'bot.log'
         if log_file.exists():
-            os.startfile(log_file)
+            open_path(log_file)
     
     def on_restart(icon, item):
         """再起動"""
         logger.info("トレイ: 再起動")
+        # 終了処理の後、restart_methodに従って起動し直す
         asyncio.run_coroutine_threadsafe(
-            bot_instance.close(),
+            supervisor.stop(restart=True),
             bot_loop
         )
         icon.stop()
-        
-        # 再起動
-        script_path = Path(__file__).parent / "start_bot.vbs"
-        subprocess.Popen(['wscript', str(script_path)], shell=True)
     
     def on_quit(icon, item):
         """終了"""
         logger.info("トレイ: 終了")
         asyncio.run_coroutine_threadsafe(
-            bot_instance.close(),
+            supervisor.stop(),
             bot_loop
         )
         icon.stop()
@@ -566,82 +5624,152 @@ def create_tray_icon(bot_loop, bot_instance):
     return icon
 
 
+async def probe_gateway(host='gateway.discord.gg', port=443, *, timeout=30):
+    """
+    DiscordゲートウェイにTCP接続できるまで待つ（指数バックオフで再試行）
+    
+    timeout秒以内に到達できればTrue
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.5
+    while True:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 5)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError) as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"ゲートウェイに到達できません: {host}:{port} ({e or 'タイムアウト'})")
+                return False
+            logger.info(f"ネットワーク待機中（{e or 'タイムアウト'}）、{min(delay, remaining):.1f}秒後に再試行")
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 10)
+
+
+async def probe_claude(resolver, *, attempts=4):
+    """claudeコマンドが解決できるか確認（見つからなければ短い間隔で再探索）"""
+    delay = 0.5
+    for attempt in range(attempts):
+        path = await asyncio.to_thread(resolver.resolve, attempt > 0)
+        if resolver.cached():
+            return True
+        if attempt + 1 < attempts:
+            await asyncio.sleep(delay)
+            delay *= 2
+    logger.warning(f"claudeコマンドが見つかりません（{path} で試行します）。`!dev diagnose` で確認してください")
+    return False
+
+
+async def wait_until_ready(config, services):
+    """
+    起動に必要な準備ができるまで待つ（固定時間の待機の代わり）
+    
+    ゲートウェイへの到達とclaudeコマンドの解決を並行して確認する。
+    startup_delayは待機の上限で、超えたら接続処理の再試行に任せる
+    """
+    started = time.monotonic()
+    network, claude = await asyncio.gather(
+        probe_gateway(timeout=config.startup_delay),
+        probe_claude(services.claude_resolver)
+    )
+    logger.info(
+        f"起動準備確認: {time.monotonic() - started:.1f}秒 "
+        f"(ネットワーク: {'OK' if network else 'NG'} / claude: {'OK' if claude else 'NG'})"
+    )
+
+
 async def main():
-    """メイン処理"""
+    """メイン処理（再起動を求められたら再起動の方法を返す）"""
     logger.info("=" * 50)
     logger.info("Discord Dev Bot 起動開始")
     logger.info(f"Python: {sys.version}")
     logger.info(f"作業ディレクトリ: {Path.cwd()}")
     logger.info("=" * 50)
     
-    # 設定読み込み
-    config = Config.load()
+    # 設定読み込み（不正な値があれば起動しない）
+    try:
+        config = Config.load()
+    except (json.JSONDecodeError, ConfigError) as e:
+        logger.error(f"config.jsonが不正です: {e}")
+        pause_before_exit()
+        return
+    configure_logging(config)
     
-    if not config['discord_token']:
+    if not config.discord_token:
         logger.error("Discord Tokenが設定されていません！")
         logger.error(f"config.jsonに設定してください: {CONFIG_FILE}")
-        input("Enterキーで終了...")
+        pause_before_exit()
         return
     
-    # Bot作成（トレイアイコンは後で設定）
-    bot = DevBot(config, None)
+    # メトリクスのHTTP公開（0で無効）
+    if config.metrics_port:
+        try:
+            await start_metrics_server(config.metrics_host, config.metrics_port)
+        except OSError as e:
+            logger.error(f"メトリクス公開に失敗: {e}")
     
-    # トレイアイコン作成（別スレッド）
-    loop = asyncio.get_event_loop()
-    tray_icon = create_tray_icon(loop, bot)
-    bot.tray_icon = tray_icon
+    # ジョブキュー等はクライアントの作り直しを跨いで保持
+    services = BotServices(config)
+    supervisor = Supervisor(services)
     
-    # トレイアイコン起動（別スレッド）
-    tray_thread = threading.Thread(target=tray_icon.run, daemon=True)
-    tray_thread.start()
+    # トレイアイコン起動（別スレッド、表示環境がなければヘッドレス）
+    tray_icon = start_tray(config, asyncio.get_running_loop(), supervisor)
+    supervisor.tray_icon = tray_icon
     
-    # 起動遅延（他サービス待機）
-    if config.get('startup_delay', 0) > 0:
-        logger.info(f"{config['startup_delay']}秒待機中...")
-        await asyncio.sleep(config['startup_delay'])
+    # ネットワーク・claudeの準備を確認（準備済みなら待たない）
+    await wait_until_ready(config, services)
     
-    # Bot起動（自動再接続付き）
-    retry_count = 0
-    max_retries = 5
+    # config.jsonの変更を監視（再起動せずに反映）
+    watcher_task = asyncio.create_task(services.watcher.run())
+    # 環境の定期診断
+    health_task = asyncio.create_task(services.health.run())
+    # リポジトリ概要の更新（HEADの変化を定期確認）
+    context_task = asyncio.create_task(services.context.run())
     
-    while retry_count < max_retries:
-        try:
-            logger.info("Bot接続開始...")
-            await bot.start(config['discord_token'])
-            break  # 正常終了
-            
-        except discord.LoginFailure:
-            logger.error("ログイン失敗: Discord Tokenが無効です")
-            break
-            
-        except Exception as e:
-            retry_count += 1
-            logger.error(f"接続エラー ({retry_count}/{max_retries}): {e}")
-            
-            if retry_count < max_retries and config.get('auto_reconnect', True):
-                wait_time = min(60, 10 * retry_count)  # 最大60秒
-                logger.info(f"{wait_time}秒後に再接続...")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error("再接続を諦めました")
-                break
+    # systemctl stop・killなどのSIGTERMでも実行中のジョブを片付けてから終了
+    stop_tasks = []
+    if sys.platform != 'win32':
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: stop_tasks.append(asyncio.create_task(supervisor.stop()))
+        )
+    
+    # Bot起動（切断・例外時はクライアントを作り直して再接続）
+    await supervisor.run()
+    # 接続できずに終わった場合なども、実行中のジョブを待つか中断して保存する
+    await services.drain(services.config.drain_timeout)
+    watcher_task.cancel()
+    health_task.cancel()
+    context_task.cancel()
+    # 実行履歴の書き込み待ちを保存し、DBを閉じてから終了
+    await asyncio.to_thread(services.close)
     
     # 終了処理
     logger.info("Bot終了")
     if tray_icon:
         tray_icon.stop()
+    if services.restart_requested:
+        return resolve_restart_method(services.config)
+    return None
 
 
 if __name__ == "__main__":
+    restart = None
     try:
-        # Windows用イベントループポリシー設定
-        if sys.platform == 'win32':
-            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        
-        asyncio.run(main())
+        # Windowsは既定のProactorイベントループを使用
+        # （SelectorEventLoopはasyncioのサブプロセス実行に対応していない）
+        restart = asyncio.run(main())
         
     except KeyboardInterrupt:
         logger.info("キーボード割り込みで終了")
     except Exception as e:
         logger.error(f"予期しないエラー: {e}\n{traceback.format_exc()}")
-        input("Enterキーで終了...")
+        pause_before_exit()
+    
+    if restart == 'exec':
+        relaunch()
+    elif restart == 'exit':
+        # systemdのRestart=on-failure等で起動し直してもらう
+        logger.info(f"再起動のため終了コード{RESTART_EXIT_CODE}で終了します")
+        stop_log_listener()
+        sys.exit(RESTART_EXIT_CODE)